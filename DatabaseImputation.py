@@ -0,0 +1,303 @@
+# Imputation of the PatientData table inside the database, so that the data
+# never leaves it: the strategies of query1.sql to query4.sql run as
+# UPDATE statements, one transaction per step, in the same order as the
+# Impute methods. The statements are written once and rendered for MySQL 8
+# (UPDATE ... JOIN) or SQLite 3.33+ (UPDATE ... FROM), which stands in for
+# MySQL in the tests. A pandas backend runs the Impute methods instead,
+# on a copy of the table read into memory, for comparison.
+import logging
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, bindparam, inspect, text
+from PatientImputation import Impute
+from PatientLoader import MEASUREMENTS, Patient, table_name, to_parameters
+from StreamingImputation import STEPS
+
+logger = logging.getLogger(__name__)
+
+# Median age of every hospital: the middle known age, or the average of
+# the two middle ones, numbered with a window function
+MEDIAN_AGE = """
+    SELECT hospitalID, AVG(age) AS median_age
+    FROM (
+        SELECT
+            hospitalID,
+            age,
+            ROW_NUMBER() OVER (PARTITION BY hospitalID ORDER BY age) AS row_num,
+            COUNT(*) OVER (PARTITION BY hospitalID) AS ages
+        FROM PatientData
+        WHERE age IS NOT NULL
+    ) ranked
+    WHERE 2 * row_num BETWEEN ages AND ages + 2
+    GROUP BY hospitalID
+"""
+
+# Average cholesterol of every (hospital, age)
+AVERAGE_CHOLESTEROL = """
+    SELECT hospitalID, age, AVG(cholesterol) AS average_cholesterol
+    FROM PatientData
+    WHERE cholesterol IS NOT NULL
+    GROUP BY hospitalID, age
+"""
+
+# Lowest cholesterol of every five-year age bracket, given the expression
+# of the bracket of age
+MIN_CHOLESTEROL = """
+    SELECT {bracket} AS age_bracket, MIN(cholesterol) AS min_cholesterol
+    FROM PatientData
+    WHERE cholesterol IS NOT NULL
+    GROUP BY age_bracket
+"""
+
+# Majority value of a column for every patient with several rows, when its
+# most frequent known value is not tied, like majority_values. The rows per
+# patient come from a window over the same counts, so the database never
+# joins them back row by row.
+MAJORITY_VALUE = """
+    SELECT patientID, majority
+    FROM (
+        SELECT
+            patientID,
+            majority,
+            RANK() OVER (
+                PARTITION BY patientID ORDER BY majority IS NULL, value_rows DESC
+            ) AS value_rank,
+            COUNT(*) OVER (
+                PARTITION BY patientID, majority IS NULL, value_rows
+            ) AS tied_values,
+            SUM(value_rows) OVER (PARTITION BY patientID) AS patient_rows
+        FROM (
+            SELECT patientID, {column} AS majority, COUNT(*) AS value_rows
+            FROM PatientData
+            GROUP BY patientID, {column}
+        ) value_counts
+    ) counts
+    WHERE value_rank = 1
+        AND tied_values = 1
+        AND patient_rows > 1
+        AND majority IS NOT NULL
+"""
+
+
+# Least-squares line of tomography over cholesterol. Like
+# RegressionStatistics, the slope is zero when all the known cholesterol
+# levels are equal (up to rounding).
+TOMOGRAPHY_LINE = f"""
+    SELECT mean_tomography - slope * mean_cholesterol AS intercept, slope
+    FROM (
+        SELECT
+            means.mean_cholesterol,
+            means.mean_tomography,
+            CASE
+                WHEN SUM(
+                    (known.cholesterol - means.mean_cholesterol)
+                    * (known.cholesterol - means.mean_cholesterol)
+                ) > {np.finfo(float).eps} * SUM(known.cholesterol * known.cholesterol)
+                THEN SUM(
+                    (known.cholesterol - means.mean_cholesterol)
+                    * (known.tomography - means.mean_tomography)
+                ) / SUM(
+                    (known.cholesterol - means.mean_cholesterol)
+                    * (known.cholesterol - means.mean_cholesterol)
+                )
+                ELSE 0
+            END AS slope
+        FROM PatientData known, (
+            SELECT
+                AVG(cholesterol) AS mean_cholesterol,
+                AVG(tomography) AS mean_tomography
+            FROM PatientData
+            WHERE cholesterol IS NOT NULL AND tomography IS NOT NULL
+        ) means
+        WHERE known.cholesterol IS NOT NULL AND known.tomography IS NOT NULL
+        GROUP BY means.mean_cholesterol, means.mean_tomography
+    ) fit
+"""
+
+
+# Returns an UPDATE statement for the dialect ("mysql" or "sqlite") that
+# sets column of the rows of PatientData (aliased pd) to value for every
+# row of the query source they match by condition and where filter holds
+def update_from(dialect, column, value, source, condition, filter="1 = 1"):
+    if dialect == "mysql":
+        return (
+            f"UPDATE {table_name} pd JOIN ({source}) source ON {condition} "
+            f"SET pd.{column} = {value} WHERE {filter}"
+        )
+    if dialect == "sqlite":
+        return (
+            f"UPDATE {table_name} AS pd SET {column} = {value} "
+            f"FROM ({source}) AS source WHERE {condition} AND {filter}"
+        )
+    raise ValueError(f"Imputation in the database is not supported for {dialect}")
+
+
+# Returns the expression of the five-year age bracket of age for the
+# dialect. SQLite may lack FLOOR, and its CAST truncates, which is the same
+# for the ages, which are never negative.
+def age_bracket(dialect, age):
+    if dialect == "sqlite":
+        return f"CAST({age} / 5 AS INTEGER)"
+    return f"FLOOR({age} / 5)"
+
+
+# Returns whether the PatientData table of an engine has the age_bracket
+# column added by PatientSchema.tune_schema
+def has_age_bracket(engine):
+    return any(
+        column["name"] == "age_bracket" for column in inspect(engine).get_columns(table_name)
+    )
+
+
+# Returns the UPDATE statements of every step for the dialect. With
+# bracket_column, the cholesterol step reads the age_bracket column (and
+# its index) instead of computing the bracket of every row.
+def step_statements(dialect, bracket_column=False):
+    if bracket_column:
+        bracket, row_bracket = "age_bracket", "pd.age_bracket"
+    else:
+        bracket, row_bracket = age_bracket(dialect, "age"), age_bracket(dialect, "pd.age")
+    return {
+        "age": [
+            update_from(
+                dialect,
+                "age",
+                "source.median_age",
+                MEDIAN_AGE,
+                "pd.hospitalID = source.hospitalID",
+                "pd.age IS NULL",
+            )
+        ],
+        "cholesterol_single_hospital": [
+            update_from(
+                dialect,
+                "cholesterol",
+                "source.average_cholesterol",
+                AVERAGE_CHOLESTEROL,
+                "pd.hospitalID = source.hospitalID AND pd.age = source.age",
+                "pd.cholesterol IS NULL",
+            )
+        ],
+        "cholesterol": [
+            update_from(
+                dialect,
+                "cholesterol",
+                "source.min_cholesterol",
+                MIN_CHOLESTEROL.format(bracket=bracket),
+                f"{row_bracket} = source.age_bracket",
+                "pd.cholesterol IS NULL",
+            )
+        ],
+        # Sanitization of duplicate patients, then the regression
+        "tomography": [
+            update_from(
+                dialect,
+                column,
+                "source.majority",
+                MAJORITY_VALUE.format(column=column),
+                "pd.patientID = source.patientID",
+            )
+            for column in ["cholesterol", "tomography"]
+        ]
+        + [
+            update_from(
+                dialect,
+                "tomography",
+                "source.intercept + source.slope * pd.cholesterol",
+                TOMOGRAPHY_LINE,
+                "1 = 1",
+                "pd.tomography IS NULL AND pd.cholesterol IS NOT NULL",
+            )
+        ],
+    }
+
+
+# Runs the imputation steps over the PatientData table of an engine, either
+# inside the database (backend="database") or with the Impute methods on a
+# copy of the table read into memory (backend="pandas"), writing back the
+# rows they change. Both give the same table.
+class DatabaseImpute:
+    def __init__(self, engine, backend="database"):
+        if backend not in ("database", "pandas"):
+            raise ValueError(f"Unknown imputation backend {backend}")
+        self.engine = engine
+        self.backend = backend
+
+    # Runs every step, each in its own transaction with the database
+    # backend. Returns the time in seconds each step took.
+    def impute(self):
+        if self.backend == "pandas":
+            return self.impute_in_memory()
+
+        statements = step_statements(self.engine.dialect.name, has_age_bracket(self.engine))
+        timings = {}
+        for step in STEPS:
+            start = time.perf_counter()
+            rows = 0
+            with self.engine.begin() as connection:
+                # Like impute_tomography, nothing is sanitized or
+                # predicted when no cholesterol level is known
+                if step != "tomography" or connection.execute(
+                    text(f"SELECT COUNT(cholesterol) FROM {table_name}")
+                ).scalar():
+                    rows = sum(
+                        connection.execute(text(statement)).rowcount
+                        for statement in statements[step]
+                    )
+            timings[step] = time.perf_counter() - start
+            logger.info(
+                "Imputed %s in the database in %.2fs (%d rows updated)", step, timings[step], rows
+            )
+        return timings
+
+    # Reads the table, runs the Impute methods and writes back the rows
+    # they changed in one transaction. Returns the time each step took,
+    # including reading ("read") and writing ("write").
+    def impute_in_memory(self):
+        timings = {}
+        start = time.perf_counter()
+        input_data = pd.read_sql_table(table_name, self.engine)
+        timings["read"] = time.perf_counter() - start
+
+        patient_imputer = Impute(input_data.copy())
+        methods = {
+            "age": patient_imputer.impute_age_all_hospitals,
+            "cholesterol_single_hospital": patient_imputer.impute_cholesterol_all_hospitals,
+            "cholesterol": patient_imputer.impute_cholesterol,
+            "tomography": patient_imputer.impute_tomography,
+        }
+        for step in STEPS:
+            start = time.perf_counter()
+            methods[step]()
+            timings[step] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        imputed_data = patient_imputer.input_data
+        changed = np.zeros(len(input_data), dtype=bool)
+        for column in MEASUREMENTS:
+            old = input_data[column].to_numpy()
+            new = imputed_data[column].to_numpy()
+            changed |= (old != new) & (pd.notna(old) | pd.notna(new))
+        if changed.any():
+            table = Patient.__table__
+            statement = (
+                table.update()
+                .where(
+                    and_(
+                        table.c.patientID == bindparam("key_patientID"),
+                        table.c.hospitalID == bindparam("key_hospitalID"),
+                    )
+                )
+                .values({column: bindparam(column) for column in MEASUREMENTS})
+            )
+            parameters = to_parameters(
+                imputed_data.loc[changed].rename(
+                    columns={"patientID": "key_patientID", "hospitalID": "key_hospitalID"}
+                )
+            )
+            with self.engine.begin() as connection:
+                connection.execute(statement, parameters)
+        timings["write"] = time.perf_counter() - start
+        logger.info("Imputed the table in memory in %.2fs", sum(timings.values()))
+        return timings
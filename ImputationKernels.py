@@ -0,0 +1,240 @@
+# Kernels computing the grouped statistics of the Impute methods over
+# NumPy arrays: the median age per hospital, the average cholesterol per
+# (hospital, age), the lowest cholesterol per age bracket and the majority
+# value per patient. Groups are integer codes (-1 for rows in no group, see
+# group_codes) and values are float arrays with np.nan for unknown values.
+# When Numba is installed the loops below are compiled and every count,
+# sum and minimum is gathered in a single pass over the rows; otherwise the
+# same statistics are computed with NumPy (bincount, sort, ufunc.at) and
+# pandas' compensated groupby sum.
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Whether the loops are compiled by Numba
+COMPILED = njit is not None
+
+
+# Returns the integer code of the group of every row for the given key
+# arrays, and the number of groups. Rows with an unknown key get -1.
+def group_codes(*keys):
+    codes, uniques = pd.factorize(keys[0])
+    codes, groups = codes.astype(np.int64), len(uniques)
+    for key in keys[1:]:
+        key_codes, uniques = pd.factorize(key)
+        codes, groups = combine_codes(codes, groups, key_codes, len(uniques))
+    return codes, groups
+
+
+# Returns the codes of the groups of the pairs of two groupings of the
+# rows (codes and number of groups each) and their number. Only the pairs
+# that occur are groups; rows in no group of either get -1.
+def combine_codes(codes, groups, other_codes, other_groups):
+    grouped = (codes >= 0) & (other_codes >= 0)
+    combined = np.full(len(codes), -1, dtype=np.int64)
+    combined[grouped], uniques = pd.factorize(
+        codes[grouped].astype(np.int64) * other_groups + other_codes[grouped]
+    )
+    return combined, len(uniques)
+
+
+# Returns the statistic of the group of every row, np.nan for rows in no group
+def per_row(statistics, codes):
+    return np.append(statistics, np.nan)[codes]
+
+
+# Returns the values of a column as a NumPy array in its dtype, with np.nan
+# for the unknown values of nullable columns (which become float64)
+def column_values(series):
+    if isinstance(series.dtype, np.dtype):
+        return series.to_numpy()
+    return series.to_numpy(dtype=float, na_value=np.nan)
+
+
+# Returns the values (a column or an array) as a float array with np.nan
+# for unknown values
+def float_values(values):
+    if isinstance(values, pd.Series):
+        values = column_values(values)
+    return np.asarray(values, dtype=float)
+
+
+# Loops compiled by Numba when it is installed. Each takes the codes, the
+# float values and the number of groups.
+
+
+# Number of known values and their compensated sum per group, adding the
+# values in row order like pandas' groupby mean
+def sum_loop(codes, values, groups):
+    counts = np.zeros(groups, dtype=np.int64)
+    sums = np.zeros(groups)
+    compensation = np.zeros(groups)
+    for row in range(len(codes)):
+        group = codes[row]
+        value = values[row]
+        if group < 0 or np.isnan(value):
+            continue
+        counts[group] += 1
+        y = value - compensation[group]
+        t = sums[group] + y
+        compensation[group] = t - sums[group] - y
+        if compensation[group] != compensation[group]:
+            compensation[group] = 0.0
+        sums[group] = t
+    return counts, sums
+
+
+# Lowest known value per group, np.nan for groups without one
+def min_loop(codes, values, groups):
+    minimums = np.full(groups, np.nan)
+    for row in range(len(codes)):
+        group = codes[row]
+        value = values[row]
+        if group < 0 or np.isnan(value):
+            continue
+        if not value >= minimums[group]:
+            minimums[group] = value
+    return minimums
+
+
+# Known values ordered by group and then by value, with the offset of the
+# first value of every group (and the number of values at the end)
+def sort_loop(codes, values, groups):
+    offsets = np.zeros(groups + 1, dtype=np.int64)
+    for row in range(len(codes)):
+        if codes[row] >= 0 and not np.isnan(values[row]):
+            offsets[codes[row] + 1] += 1
+    offsets = np.cumsum(offsets)
+    next_position = offsets[:-1].copy()
+    ordered = np.empty(offsets[-1])
+    for row in range(len(codes)):
+        group = codes[row]
+        if group >= 0 and not np.isnan(values[row]):
+            ordered[next_position[group]] = values[row]
+            next_position[group] += 1
+    for group in range(groups):
+        ordered[offsets[group] : offsets[group + 1]].sort()
+    return offsets, ordered
+
+
+if COMPILED:
+    sum_loop = njit(cache=True)(sum_loop)
+    min_loop = njit(cache=True)(min_loop)
+    sort_loop = njit(cache=True)(sort_loop)
+
+
+# The same statistics with NumPy and pandas
+
+
+# The sums come from pandas' groupby, which compensates them like sum_loop
+# where np.bincount would round them differently. Grouping by a Categorical
+# of the codes saves pandas factorizing them again.
+def sum_numpy(codes, values, groups):
+    known = (codes >= 0) & ~np.isnan(values)
+    counts = np.bincount(codes[known], minlength=groups)
+    categories = pd.Categorical.from_codes(codes[known], categories=pd.RangeIndex(groups))
+    sums = pd.Series(values[known]).groupby(categories, observed=False).sum().to_numpy()
+    return counts, sums
+
+
+def min_numpy(codes, values, groups):
+    known = (codes >= 0) & ~np.isnan(values)
+    minimums = np.full(groups, np.inf)
+    np.minimum.at(minimums, codes[known], values[known])
+    minimums[np.bincount(codes[known], minlength=groups) == 0] = np.nan
+    return minimums
+
+
+# Sorts one integer key per value, made of its group and the rank of the
+# value among the distinct values, which is much faster than sorting by
+# two keys
+def sort_numpy(codes, values, groups, by_value=True):
+    known = (codes >= 0) & ~np.isnan(values)
+    codes = codes[known]
+    value_codes, uniques = pd.factorize(values[known], sort=by_value)
+    offsets = np.zeros(groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=groups), out=offsets[1:])
+    keys = np.sort(codes * max(len(uniques), 1) + value_codes)
+    return offsets, uniques[keys % max(len(uniques), 1)]
+
+
+# Known values ordered by group, with equal values next to each other but
+# not sorted, which saves sorting the distinct values
+def cluster_numpy(codes, values, groups):
+    return sort_numpy(codes, values, groups, by_value=False)
+
+
+# Returns the kernel for a statistic: the compiled loop when Numba is
+# installed (or loops=True, which runs the loops uncompiled without Numba),
+# its NumPy version otherwise. sort_loop also serves as the cluster kernel,
+# since values sorted in their group are clustered too.
+def kernel(name, loops=None):
+    if loops is None:
+        loops = COMPILED
+    if loops:
+        kernels = {"sum": sum_loop, "min": min_loop, "sort": sort_loop, "cluster": sort_loop}
+    else:
+        kernels = {"sum": sum_numpy, "min": min_numpy, "sort": sort_numpy, "cluster": cluster_numpy}
+    return kernels[name]
+
+
+# Returns the number of known values of every group and their sum
+def group_sums(codes, values, groups, loops=None):
+    return kernel("sum", loops)(codes, float_values(values), groups)
+
+
+# Returns the average of the known values of every group, np.nan for
+# groups without one
+def group_mean(codes, values, groups, loops=None):
+    counts, sums = kernel("sum", loops)(codes, float_values(values), groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+# Returns the lowest known value of every group, np.nan for groups without one
+def group_min(codes, values, groups, loops=None):
+    return kernel("min", loops)(codes, float_values(values), groups)
+
+
+# Returns the median of the known values of every group: the middle value
+# or the average of the two middle ones, np.nan for groups without one
+def group_median(codes, values, groups, loops=None):
+    offsets, ordered = kernel("sort", loops)(codes, float_values(values), groups)
+    counts = np.diff(offsets)
+    has_values = counts > 0
+    lower = offsets[:-1][has_values] + (counts[has_values] - 1) // 2
+    upper = offsets[:-1][has_values] + counts[has_values] // 2
+    medians = np.full(groups, np.nan)
+    medians[has_values] = (ordered[lower] + ordered[upper]) / 2
+    return medians
+
+
+# Returns the most frequent known value of every group, np.nan for groups
+# without one or where it is tied
+def group_majority(codes, values, groups, loops=None):
+    offsets, ordered = kernel("cluster", loops)(codes, float_values(values), groups)
+    majorities = np.full(groups, np.nan)
+    if len(ordered) == 0:
+        return majorities
+
+    # Runs of equal values within every group
+    group_of = np.repeat(np.arange(groups), np.diff(offsets))
+    starts = np.ones(len(ordered), dtype=bool)
+    starts[1:] = (ordered[1:] != ordered[:-1]) | (group_of[1:] != group_of[:-1])
+    run_starts = np.flatnonzero(starts)
+    run_lengths = np.diff(np.append(run_starts, len(ordered)))
+    run_groups = group_of[run_starts]
+
+    # Longest run of every group and how many runs reach it
+    longest = np.zeros(groups, dtype=np.int64)
+    np.maximum.at(longest, run_groups, run_lengths)
+    is_mode = run_lengths == longest[run_groups]
+    modes = np.bincount(run_groups[is_mode], minlength=groups)
+
+    majorities[run_groups[is_mode]] = ordered[run_starts[is_mode]]
+    majorities[modes != 1] = np.nan
+    return majorities
@@ -0,0 +1,198 @@
+# Fused execution of several imputation strategies of Impute. Called one
+# after another, the Impute methods each scan the frame, build their own
+# masks and group keys, write into it and return a DataFrame of changed
+# rows. An ImputationPlan reads the frame once into arrays, factorizes the
+# hospitals once and the ages once per state of them, so that every step
+# groups by codes it shares with the others, computes each grouped
+# statistic in one pass with the kernels of ImputationKernels, then writes
+# every column once and returns a single report of the cells that changed.
+# The frame ends up exactly as after calling the methods in the same order.
+import numpy as np
+import pandas as pd
+from ImputationKernels import (
+    combine_codes,
+    group_codes,
+    group_mean,
+    group_median,
+    group_min,
+    per_row,
+)
+from PatientImputation import RegressionStatistics, majority_values
+from PatientLoader import MEASUREMENTS
+from StreamingImputation import STEPS
+
+
+# Returns where two float arrays differ, taking np.nan as equal to np.nan
+def differs(old, new):
+    return (old != new) & ~(np.isnan(old) & np.isnan(new))
+
+
+# Ordered strategies to run over the input_data of an Impute. Nothing is
+# computed until run is called.
+class ImputationPlan:
+    def __init__(self, patient_imputer, steps=STEPS):
+        unknown = [step for step in steps if step not in STEPS]
+        if unknown:
+            raise ValueError(f"Unknown imputation steps: {', '.join(unknown)}")
+        self.patient_imputer = patient_imputer
+        self.steps = list(steps)
+
+    # Runs the strategies and writes their results into input_data. Returns
+    # a DataFrame with one row per changed cell, ordered by row and column:
+    # its position in input_data, the patientID and hospitalID of its row,
+    # its column, the last step that changed it (both categorical) and its
+    # old and new values.
+    def run(self):
+        # input_data is read once, from the tracker the changes are written
+        # through, which on the Polars backend is its only pandas copy
+        changes = self.patient_imputer.changes()
+        input_data = changes.input_data
+        # Working copies of the measurements in the dtypes of their columns,
+        # so that every step reads the same values as the Impute methods do
+        self.values = {}
+        for column in MEASUREMENTS:
+            dtype = input_data[column].dtype
+            if not (isinstance(dtype, np.dtype) and dtype.kind == "f"):
+                dtype = np.dtype(dtype.numpy_dtype if hasattr(dtype, "numpy_dtype") else float)
+            self.values[column] = input_data[column].to_numpy(
+                dtype=dtype, na_value=np.nan, copy=True
+            )
+        original = {column: values.copy() for column, values in self.values.items()}
+        self.written_by = {
+            column: np.full(len(input_data), -1, dtype=np.int8) for column in MEASUREMENTS
+        }
+        self.input_data = input_data
+        self._hospital_codes = None
+        self._age_codes = None
+
+        steps = {
+            "age": self.impute_age,
+            "cholesterol_single_hospital": self.impute_cholesterol_single_hospital,
+            "cholesterol": self.impute_cholesterol,
+            "tomography": self.impute_tomography,
+        }
+        for index, step in enumerate(self.steps):
+            self.step_index = index
+            steps[step]()
+
+        # Write every changed column once and report its changed cells
+        positions, column_codes, step_indexes, old_values, new_values = [], [], [], [], []
+        for column_code, column in enumerate(MEASUREMENTS):
+            old, new = original[column], self.values[column]
+            changed = np.flatnonzero(differs(old, new))
+            changes.fill_positions(changed, column, new[changed])
+            positions.append(changed)
+            column_codes.append(np.full(len(changed), column_code, dtype=np.int8))
+            step_indexes.append(self.written_by[column][changed])
+            old_values.append(old[changed].astype(float))
+            new_values.append(new[changed].astype(float))
+
+        positions = np.concatenate(positions)
+        column_codes = np.concatenate(column_codes)
+        order = np.lexsort((column_codes, positions))
+        positions = positions[order]
+        step_names, step_codes = np.unique(self.steps, return_inverse=True)
+        return pd.DataFrame(
+            {
+                "position": positions,
+                "patientID": input_data["patientID"].to_numpy()[positions],
+                "hospitalID": input_data["hospitalID"].to_numpy()[positions],
+                "column": pd.Categorical.from_codes(
+                    column_codes[order], categories=MEASUREMENTS
+                ),
+                "step": pd.Categorical.from_codes(
+                    step_codes[np.concatenate(step_indexes)[order]], categories=step_names
+                ),
+                "old_value": np.concatenate(old_values)[order],
+                "new_value": np.concatenate(new_values)[order],
+            }
+        )
+
+    # Writes values into column at the rows where mask is True, rounded to
+    # the dtype of the column like ChangeTracker does, and records the step
+    def write(self, mask, column, values):
+        self.values[column][mask] = values
+        self.written_by[column][mask] = self.step_index
+        if column == "age":
+            self._age_codes = None
+
+    # Codes of the hospital of every row (-1 when unknown) and the number
+    # of hospitals, shared by every step that groups by hospital
+    def hospital_codes(self):
+        if self._hospital_codes is None:
+            self._hospital_codes = group_codes(self.input_data["hospitalID"])
+        return self._hospital_codes
+
+    # Codes of the age of every row (-1 when unknown) and the distinct ages,
+    # shared by the steps that group by age until an age is written
+    def age_codes(self):
+        if self._age_codes is None:
+            self._age_codes = pd.factorize(self.values["age"])
+        return self._age_codes
+
+    # Like impute_age_all_hospitals
+    def impute_age(self):
+        ages = self.values["age"]
+        codes, hospitals = self.hospital_codes()
+        median_age = per_row(group_median(codes, ages, hospitals), codes)
+        mask = np.isnan(ages) & ~np.isnan(median_age)
+        self.write(mask, "age", median_age[mask])
+
+    # Like impute_cholesterol_all_hospitals. When there are no more
+    # (hospital, age) pairs than rows, every pair is a group, which saves
+    # numbering only the pairs that occur.
+    def impute_cholesterol_single_hospital(self):
+        cholesterol = self.values["cholesterol"]
+        hospital_codes, hospitals = self.hospital_codes()
+        age_codes, ages = self.age_codes()
+        if hospitals * len(ages) <= len(cholesterol):
+            codes = np.where(
+                (hospital_codes >= 0) & (age_codes >= 0),
+                hospital_codes * len(ages) + age_codes,
+                -1,
+            )
+            groups = hospitals * len(ages)
+        else:
+            codes, groups = combine_codes(hospital_codes, hospitals, age_codes, len(ages))
+        average_cholesterol = per_row(group_mean(codes, cholesterol, groups), codes)
+        mask = np.isnan(cholesterol) & ~np.isnan(average_cholesterol)
+        self.write(mask, "cholesterol", average_cholesterol[mask])
+
+    # Like impute_cholesterol, with the bracket of every row looked up from
+    # the bracket of its distinct age
+    def impute_cholesterol(self):
+        cholesterol = self.values["cholesterol"]
+        age_codes, ages = self.age_codes()
+        age_brackets, brackets = pd.factorize((ages // 5) * 5)
+        codes = np.where(age_codes >= 0, np.append(age_brackets, -1)[age_codes], -1)
+        min_cholesterol = per_row(group_min(codes, cholesterol, len(brackets)), codes)
+        mask = np.isnan(cholesterol) & ~np.isnan(min_cholesterol)
+        self.write(mask, "cholesterol", min_cholesterol[mask])
+
+    # Like impute_tomography: sanitization of duplicate patients, then the
+    # least-squares prediction
+    def impute_tomography(self):
+        cholesterol = self.values["cholesterol"]
+        if np.isnan(cholesterol).all():
+            return
+
+        columns = ["cholesterol", "tomography"]
+        sanitized = majority_values(
+            pd.DataFrame(
+                {
+                    "patientID": self.input_data["patientID"].to_numpy(),
+                    **{column: self.values[column] for column in columns},
+                }
+            ),
+            columns,
+        )
+        for column in columns:
+            new = sanitized[column].to_numpy()
+            mask = differs(self.values[column], new)
+            self.write(mask, column, new[mask])
+
+        tomography = self.values["tomography"]
+        model = RegressionStatistics().update(cholesterol, tomography)
+        if model.count > 0:
+            mask = np.isnan(tomography) & ~np.isnan(cholesterol)
+            self.write(mask, "tomography", model.predict(cholesterol[mask]))
@@ -0,0 +1,334 @@
+# Incremental imputation of the hospital files: the data and the statistics
+# of every imputation strategy are persisted per hospital in a directory,
+# so that when a hospital file is new or has changed only the statistics of
+# that hospital are recomputed and only the rows they affect are imputed
+# again, instead of imputing every hospital from scratch.
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from MedianSketch import HistogramMedian
+from PatientImputation import RegressionStatistics, majority_values
+from PatientLoader import hospital_number, hospital_records, replace_hospital_records
+
+COLUMNS = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+
+# Returns the statistics of a hospital that only depend on its own rows:
+# the histogram of its known ages and, once unknown ages are set to the
+# median, the cholesterol sum and count per age, the lowest known
+# cholesterol per five-year age bracket and the brackets of the rows whose
+# cholesterol is left to the minimum of their bracket across all hospitals.
+def hospital_statistics(raw):
+    histogram = HistogramMedian().update(np.zeros(len(raw)), raw["age"])
+    median_age = histogram.medians()
+    median_age = median_age.iloc[0] if len(median_age) > 0 else np.nan
+    ages = raw["age"].fillna(median_age)
+
+    by_age = raw["cholesterol"].groupby(ages)
+    pending = (
+        raw["cholesterol"].isnull()
+        & ages.notnull()
+        & by_age.transform("count").fillna(0).eq(0)
+    )
+    return {
+        "age_histogram": {
+            str(age): int(count)
+            for (_, age), count in histogram.counts.items()
+        },
+        "median_age": None if pd.isna(median_age) else float(median_age),
+        "cholesterol_per_age": {
+            str(age): [float(total), int(count)]
+            for age, total, count in zip(
+                by_age.sum().index, by_age.sum().to_numpy(), by_age.count().to_numpy()
+            )
+            if count > 0
+        },
+        "bracket_min": {
+            str(bracket): float(minimum)
+            for bracket, minimum in raw["cholesterol"]
+            .groupby((ages // 5) * 5)
+            .min()
+            .dropna()
+            .items()
+        },
+        "pending_brackets": sorted(set(((ages[pending] // 5) * 5).tolist())),
+    }
+
+
+# Applies the age and cholesterol strategies of Impute to the rows of one
+# hospital given its statistics and the lowest known cholesterol of every
+# age bracket across all hospitals. Returns the imputed copy of raw.
+def impute_hospital(raw, statistics, bracket_min):
+    data = raw.copy()
+    if statistics["median_age"] is not None:
+        data.loc[data["age"].isnull(), "age"] = statistics["median_age"]
+
+    average_cholesterol = pd.Series(
+        {float(age): total / count for age, (total, count) in statistics["cholesterol_per_age"].items()},
+        dtype=float,
+    )
+    imputed = data["age"].map(average_cholesterol)
+    unknown = data["cholesterol"].isnull() & imputed.notnull()
+    data.loc[unknown, "cholesterol"] = imputed[unknown].to_numpy()
+
+    imputed = ((data["age"] // 5) * 5).map(bracket_min)
+    unknown = data["cholesterol"].isnull() & imputed.notnull()
+    data.loc[unknown, "cholesterol"] = imputed[unknown].to_numpy()
+    return data
+
+
+# Persisted imputation of the patients of many hospitals, kept in directory.
+# The result is the same as calling impute_age_all_hospitals,
+# impute_cholesterol_all_hospitals, impute_cholesterol and
+# impute_tomography of Impute over the rows of all hospitals, in order of
+# hospitalID, up to rounding of the tomography regression.
+class IncrementalImpute:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for stage in ["raw", "imputed", "sanitized"]:
+            os.makedirs(os.path.join(directory, stage), exist_ok=True)
+
+        statistics_path = os.path.join(directory, "statistics.json")
+        if os.path.exists(statistics_path):
+            with open(statistics_path) as statistics_file:
+                self.statistics = json.load(statistics_file)
+        else:
+            self.statistics = {"files": {}, "hospitals": {}}
+
+        patients_path = os.path.join(directory, "patients.pkl")
+        if os.path.exists(patients_path):
+            self.patients = pd.read_pickle(patients_path)
+        else:
+            self.patients = pd.DataFrame({"patientID": [], "hospitalID": []})
+
+    def partition_path(self, stage, hospitalID):
+        return os.path.join(self.directory, stage, f"hospital-{hospitalID}.pkl")
+
+    def read_partition(self, stage, hospitalID):
+        return pd.read_pickle(self.partition_path(stage, hospitalID))
+
+    def write_partition(self, stage, hospitalID, data):
+        data.to_pickle(self.partition_path(stage, hospitalID))
+
+    def hospitals(self):
+        return sorted(int(hospitalID) for hospitalID in self.statistics["hospitals"])
+
+    # Lowest known cholesterol of every age bracket across all hospitals
+    def bracket_min(self):
+        minimums = {}
+        for statistics in self.statistics["hospitals"].values():
+            for bracket, minimum in statistics["bracket_min"].items():
+                bracket = float(bracket)
+                minimums[bracket] = min(minimums.get(bracket, minimum), minimum)
+        return pd.Series(minimums, dtype=float)
+
+    # Tomography regression over the sanitized rows of all hospitals
+    def regression(self):
+        regression = RegressionStatistics()
+        for statistics in self.statistics["hospitals"].values():
+            hospital_regression = RegressionStatistics()
+            (
+                hospital_regression.count,
+                hospital_regression.sum_x,
+                hospital_regression.sum_y,
+                hospital_regression.sum_xx,
+                hospital_regression.sum_xy,
+            ) = statistics["regression"]
+            regression.merge(hospital_regression)
+        return regression
+
+    # Whether any cholesterol is known once age and cholesterol are imputed;
+    # impute_tomography changes nothing otherwise.
+    def sanitize(self):
+        return any(
+            statistics["known_cholesterol"]
+            for statistics in self.statistics["hospitals"].values()
+        )
+
+    # Reads the hospital files that are new or have changed since they were
+    # last ingested and updates the imputation. The rows of a hospital are
+    # those of all its files, merged like bulk_insert_records does.
+    # Returns the set of hospitals whose imputed rows were updated.
+    def ingest_files(self, filepaths):
+        files_per_hospital = {}
+        digests = {}
+        for filepath in filepaths:
+            with open(filepath, "rb") as hospital_file:
+                digest = hashlib.sha1(hospital_file.read()).hexdigest()
+            files_per_hospital.setdefault(hospital_number(filepath), []).append(filepath)
+            if self.statistics["files"].get(filepath) != digest:
+                digests[filepath] = digest
+
+        changed = {}
+        for hospitalID, hospital_filepaths in files_per_hospital.items():
+            if any(filepath in digests for filepath in hospital_filepaths):
+                data = pd.concat([pd.read_csv(filepath) for filepath in hospital_filepaths])
+                changed[hospitalID] = hospital_records(data, hospitalID)
+
+        updated = self.update(changed)
+        self.statistics["files"].update(digests)
+        self.save_statistics()
+        return updated
+
+    # Whether unknown tomography is predicted and the sums of the line that
+    # predicts it, which change with the rows of any hospital
+    def prediction(self):
+        regression = self.regression()
+        return (
+            self.sanitize(),
+            regression.count,
+            regression.sum_x,
+            regression.sum_y,
+            regression.sum_xx,
+            regression.sum_xy,
+        )
+
+    # Ingests the hospital files like ingest_files and writes the imputed
+    # rows that changed into the PatientData table of an engine: the rows of
+    # the updated hospitals are replaced, and those of every hospital when
+    # the tomography line changed, since it predicts their unknown values.
+    # Returns the set of hospitals whose rows were replaced.
+    def ingest_into_table(self, engine, filepaths, batch_size=10000):
+        prediction = self.prediction()
+        updated = self.ingest_files(filepaths)
+        if updated and self.prediction() != prediction:
+            updated = set(self.hospitals())
+        if updated:
+            replace_hospital_records(engine, self.load(updated), updated, batch_size)
+        return updated
+
+    # Replaces the rows of the hospitals in the dictionary hospital_data
+    # (hospitalID -> DataFrame with the five attributes expected by Impute)
+    # and imputes again only the rows that depend on them. Returns the set
+    # of hospitals whose imputed rows were updated.
+    def update(self, hospital_data):
+        if not hospital_data:
+            return set()
+        was_sanitized = self.sanitize()
+        old_bracket_min = self.bracket_min()
+        affected_patients = set()
+
+        # Statistics that only depend on the rows of each changed hospital
+        for hospitalID, raw in hospital_data.items():
+            raw = raw[COLUMNS].reset_index(drop=True)
+            key = str(hospitalID)
+            if key in self.statistics["hospitals"]:
+                affected_patients.update(self.read_partition("raw", hospitalID)["patientID"])
+            self.write_partition("raw", hospitalID, raw)
+            self.statistics["hospitals"][key] = hospital_statistics(raw)
+
+        # Hospitals with rows waiting for the minimum of a bracket that changed
+        bracket_min = self.bracket_min()
+        changed_brackets = set(
+            bracket
+            for bracket in set(old_bracket_min.index) | set(bracket_min.index)
+            if old_bracket_min.get(bracket) != bracket_min.get(bracket)
+        )
+        reimputed = set(hospital_data) | set(
+            int(key)
+            for key, statistics in self.statistics["hospitals"].items()
+            if changed_brackets.intersection(statistics["pending_brackets"])
+        )
+
+        # Age and cholesterol strategies for the affected hospitals
+        for hospitalID in reimputed:
+            raw = self.read_partition("raw", hospitalID)
+            statistics = self.statistics["hospitals"][str(hospitalID)]
+            imputed = impute_hospital(raw, statistics, bracket_min)
+            self.write_partition("imputed", hospitalID, imputed)
+            statistics["known_cholesterol"] = bool(imputed["cholesterol"].notnull().any())
+            affected_patients.update(imputed["patientID"])
+
+        self.patients = pd.concat(
+            [
+                self.patients[~self.patients["hospitalID"].isin(list(reimputed))],
+                pd.concat(
+                    [
+                        self.read_partition("imputed", hospitalID)[["patientID", "hospitalID"]]
+                        for hospitalID in reimputed
+                    ]
+                ).drop_duplicates(),
+            ],
+            ignore_index=True,
+        )
+
+        # Sanitization needs every row of a patient; when it is switched on
+        # or off every patient is affected
+        if self.sanitize() != was_sanitized:
+            affected_patients = set(self.patients["patientID"])
+        resanitized = reimputed | set(
+            self.patients.loc[
+                self.patients["patientID"].isin(list(affected_patients)), "hospitalID"
+            ].astype(int)
+        )
+        self.resanitize(resanitized, reimputed, affected_patients)
+
+        self.patients.to_pickle(os.path.join(self.directory, "patients.pkl"))
+        self.save_statistics()
+        return resanitized
+
+    # Sanitizes again the rows of the affected patients in the given
+    # hospitals and updates their contribution to the tomography regression
+    def resanitize(self, hospitals, reimputed, affected_patients):
+        imputed = {hospitalID: self.read_partition("imputed", hospitalID) for hospitalID in hospitals}
+        affected_rows = {
+            hospitalID: data["patientID"].isin(list(affected_patients)).to_numpy()
+            for hospitalID, data in imputed.items()
+        }
+        patient_rows = pd.concat(
+            [imputed[hospitalID].loc[affected_rows[hospitalID]] for hospitalID in hospitals],
+            keys=list(hospitals),
+        )
+        if self.sanitize() and len(patient_rows) > 0:
+            patient_rows[["cholesterol", "tomography"]] = majority_values(
+                patient_rows, ["cholesterol", "tomography"]
+            ).to_numpy()
+
+        for hospitalID in hospitals:
+            if hospitalID in reimputed:
+                sanitized = imputed[hospitalID].copy()
+            else:
+                sanitized = self.read_partition("sanitized", hospitalID)
+            if affected_rows[hospitalID].any():
+                sanitized.loc[affected_rows[hospitalID], ["cholesterol", "tomography"]] = (
+                    patient_rows.loc[hospitalID, ["cholesterol", "tomography"]].to_numpy()
+                )
+            self.write_partition("sanitized", hospitalID, sanitized)
+
+            regression = RegressionStatistics().update(
+                sanitized["cholesterol"], sanitized["tomography"]
+            )
+            self.statistics["hospitals"][str(hospitalID)]["regression"] = [
+                regression.count,
+                float(regression.sum_x),
+                float(regression.sum_y),
+                float(regression.sum_xx),
+                float(regression.sum_xy),
+            ]
+
+    def save_statistics(self):
+        with open(os.path.join(self.directory, "statistics.json"), "w") as statistics_file:
+            json.dump(self.statistics, statistics_file)
+
+    # Returns the imputed rows of the given hospitals (all by default), in
+    # order of hospitalID, predicting the unknown tomography with the
+    # regression over all hospitals.
+    def load(self, hospitalIDs=None):
+        hospitals = self.hospitals() if hospitalIDs is None else sorted(hospitalIDs)
+        if not hospitals:
+            return pd.DataFrame(columns=COLUMNS)
+        data = pd.concat(
+            [self.read_partition("sanitized", hospitalID) for hospitalID in hospitals],
+            ignore_index=True,
+        )
+
+        regression = self.regression()
+        if self.sanitize() and regression.count > 0:
+            to_predict = data["tomography"].isnull() & data["cholesterol"].notnull()
+            data.loc[to_predict, "tomography"] = regression.predict(
+                data.loc[to_predict, "cholesterol"]
+            )
+        return data
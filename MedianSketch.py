@@ -0,0 +1,145 @@
+# Per-group medians that can be computed one chunk of data at a time.
+# Each class gathers a summary of the values of every group with update,
+# combines summaries gathered separately (by other chunks or workers) with
+# merge, and returns the median of every group with medians.
+import numpy as np
+import pandas as pd
+
+
+# Exact per-group medians from a histogram of the values of every group,
+# i.e., the number of rows per (group, value). Its size depends on the
+# number of distinct values, which is small for a bounded domain like ages,
+# not on the number of rows, and no global sort is needed.
+class HistogramMedian:
+    def __init__(self):
+        self.counts = pd.Series(
+            dtype=np.int64,
+            index=pd.MultiIndex.from_arrays([[], []], names=["group", "value"]),
+        )
+
+    # Adds the known values, grouped by the group of the same position.
+    # Returns self.
+    def update(self, groups, values):
+        chunk = pd.DataFrame({"group": np.asarray(groups), "value": np.asarray(values)})
+        counts = chunk.groupby(["group", "value"]).size()
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+        return self
+
+    # Adds the histograms of another HistogramMedian. Returns self.
+    def merge(self, other):
+        self.counts = self.counts.add(other.counts, fill_value=0).astype(np.int64)
+        return self
+
+    # Returns a Series with the median of every group with a known value
+    def medians(self):
+        counts = self.counts[self.counts > 0].sort_index()
+        if len(counts) == 0:
+            return pd.Series(dtype=float)
+        groups = counts.index.get_level_values(0).to_numpy()
+        values = counts.index.get_level_values(1).to_numpy()
+        cumulative = np.cumsum(counts.to_numpy())
+
+        # First and last position of every group in the sorted histogram
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(groups)] - 1
+        before = np.r_[0, cumulative[ends[:-1]]]
+        total = cumulative[ends] - before
+
+        # Positions of the lower and upper middle value of every group
+        lower = np.searchsorted(cumulative, before + (total - 1) // 2, side="right")
+        upper = np.searchsorted(cumulative, before + total // 2, side="right")
+        return pd.Series((values[lower] + values[upper]) / 2, index=groups[starts])
+
+
+# Approximate per-group medians from a t-digest of the values of every
+# group: the sorted values are summarized by centroids (mean and weight),
+# small near the tails and at most compression / 2 + 1 per group.
+# Larger compression values give smaller errors; groups with at most
+# compression / 4 values keep one centroid per value and get their
+# exact median. The centroids of all the groups are stored together
+# and compressed at once.
+class TDigestMedian:
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.groups = None
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    # Adds the known values, grouped by the group of the same position.
+    # Returns self.
+    def update(self, groups, values):
+        groups = np.asarray(groups)
+        values = np.asarray(values, dtype=float)
+        known = ~np.isnan(values) & pd.notna(groups)
+        if self.groups is None:
+            self.groups = groups[:0]
+        self.compress(
+            np.concatenate([self.groups, groups[known]]),
+            np.concatenate([self.means, values[known]]),
+            np.concatenate([self.weights, np.ones(np.count_nonzero(known))]),
+        )
+        return self
+
+    # Adds the centroids of another TDigestMedian. Returns self.
+    def merge(self, other):
+        if other.groups is None:
+            return self
+        if self.groups is None:
+            self.groups = other.groups[:0]
+        self.compress(
+            np.concatenate([self.groups, other.groups]),
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+        )
+        return self
+
+    # Replaces the centroids by the given ones, merging neighbouring
+    # centroids of a group whose quantiles are less than one unit apart
+    # on the k1 scale k(q) = compression / (2 pi) * asin(2q - 1).
+    def compress(self, groups, means, weights):
+        if len(groups) == 0:
+            self.groups, self.means, self.weights = groups, means, weights
+            return
+
+        group_codes, group_uniques = pd.factorize(groups, sort=True)
+        order = np.lexsort((means, group_codes))
+        group_codes = group_codes[order]
+        means = means[order]
+        weights = weights[order]
+
+        # Quantile of the middle of every centroid within its group
+        cumulative = np.cumsum(weights)
+        starts = np.flatnonzero(np.r_[True, group_codes[1:] != group_codes[:-1]])
+        before = np.repeat(
+            cumulative[starts] - weights[starts], np.diff(np.r_[starts, len(weights)])
+        )
+        total = np.bincount(group_codes, weights=weights)[group_codes]
+        quantile = (cumulative - weights / 2 - before) / total
+
+        # Index of the unit of the k1 scale each centroid falls in
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * quantile - 1)
+        cluster = np.floor(k + self.compression / 4).astype(np.int64)
+        clusters_per_group = self.compression // 2 + 2
+        keys = group_codes * clusters_per_group + cluster
+
+        # keys are sorted, so each merged centroid is a run of equal keys
+        run_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        merged_weights = np.add.reduceat(weights, run_starts)
+        self.means = np.add.reduceat(weights * means, run_starts) / merged_weights
+        self.weights = merged_weights
+        self.groups = group_uniques[group_codes[run_starts]]
+
+    # Returns a Series with the (approximate) median of every group with
+    # a known value, interpolated between the centroids around it.
+    def medians(self):
+        medians = {}
+        if self.groups is None or len(self.groups) == 0:
+            return pd.Series(medians, dtype=float)
+        starts = np.flatnonzero(np.r_[True, self.groups[1:] != self.groups[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(self.groups)]):
+            weights = self.weights[start:end]
+            centers = np.cumsum(weights) - weights / 2
+            medians[self.groups[start]] = np.interp(
+                weights.sum() / 2, centers, self.means[start:end]
+            )
+        return pd.Series(medians, dtype=float)
@@ -0,0 +1,221 @@
+# Multiple imputation of patient data: instead of the single deterministic
+# fill of Impute, m imputed datasets are drawn at random. Every unknown cell
+# gets m values drawn at once as one (m x cells) array, and only those
+# values are kept, never m copies of the frame. Estimates computed on each
+# dataset are pooled with Rubin's rules.
+import numpy as np
+import pandas as pd
+from ImputationKernels import float_values
+from PatientImputation import RegressionStatistics
+
+COLUMNS = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+
+# Given the keys of known values (-1 to skip one), the known values, the keys
+# asked for (any shape, -1 for none) and one uniform number in [0, 1) per
+# key asked for, returns for every key asked for one of the known values
+# with the same key, chosen by its uniform number; np.nan for keys without
+# a known value.
+def draw_from_groups(known_keys, known_values, keys, uniform):
+    usable = np.asarray(known_keys) >= 0
+    group_keys, known_codes = np.unique(np.asarray(known_keys)[usable], return_inverse=True)
+    drawn = np.full(np.shape(keys), np.nan)
+    if len(group_keys) == 0:
+        return drawn
+
+    # Known values sorted by group; group c is values[starts[c]:starts[c] + counts[c]]
+    values = np.asarray(known_values, dtype=float)[usable]
+    values = values[np.argsort(known_codes, kind="stable")]
+    counts = np.bincount(known_codes, minlength=len(group_keys))
+    starts = np.cumsum(counts) - counts
+
+    codes = np.searchsorted(group_keys, keys).clip(max=len(group_keys) - 1)
+    found = (keys >= 0) & (group_keys[codes] == keys)
+    codes = codes[found]
+    drawn[found] = values[starts[codes] + (uniform[found] * counts[codes]).astype(np.intp)]
+    return drawn
+
+
+# Returns integer keys for the values of arrays of any shape, equal for
+# equal values and -1 for np.nan. The same values get the same key in
+# every array given in the same call.
+def value_keys(*arrays):
+    codes, _ = pd.factorize(np.concatenate([np.ravel(array) for array in arrays]))
+    keys = []
+    for array in arrays:
+        keys.append(codes[: np.size(array)].reshape(np.shape(array)))
+        codes = codes[np.size(array) :]
+    return keys
+
+
+# Returns the keys of (group, value) pairs given the keys of the groups and
+# of the values, both -1 when unknown, and the number of value keys
+def pair_keys(groups, value_codes, values):
+    return np.where((groups >= 0) & (value_codes >= 0), groups * values + value_codes, -1)
+
+
+# Pools the estimates of a quantity computed on each of the m imputed
+# datasets, with the variances of those estimates, using Rubin's rules.
+# Returns a dict with the pooled estimate, the within-imputation,
+# between-imputation and total variances and the degrees of freedom.
+def rubin_pool(estimates, variances):
+    estimates = np.asarray(estimates, dtype=float)
+    variances = np.asarray(variances, dtype=float)
+    m = len(estimates)
+    within = variances.mean()
+    between = estimates.var(ddof=1) if m > 1 else 0.0
+    total = within + (1 + 1 / m) * between
+    if between > 0:
+        degrees_of_freedom = (m - 1) * (1 + within / ((1 + 1 / m) * between)) ** 2
+    else:
+        degrees_of_freedom = np.inf
+    return {
+        "estimate": estimates.mean(),
+        "within": within,
+        "between": between,
+        "total": total,
+        "df": degrees_of_freedom,
+    }
+
+
+# Draws m imputed datasets of a DataFrame with the five attributes expected
+# by Impute, following the strategies of Impute with random draws instead
+# of a single statistic:
+# - an unknown age is drawn from the known ages of the same hospital;
+# - an unknown cholesterol level is drawn from the known levels of the same
+#   hospital and age (the drawn age when it was unknown), or else from the
+#   known levels of the same five-year age bracket across all hospitals;
+# - an unknown tomography is predicted from the cholesterol level (the
+#   drawn one when it was unknown) with the least-squares line fitted on the
+#   rows where both are known, plus a residual of that fit drawn at random.
+# Cells with nothing to draw from stay unknown. Duplicate patients are not
+# sanitized. input_data is never modified.
+class MultipleImpute:
+    # The draws of every column come from their own random stream of seed,
+    # so the same seed always gives the same m datasets.
+    def __init__(self, input_data, m=5, seed=0):
+        self.input_data = input_data
+        self.m = m
+        self.seed = seed
+        # Per column, the increasing positions of its unknown cells and the
+        # (m x cells) array of their drawn values
+        self.imputed = {}
+
+    # Draws the m values of every unknown cell. Returns self.
+    def impute(self):
+        age_stream, cholesterol_stream, tomography_stream = [
+            np.random.default_rng(child)
+            for child in np.random.SeedSequence(self.seed).spawn(3)
+        ]
+        hospital_keys, _ = pd.factorize(self.input_data["hospitalID"])
+        ages = float_values(self.input_data["age"])
+        cholesterol = float_values(self.input_data["cholesterol"])
+        tomography = float_values(self.input_data["tomography"])
+
+        # Age: drawn from the known ages of the hospital
+        age_positions = np.flatnonzero(np.isnan(ages))
+        known = ~np.isnan(ages) & (hospital_keys >= 0)
+        age_draws = draw_from_groups(
+            hospital_keys[known],
+            ages[known],
+            np.broadcast_to(hospital_keys[age_positions], (self.m, len(age_positions))),
+            age_stream.random((self.m, len(age_positions))),
+        )
+        self.imputed["age"] = (age_positions, self.narrow(age_draws, "age"))
+
+        # Cholesterol: drawn from the known levels of the (hospital, age)
+        # group, else from those of the age bracket
+        cholesterol_positions = np.flatnonzero(np.isnan(cholesterol))
+        row_ages = self.draws_at("age", ages, cholesterol_positions)
+        uniform = cholesterol_stream.random(row_ages.shape)
+        known = ~np.isnan(cholesterol)
+
+        known_age_keys, row_age_keys = value_keys(ages[known], row_ages)
+        values = max(known_age_keys.max(initial=-1), row_age_keys.max(initial=-1)) + 1
+        cholesterol_draws = draw_from_groups(
+            pair_keys(hospital_keys[known], known_age_keys, values),
+            cholesterol[known],
+            pair_keys(hospital_keys[cholesterol_positions], row_age_keys, values),
+            uniform,
+        )
+        unfilled = np.isnan(cholesterol_draws)
+        known_brackets, row_brackets = value_keys(
+            np.floor(ages[known] / 5), np.floor(row_ages[unfilled] / 5)
+        )
+        cholesterol_draws[unfilled] = draw_from_groups(
+            known_brackets,
+            cholesterol[known],
+            row_brackets,
+            uniform[unfilled],
+        )
+        self.imputed["cholesterol"] = (
+            cholesterol_positions,
+            self.narrow(cholesterol_draws, "cholesterol"),
+        )
+
+        # Tomography: least-squares prediction plus a drawn residual
+        tomography_positions = np.flatnonzero(np.isnan(tomography))
+        model = RegressionStatistics().update(cholesterol, tomography)
+        training = ~(np.isnan(cholesterol) | np.isnan(tomography))
+        residuals = tomography[training] - model.predict(cholesterol[training])
+        row_cholesterol = self.draws_at("cholesterol", cholesterol, tomography_positions)
+        tomography_draws = np.full(row_cholesterol.shape, np.nan)
+        if model.count > 0:
+            picked = (
+                tomography_stream.random(row_cholesterol.shape) * len(residuals)
+            ).astype(np.intp)
+            tomography_draws = model.predict(row_cholesterol) + residuals[picked]
+        self.imputed["tomography"] = (
+            tomography_positions,
+            self.narrow(tomography_draws, "tomography"),
+        )
+        return self
+
+    # Returns the drawn values in the dtype of a float column (such as
+    # float32 for a compact frame), or as float64
+    def narrow(self, draws, column):
+        dtype = self.input_data[column].dtype
+        if isinstance(dtype, np.dtype) and dtype.kind == "f":
+            return draws.astype(dtype, copy=False)
+        return draws
+
+    # Returns the (m x positions) values of a column at the given
+    # increasing positions in every dataset: the known values, or the
+    # drawn ones for the cells that were unknown
+    def draws_at(self, column, values, positions):
+        imputed_positions, draws = self.imputed[column]
+        at = np.broadcast_to(values[positions], (self.m, len(positions))).copy()
+        unknown = np.isnan(values[positions])
+        at[:, unknown] = draws[:, np.searchsorted(imputed_positions, positions[unknown])]
+        return at
+
+    # Returns a copy of input_data where the unknown cells are filled with
+    # the values of the given draw, between 0 and m - 1
+    def dataset(self, draw):
+        imputed_data = self.input_data.copy()
+        for column, (positions, draws) in self.imputed.items():
+            filled = ~np.isnan(draws[draw])
+            imputed_data.iloc[
+                positions[filled], imputed_data.columns.get_loc(column)
+            ] = draws[draw][filled]
+        return imputed_data
+
+    # Returns the mean of a column pooled over the m datasets with Rubin's
+    # rules, see rubin_pool. Unknown cells left after imputation are skipped.
+    # Computed from the known values and the draws, without any dataset.
+    # Raises ValueError if a dataset has fewer than two values of the column,
+    # whose sample variance is then undefined.
+    def pooled_mean(self, column):
+        values = float_values(self.input_data[column])
+        known = values[~np.isnan(values)]
+        draws = self.imputed[column][1].astype(float)
+        filled = ~np.isnan(draws)
+
+        count = len(known) + filled.sum(axis=1)
+        if (count < 2).any():
+            raise ValueError(f"Pooling the mean of {column} needs two values in every dataset")
+        total = known.sum() + np.nansum(draws, axis=1)
+        squares = np.sum(known * known) + np.nansum(draws * draws, axis=1)
+        means = total / count
+        sample_variances = (squares - total * means) / (count - 1)
+        return rubin_pool(means, sample_variances / count)
@@ -0,0 +1,126 @@
+# Parallel execution of the per-hospital imputation strategies of Impute.
+# The rows of every hospital are independent for impute_age and
+# impute_cholesterol_single_hospital, so the hospitals are split among a
+# pool of processes. The columns are copied once into shared memory, which
+# the workers map instead of receiving a pickled copy of the frame, and
+# each worker only sends back the cells it imputed.
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import numpy as np
+import pandas as pd
+from ImputationKernels import column_values
+from PatientImputation import Impute
+
+COLUMNS = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+# Columns mapped from shared memory by a worker process, by name
+shared_columns = {}
+
+
+# Initializer of the worker processes: maps the shared columns described
+# by specs (name -> (shared memory name, dtype, length))
+def attach_columns(specs):
+    for column, (name, dtype, length) in specs.items():
+        memory = shared_memory.SharedMemory(name=name)
+        shared_columns[column] = (memory, np.ndarray(length, dtype=dtype, buffer=memory.buf))
+
+
+# Runs the Impute method on the rows of each (hospitalID, start, end) of
+# hospitals, whose positions are order[start:end]. Returns, for every
+# hospital, the positions of the rows whose column was imputed and their
+# new values.
+def impute_hospitals(method, column, hospitals):
+    order = shared_columns["order"][1]
+    results = []
+    for hospitalID, start, end in hospitals:
+        positions = order[start:end]
+        hospital_data = pd.DataFrame(
+            {name: shared_columns[name][1][positions] for name in COLUMNS}
+        )
+        unknown = hospital_data[column].isnull().to_numpy()
+        getattr(Impute(hospital_data), method)(hospitalID)
+        imputed = unknown & hospital_data[column].notnull().to_numpy()
+        results.append((positions[imputed], hospital_data[column].to_numpy()[imputed]))
+    return results
+
+
+# Runs the per-hospital strategies of an Impute over many hospitals at once
+# in a pool of workers processes (os.cpu_count() by default). Results are
+# written into patient_imputer.input_data and returned in the same order as
+# calling the Impute method once per hospital, whatever the number of
+# workers.
+class ParallelImpute:
+    def __init__(self, patient_imputer, workers=None):
+        self.patient_imputer = patient_imputer
+        self.workers = os.cpu_count() if workers is None else workers
+
+    # Like calling impute_age for every hospital in hospitalIDs (all the
+    # hospitals in order of appearance by default) and concatenating the
+    # returned DataFrames
+    def impute_age(self, hospitalIDs=None):
+        return self.run("impute_age", "age", hospitalIDs)
+
+    # Like calling impute_cholesterol_single_hospital for every hospital in
+    # hospitalIDs and concatenating the returned DataFrames
+    def impute_cholesterol_single_hospital(self, hospitalIDs=None):
+        return self.run("impute_cholesterol_single_hospital", "cholesterol", hospitalIDs)
+
+    def run(self, method, column, hospitalIDs):
+        input_data = self.patient_imputer.input_data
+        codes, uniques = pd.factorize(input_data["hospitalID"])
+        if hospitalIDs is None:
+            hospitalIDs = list(uniques)
+
+        # Row positions sorted by hospital; the rows of hospital code c are
+        # order[starts[c]:starts[c + 1]], in the order of input_data
+        known = codes >= 0
+        order = np.flatnonzero(known)[np.argsort(codes[known], kind="stable")]
+        starts = np.r_[0, np.cumsum(np.bincount(codes[known], minlength=len(uniques)))]
+        hospital_codes = uniques.get_indexer(hospitalIDs)
+        hospitals = [
+            (hospitalID, int(starts[code]), int(starts[code + 1]))
+            for hospitalID, code in zip(hospitalIDs, hospital_codes)
+            if code >= 0
+        ]
+
+        arrays = {name: column_values(input_data[name]) for name in COLUMNS}
+        arrays["order"] = order
+        memories = []
+        try:
+            specs = {}
+            for name, values in arrays.items():
+                memory = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                memories.append(memory)
+                np.ndarray(len(values), dtype=values.dtype, buffer=memory.buf)[:] = values
+                specs[name] = (memory.name, values.dtype.str, len(values))
+
+            # A few batches of consecutive hospitals per worker balance the
+            # load without one task per hospital
+            batches = [
+                batch
+                for batch in np.array_split(
+                    np.arange(len(hospitals)), max(min(len(hospitals), self.workers * 4), 1)
+                )
+                if len(batch) > 0
+            ]
+            with ProcessPoolExecutor(
+                self.workers, initializer=attach_columns, initargs=(specs,)
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        impute_hospitals, method, column, [hospitals[index] for index in batch]
+                    )
+                    for batch in batches
+                ]
+                results = [result for future in futures for result in future.result()]
+        finally:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+
+        # Write the imputed cells in the order of the hospitals
+        changes = self.patient_imputer.changes()
+        for positions, values in results:
+            changes.fill_positions(positions, column, values)
+        return changes.changed_rows(["patientID", "age", "cholesterol", "tomography"])
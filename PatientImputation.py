@@ -1,7 +1,342 @@
 # Collection of methods to impute missing hospital data provided by file
-from sklearn.linear_model import LinearRegression
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+from Instrumentation import NULL_STAGE
+from ImputationKernels import (
+    group_codes,
+    group_sums,
+    group_majority,
+    group_mean,
+    group_median,
+    group_min,
+    per_row,
+)
+
+
+# Given a DataFrame, returns a DataFrame with the given columns where,
+# for every group of rows sharing the same key (patientID by default),
+# each column is replaced by its majority value within the group.
+# A column is left unchanged for a group when the most frequent known
+# value is tied, when no value is known, or when the group has a single row.
+# Unknown values of a group with a majority are replaced as well.
+# Only the rows of groups with several rows are counted, with the kernels
+# of ImputationKernels, instead of calling Series.mode() once per group.
+def majority_values(input_data, columns, key="patientID"):
+    # Integer code of the group of every row; rows with an unknown key
+    # or in a group of a single row get -1
+    key_codes, groups = group_codes(input_data[key])
+    group_size = np.bincount(key_codes[key_codes >= 0], minlength=groups)
+    key_codes = np.where((key_codes >= 0) & (group_size[key_codes] > 1), key_codes, -1)
+    duplicated = np.flatnonzero(key_codes >= 0)
+
+    sanitized = input_data[columns].copy()
+    for column in columns:
+        # Majority value of the group of every duplicated row
+        majority = per_row(
+            group_majority(key_codes[duplicated], input_data[column].iloc[duplicated], groups),
+            key_codes[duplicated],
+        )
+
+        replaced = duplicated[~np.isnan(majority)]
+        sanitized.iloc[replaced, sanitized.columns.get_loc(column)] = majority[
+            ~np.isnan(majority)
+        ]
+
+    return sanitized
+
+
+# Running sufficient statistics (n, sum x, sum y, sum x^2, sum x*y) of the
+# one-variable least-squares line y = intercept + slope * x, the same
+# maths query4.sql uses. Statistics gathered over separate chunks of data
+# can be merged, so a line can be fitted one chunk at a time.
+class RegressionStatistics:
+    def __init__(self):
+        self.count = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+    # Adds every pair (x, y) where both x and y are known. Returns self.
+    def update(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        known = ~(np.isnan(x) | np.isnan(y))
+        self.count += int(np.count_nonzero(known))
+        self.sum_x += np.sum(x, where=known)
+        self.sum_y += np.sum(y, where=known)
+        self.sum_xx += np.sum(x * x, where=known)
+        self.sum_xy += np.sum(x * y, where=known)
+        return self
+
+    # Adds the statistics gathered by another RegressionStatistics. Returns self.
+    def merge(self, other):
+        self.count += other.count
+        self.sum_x += other.sum_x
+        self.sum_y += other.sum_y
+        self.sum_xx += other.sum_xx
+        self.sum_xy += other.sum_xy
+        return self
+
+    # Slope of the fitted line. Like an ordinary least-squares solver, it is
+    # zero when all the known x are equal (up to rounding).
+    def slope(self):
+        if self.count == 0:
+            return np.nan
+        variance_x = self.sum_xx - self.sum_x * self.sum_x / self.count
+        if variance_x <= np.finfo(float).eps * self.sum_xx:
+            return 0.0
+        return (self.sum_xy - self.sum_x * self.sum_y / self.count) / variance_x
+
+    # Intercept of the fitted line
+    def intercept(self):
+        if self.count == 0:
+            return np.nan
+        return (self.sum_y - self.slope() * self.sum_x) / self.count
+
+    # Returns the fitted y for every given x
+    def predict(self, x):
+        return self.intercept() + self.slope() * np.asarray(x, dtype=float)
+
+
+# RegressionStatistics of many groups at once, such as hospitals: arrays
+# with the sums of every group, gathered in one pass over the rows, from
+# which the lines of all the groups are fitted with batched arithmetic.
+class GroupRegressionStatistics:
+    def __init__(self, groups):
+        self.count = np.zeros(groups, dtype=np.int64)
+        self.sum_x = np.zeros(groups)
+        self.sum_y = np.zeros(groups)
+        self.sum_xx = np.zeros(groups)
+        self.sum_xy = np.zeros(groups)
+
+    # Adds every pair (x, y) where both x and y are known to the group of
+    # the same position (an integer code, -1 for none). Returns self.
+    def update(self, codes, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        codes = np.where(np.isnan(x) | np.isnan(y), -1, codes)
+        groups = len(self.count)
+        count, sum_x = group_sums(codes, x, groups)
+        self.count += count
+        self.sum_x += sum_x
+        self.sum_y += group_sums(codes, y, groups)[1]
+        self.sum_xx += group_sums(codes, x * x, groups)[1]
+        self.sum_xy += group_sums(codes, x * y, groups)[1]
+        return self
+
+    # Variance of x of every group, times its count
+    def variance_x(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum_xx - self.sum_x * self.sum_x / self.count
+
+    # Whether the line of every group can be fitted from its own pairs: it
+    # has at least min_points of them and its x are not all equal (up to
+    # rounding), the case where RegressionStatistics gives a zero slope
+    def fitted(self, min_points=3):
+        return (self.count >= max(min_points, 2)) & (
+            self.variance_x() > np.finfo(float).eps * self.sum_xx
+        )
+
+    # Slope of the line of every group, np.nan where it is not fitted
+    def slope(self, min_points=3):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slope = (self.sum_xy - self.sum_x * self.sum_y / self.count) / self.variance_x()
+        return np.where(self.fitted(min_points), slope, np.nan)
+
+    # Intercept of the line of every group, np.nan where it is not fitted
+    def intercept(self, min_points=3):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.sum_y - self.slope(min_points) * self.sum_x) / self.count
+
+
+# Writes imputed values into a DataFrame and records the positions of the
+# rows that changed, so that an imputation method can return its changed
+# rows without keeping a copy of the frame from before its writes.
+# An optional on_write(positions, column) is called after every write, and
+# an optional before_write(positions, column) before it.
+class ChangeTracker:
+    def __init__(self, input_data, on_write=None, before_write=None):
+        self.input_data = input_data
+        self.on_write = on_write
+        self.before_write = before_write
+        self.positions = []
+
+    # Writes values (a scalar or one value per selected row) into column
+    # at the rows where mask is True, and records those rows as changed.
+    def fill(self, mask, column, values):
+        self.fill_positions(np.flatnonzero(np.asarray(mask)), column, values)
+
+    # Writes values (a scalar or one value per position) into column at the
+    # rows of the given increasing positions, and records them as changed.
+    def fill_positions(self, positions, column, values):
+        if isinstance(values, pd.Series):
+            values = values.to_numpy()
+        # Statistics computed in float64 are rounded to narrower float
+        # columns (such as float32 ones from a PatientStore), which pandas
+        # refuses to do implicitly
+        column_dtype = self.input_data[column].dtype
+        if isinstance(column_dtype, np.dtype) and column_dtype.kind == "f":
+            values = np.asarray(values, dtype=column_dtype)
+        if len(positions) > 0:
+            if self.before_write is not None:
+                self.before_write(positions, column)
+            self.input_data.iloc[
+                positions, self.input_data.columns.get_loc(column)
+            ] = values
+            if self.on_write is not None:
+                self.on_write(positions, column)
+        self.positions.append(positions)
+
+    # Writes the columns of new_values over the columns of the same name.
+    # Only the rows where a known value was changed are recorded;
+    # unknown values that become known are written but not recorded.
+    def replace(self, new_values):
+        changed = np.zeros(len(self.input_data), dtype=bool)
+        for column in new_values.columns:
+            old = self.input_data[column].to_numpy()
+            new = new_values[column].to_numpy()
+            known = pd.notna(old)
+            differs = (old != new) & (known | pd.notna(new))
+            changed |= differs & known
+
+            positions = np.flatnonzero(differs)
+            if len(positions) > 0:
+                if self.before_write is not None:
+                    self.before_write(positions, column)
+                self.input_data.iloc[
+                    positions, self.input_data.columns.get_loc(column)
+                ] = new[positions]
+                if self.on_write is not None:
+                    self.on_write(positions, column)
+        self.positions.append(np.flatnonzero(changed))
+
+    # Returns the given columns of the recorded rows,
+    # in the order they were first recorded. Taking the rows of every
+    # column costs half as much as selecting them from the frame.
+    def changed_rows(self, columns):
+        if self.positions:
+            positions = pd.unique(np.concatenate(self.positions))
+        else:
+            positions = np.array([], dtype=np.intp)
+        return pd.DataFrame(
+            {column: self.input_data[column].array.take(positions) for column in columns}
+        )
+
+
+# Statistics of groups of rows, such as the median age of a hospital, kept
+# by (strategy, group key) until invalidated. Only the max_groups most
+# recently used are kept. With check, every statistic found in the cache is
+# computed again and AssertionError is raised if they differ.
+class StatisticsCache:
+    def __init__(self, max_groups=1024, check=False):
+        self.max_groups = max_groups
+        self.check = check
+        self.statistics = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the statistic of a strategy for a group, calling compute()
+    # only if it is not in the cache
+    def get(self, strategy, group, compute):
+        key = (strategy, group)
+        if key not in self.statistics:
+            self.misses += 1
+            self.statistics[key] = compute()
+            if len(self.statistics) > self.max_groups:
+                self.statistics.popitem(last=False)
+            return self.statistics[key]
+
+        self.hits += 1
+        self.statistics.move_to_end(key)
+        statistic = self.statistics[key]
+        if self.check and not same_statistic(statistic, compute()):
+            raise AssertionError(f"Cached {strategy} of group {group} is out of date")
+        return statistic
+
+    # Forgets the statistics of a strategy for the given groups
+    def invalidate(self, strategy, groups):
+        for group in groups:
+            self.statistics.pop((strategy, group), None)
+
+    def clear(self):
+        self.statistics.clear()
+
+
+# Returns whether two statistics (numbers or Series) are equal, taking
+# np.nan as equal to np.nan
+def same_statistic(statistic, other):
+    if isinstance(statistic, pd.Series):
+        return isinstance(other, pd.Series) and statistic.equals(other)
+    return statistic == other or (pd.isna(statistic) and pd.isna(other))
+
+
+# Compact dtypes of the five attributes expected by Impute, with np.nan
+# for unknown measurements, and their variants with pandas' nullable
+# dtypes, which also allow unknown IDs and use pd.NA. The compact dtypes
+# take less than half the memory of int64 IDs and float64 measurements;
+# the nullable ones add a byte per value for the mask of unknown values.
+COMPACT_DTYPES = {
+    "patientID": "int32",
+    "hospitalID": "int16",
+    "age": "float32",
+    "cholesterol": "float32",
+    "tomography": "float32",
+}
+NULLABLE_DTYPES = {
+    "patientID": "Int32",
+    "hospitalID": "Int16",
+    "age": "Float32",
+    "cholesterol": "Float32",
+    "tomography": "Float32",
+}
+
+
+# Returns a copy of input_data with the five attributes expected by Impute
+# converted to the compact (or nullable) dtypes; other columns are kept
+# as they are. Raises ValueError if an attribute is missing, is not
+# numeric, or has IDs that are unknown (unless nullable), not whole
+# numbers, or out of range for their dtype.
+def compact_frame(input_data, nullable=False):
+    dtypes = NULLABLE_DTYPES if nullable else COMPACT_DTYPES
+    missing = [column for column in dtypes if column not in input_data.columns]
+    if missing:
+        raise ValueError(f"Missing attributes: {', '.join(missing)}")
+
+    for column in dtypes:
+        if not pd.api.types.is_numeric_dtype(input_data[column]):
+            raise ValueError(f"{column} is not numeric")
+
+    for column in ["patientID", "hospitalID"]:
+        ids = input_data[column].to_numpy(dtype=float, na_value=np.nan)
+        known = ~np.isnan(ids)
+        if not nullable and not known.all():
+            raise ValueError(f"{column} has unknown values")
+        limits = np.iinfo(dtypes[column].lower())
+        ids = ids[known]
+        if np.any(ids != np.round(ids)) or np.any((ids < limits.min) | (ids > limits.max)):
+            raise ValueError(f"{column} does not fit in {dtypes[column]}")
+
+    return input_data.astype(dtypes)
+
+
+# Returns the number of bytes used by a DataFrame, including its index
+def memory_footprint(input_data):
+    return int(input_data.memory_usage(index=True, deep=True).sum())
+
+
+# Backends that can keep and impute the data of an Impute
+BACKENDS = ["pandas", "polars"]
+
+# Statistics the cache of an Impute keeps, with the columns they are
+# computed from: per hospital, except min_cholesterol, which is kept per
+# five-year age bracket
+CACHED_STATISTICS = {
+    "median_age": ["age"],
+    "average_cholesterol": ["age", "cholesterol"],
+    "min_cholesterol": ["age", "cholesterol"],
+}
 
 
 # Class that imputes estimated values for cells of a pandas DataFrame
@@ -10,8 +345,122 @@ class Impute:
     # Constructs a new Impute class with a given DataFrame called input_data
     # The DataFrame should have five attributes:
     # patientID, hospitalID, age, cholesterol, tomography
-    def __init__(self, input_data):
+    # With compact=True they are validated and converted once to
+    # COMPACT_DTYPES (or NULLABLE_DTYPES with nullable=True), see compact_frame.
+    # With an Instrumentation, every stage of every method is measured and
+    # recorded, see Instrumentation.py.
+    # With backend="polars", the data is kept and imputed by Polars instead
+    # of pandas, see PolarsImputation.py; the pandas backend is the reference.
+    # With cache_size, the per-hospital statistics of impute_age and
+    # impute_cholesterol_single_hospital and the per-bracket minimums of
+    # impute_cholesterol are kept for up to cache_size groups and
+    # strategies, and only those of the groups whose rows the methods (or
+    # set_values) write are computed again; check_cache
+    # verifies every statistic taken from the cache. Writes made directly
+    # to input_data bypass the cache: replace input_data to clear it.
+    def __new__(cls, input_data=None, *args, backend="pandas", **options):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown imputation backend {backend}")
+        if backend == "polars" and cls is Impute:
+            from PolarsImputation import PolarsImpute
+
+            return super().__new__(PolarsImpute)
+        return super().__new__(cls)
+
+    def __init__(
+        self,
+        input_data,
+        compact=False,
+        nullable=False,
+        instrumentation=None,
+        backend="pandas",
+        cache_size=0,
+        check_cache=False,
+    ):
+        if compact:
+            input_data = compact_frame(input_data, nullable)
+        self.cache = StatisticsCache(cache_size, check_cache) if cache_size > 0 else None
         self.input_data = input_data
+        self.instrumentation = instrumentation
+
+    # The imputation methods only write measurements, so the positions of
+    # the rows of every hospital stay valid until input_data is replaced
+    @property
+    def input_data(self):
+        return self._input_data
+
+    @input_data.setter
+    def input_data(self, input_data):
+        self._input_data = input_data
+        self._hospital_positions = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    # Returns a ChangeTracker over input_data that keeps the cache up to
+    # date. The groups of the rows are forgotten before and after every
+    # write, since writing an age moves its row to another age bracket.
+    def changes(self):
+        if self.cache is None:
+            return ChangeTracker(self.input_data)
+        return ChangeTracker(self.input_data, self.invalidate, self.invalidate)
+
+    # Forgets the cached statistics computed from column of the groups of
+    # the rows at the given positions
+    def invalidate(self, positions, column):
+        for strategy, columns in CACHED_STATISTICS.items():
+            if column in columns:
+                self.cache.invalidate(strategy, self.cache_groups(strategy, positions))
+
+    # Returns the groups of the rows at the given positions for a strategy
+    # of CACHED_STATISTICS: their age brackets for min_cholesterol, their
+    # hospitals otherwise
+    def cache_groups(self, strategy, positions):
+        if strategy == "min_cholesterol":
+            return pd.unique((self.input_data["age"].iloc[positions] // 5) * 5)
+        return pd.unique(self.input_data["hospitalID"].iloc[positions])
+
+    # Returns the statistic of a strategy of CACHED_STATISTICS for a
+    # group, from the cache if there is one, or else from compute()
+    def statistic(self, strategy, group, compute):
+        if self.cache is None:
+            return compute()
+        return self.cache.get(strategy, group, compute)
+
+    # Writes values (a scalar or one value per position) into a measurement
+    # column at the rows of the given increasing positions
+    def set_values(self, positions, column, values):
+        if column not in ["age", "cholesterol", "tomography"]:
+            raise ValueError(f"Only measurements can be set, not {column}")
+        self.changes().fill_positions(np.asarray(positions), column, values)
+
+    # Returns a context for a stage of method that scans rows_scanned rows,
+    # measured if there is an instrumentation. Set rows_changed on it.
+    def stage(self, method, name, rows_scanned=0):
+        if self.instrumentation is None:
+            return NULL_STAGE
+        return self.instrumentation.stage(method, name, rows_scanned)
+
+    # Returns the increasing positions of the rows of a hospital in
+    # input_data. The positions of all the hospitals are found in a single
+    # grouped pass the first time, so that per-hospital methods only touch
+    # the rows of their hospital instead of comparing every hospitalID.
+    def hospital_positions(self, hospitalID):
+        if self._hospital_positions is None:
+            self._hospital_positions = self.input_data.groupby(
+                "hospitalID", sort=False
+            ).indices
+        return self._hospital_positions.get(hospitalID, np.array([], dtype=np.intp))
+
+    # Returns the number of bytes used by input_data
+    def memory_footprint(self):
+        return memory_footprint(self.input_data)
+
+    # Constructs a new Impute class with the patients of the given hospitals
+    # (all by default) of a PatientStore, reading only their partitions.
+    # The memory-mapped columns are read-only, so they are copied once.
+    @classmethod
+    def from_store(cls, store, hospitalIDs=None):
+        return cls(store.read(hospitalIDs).copy())
 
     # Given a hospital id, imputes the age of all patients
     # at that hospital who currently have np.nan for age
@@ -19,12 +468,13 @@ class Impute:
     # Returns a DataFrame consisting of all patients whose age has changed.
     def impute_age(self, hospitalID):
         # Implement me!
+        changes = self.changes()
+        positions = self.hospital_positions(hospitalID)
+        hospital_ages = self.input_data["age"].iloc[positions]
+
         # Get the median age of patients with known age at the given hospitalID
-        median_age = self.input_data.loc[
-            (self.input_data["hospitalID"] == hospitalID)
-            & (~self.input_data["age"].isnull()),
-            "age",
-        ].median()
+        with self.stage("impute_age", "statistics", len(positions)):
+            median_age = self.statistic("median_age", hospitalID, hospital_ages.median)
 
         # Check if median age is NaN - if so, return an empty DataFrame
         if pd.isna(median_age):
@@ -32,27 +482,55 @@ class Impute:
                 columns=["patientID", "age", "cholesterol", "tomography"]
             )
 
-        # extracts the rows from input_data that match the boolean
-        # .copy() at the end. This creates a new DataFrame that's a copy of the extracted rows
-        changed_rows = self.input_data.loc[
-            (self.input_data["hospitalID"] == hospitalID)
-            & (self.input_data["age"].isnull())
-        ].copy()
-
         # Impute the missing ages
-        self.input_data.loc[
-            (self.input_data["hospitalID"] == hospitalID)
-            & (self.input_data["age"].isnull()),
-            "age",
-        ] = median_age
+        with self.stage("impute_age", "fill", len(positions)) as stage:
+            filled = positions[hospital_ages.isnull().to_numpy()]
+            changes.fill_positions(filled, "age", median_age)
+            stage.rows_changed = len(filled)
+
+        # Return the rows that had the age imputed.
+        with self.stage("impute_age", "changed_rows", len(filled)):
+            return changes.changed_rows(["patientID", "age", "cholesterol", "tomography"])
+
+    # Imputes the age of all patients at every hospital (or only at the
+    # hospitals in the optional list hospitalIDs) who currently have np.nan
+    # for age as the median of all patients at the same hospital whose age
+    # is known. Equivalent to calling impute_age once per hospital, but the
+    # medians are computed in a single grouped pass and written at once.
+    # Returns a DataFrame consisting of all patients whose age has changed,
+    # in the order they appear in input_data, including their hospitalID.
+    def impute_age_all_hospitals(self, hospitalIDs=None):
+        method = "impute_age_all_hospitals"
+        changes = self.changes()
+        rows = len(self.input_data)
+
+        with self.stage(method, "statistics", rows):
+            # Median age per hospital, which skips the unknown ages, looked
+            # up for every row; rows with an unknown hospital get NaN
+            hospital_codes, hospitals = group_codes(self.input_data["hospitalID"])
+            imputed_age = pd.Series(
+                per_row(
+                    group_median(hospital_codes, self.input_data["age"], hospitals),
+                    hospital_codes,
+                ),
+                index=self.input_data.index,
+            )
 
-        # Return the changed rows# Directly update the 'changed_rows' DataFrame with the imputed age values.
-        changed_rows["age"] = median_age
+        with self.stage(method, "fill", rows) as stage:
+            # Only rows with an unknown age whose hospital has a known median change
+            changed_mask = self.input_data["age"].isnull() & imputed_age.notnull()
+            if hospitalIDs is not None:
+                changed_mask &= self.input_data["hospitalID"].isin(hospitalIDs)
 
-        # Return the 'changed_rows' DataFrame to see which rows had the age imputed.
-        return changed_rows[
-            ["patientID", "age", "cholesterol", "tomography"]
-        ].reset_index(drop=True)
+            # Impute the missing ages with one vectorized write
+            changes.fill(changed_mask, "age", imputed_age[changed_mask])
+            stage.rows_changed = len(changes.positions[-1])
+
+        # Return the rows whose age has been imputed
+        with self.stage(method, "changed_rows", len(changes.positions[-1])):
+            return changes.changed_rows(
+                ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+            )
 
     # Given a hospital id, imputes the cholesterol level of all patients
     # at that hospital who currently have np.nan for cholesterol
@@ -60,37 +538,78 @@ class Impute:
     # Returns a DataFrame consisting of all patients whose cholesterol has changed.
     def impute_cholesterol_single_hospital(self, hospitalID):
         # Implement me!
+        method = "impute_cholesterol_single_hospital"
+        changes = self.changes()
+
         # 1.- Group patients by age within the specified hospital ID.
-        # Filter patients from the specified hospital.
-        hospital_patients = self.input_data[self.input_data["hospitalID"] == hospitalID]
-
-        # Calculate the average cholesterol for each age in the hospital.
-        average_cholesterol_per_age = hospital_patients.groupby("age")[
-            "cholesterol"
-        ].mean()
-
-        # Find patients with missing cholesterol values.
-        patients_with_nan_cholesterol = hospital_patients["cholesterol"].isnull()
-
-        # Loop through each patient in the specified hospital.
-        for idx, patient in hospital_patients[patients_with_nan_cholesterol].iterrows():
-            # Find the average cholesterol for the age of the current patient.
-            age = patient["age"]
-            if pd.notnull(age):  # Check if the age is not NaN
-                average_cholesterol = average_cholesterol_per_age.get(age, np.nan)
-                # Update the cholesterol value if the average cholesterol is not NaN.
-                if pd.notnull(average_cholesterol):
-                    self.input_data.loc[idx, "cholesterol"] = average_cholesterol
+        # Take only the rows of the specified hospital.
+        positions = self.hospital_positions(hospitalID)
+        hospital_ages = self.input_data["age"].iloc[positions]
+        hospital_cholesterol = self.input_data["cholesterol"].iloc[positions]
+
+        with self.stage(method, "statistics", len(positions)):
+            # Calculate the average cholesterol for each age in the hospital.
+            average_cholesterol_per_age = self.statistic(
+                "average_cholesterol",
+                hospitalID,
+                lambda: hospital_cholesterol.groupby(hospital_ages).mean(),
+            )
+
+            # Look up the average cholesterol for the age of every patient in the
+            # hospital; unknown ages and ages without a known value map to NaN.
+            imputed_cholesterol = hospital_ages.map(average_cholesterol_per_age)
+
+        with self.stage(method, "fill", len(positions)) as stage:
+            # Patients with missing cholesterol that have an average to impute.
+            changed_mask = (
+                hospital_cholesterol.isnull() & imputed_cholesterol.notnull()
+            ).to_numpy()
+
+            # Update all the missing cholesterol values with one write.
+            changes.fill_positions(
+                positions[changed_mask], "cholesterol", imputed_cholesterol[changed_mask]
+            )
+            stage.rows_changed = np.count_nonzero(changed_mask)
 
         # Return the changed rows.
-        changed_rows = self.input_data.loc[
-            (self.input_data["hospitalID"] == hospitalID)
-            & (self.input_data["cholesterol"].notnull())
-            & patients_with_nan_cholesterol
-        ]
-        return changed_rows[
-            ["patientID", "age", "cholesterol", "tomography"]
-        ].reset_index(drop=True)
+        with self.stage(method, "changed_rows", np.count_nonzero(changed_mask)):
+            return changes.changed_rows(["patientID", "age", "cholesterol", "tomography"])
+
+    # Imputes the cholesterol level of all patients at every hospital
+    # who currently have np.nan for cholesterol as the average of all patients
+    # at the same hospital with the same age, like query2.sql does in one UPDATE.
+    # Equivalent to calling impute_cholesterol_single_hospital once per hospital.
+    # Returns a DataFrame consisting of all patients whose cholesterol has changed,
+    # in the order they appear in input_data, including their hospitalID.
+    def impute_cholesterol_all_hospitals(self):
+        method = "impute_cholesterol_all_hospitals"
+        changes = self.changes()
+        rows = len(self.input_data)
+
+        # Average cholesterol of the (hospital, age) group of every patient;
+        # rows with an unknown age or hospital belong to no group and get NaN.
+        with self.stage(method, "statistics", rows):
+            codes, groups = group_codes(self.input_data["hospitalID"], self.input_data["age"])
+            imputed_cholesterol = pd.Series(
+                per_row(group_mean(codes, self.input_data["cholesterol"], groups), codes),
+                index=self.input_data.index,
+            )
+
+        with self.stage(method, "fill", rows) as stage:
+            # Patients with missing cholesterol that have an average to impute.
+            changed_mask = (
+                self.input_data["cholesterol"].isnull() & imputed_cholesterol.notnull()
+            )
+
+            # Update all the missing cholesterol values with one write.
+            changes.fill(changed_mask, "cholesterol", imputed_cholesterol[changed_mask])
+            stage.rows_changed = len(changes.positions[-1])
+
+        # Return the changed rows.
+        with self.stage(method, "changed_rows", len(changes.positions[-1])):
+            return changes.changed_rows(
+                ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+            )
 
     # Imputes the cholesterol level of all patients at all hospitals
     # who currently have np.nan for cholesterol using as the lowest
@@ -98,115 +617,140 @@ class Impute:
     # Returns a DataFrame consisting of all patients whose cholesterol has changed.
     def impute_cholesterol(self):
         # Implement me!
-        # Create a new column for the five-year age brackets
-        self.input_data["age_bracket"] = (self.input_data["age"] // 5) * 5
+        method = "impute_cholesterol"
+        changes = self.changes()
+        rows = len(self.input_data)
+
+        with self.stage(method, "statistics", rows):
+            # Five-year age bracket of every patient; kept as a temporary key
+            # so that input_data is never widened with an extra column.
+            age_bracket = (self.input_data["age"] // 5) * 5
+
+            # Find the minimum cholesterol for each age bracket across all
+            # hospitals and look it up for every patient. The minimums of
+            # all the brackets are computed together, only when one of them
+            # is not cached (or to check the cache).
+            bracket_codes, brackets = pd.factorize(age_bracket)
+            minimums = []
+
+            def bracket_minimum(index):
+                if not minimums:
+                    minimums.append(
+                        group_min(bracket_codes, self.input_data["cholesterol"], len(brackets))
+                    )
+                return minimums[0][index]
+
+            min_cholesterol = pd.Series(
+                per_row(
+                    np.array(
+                        [
+                            self.statistic(
+                                "min_cholesterol", bracket, lambda index=index: bracket_minimum(index)
+                            )
+                            for index, bracket in enumerate(brackets)
+                        ],
+                        dtype=float,
+                    ),
+                    bracket_codes,
+                ),
+                index=self.input_data.index,
+            )
 
-        # Find the minimum cholesterol for each age bracket across all hospitals
-        min_cholesterol_per_bracket = (
-            self.input_data.groupby("age_bracket")["cholesterol"].min().to_dict()
-        )
+        with self.stage(method, "fill", rows) as stage:
+            # Create a mask for rows with NaN cholesterol values
+            nan_cholesterol_mask = self.input_data["cholesterol"].isnull()
 
-        # Create a mask for rows with NaN cholesterol values
-        nan_cholesterol_mask = self.input_data["cholesterol"].isnull()
+            # The bracket minimum of every patient with missing cholesterol
+            imputed_cholesterol = min_cholesterol[nan_cholesterol_mask]
 
-        # Impute cholesterol for patients with missing values
-        self.input_data.loc[nan_cholesterol_mask, "cholesterol"] = self.input_data.loc[
-            nan_cholesterol_mask
-        ].apply(
-            lambda row: min_cholesterol_per_bracket.get(row["age_bracket"], np.nan),
-            axis=1,
-        )
+            # Only rows whose bracket has a known minimum change
+            changed_mask = nan_cholesterol_mask.copy()
+            changed_mask[nan_cholesterol_mask] = imputed_cholesterol.notnull().to_numpy()
 
-        # Find the rows that have been changed
-        changed_rows = self.input_data.loc[
-            nan_cholesterol_mask & self.input_data["cholesterol"].notnull()
-        ]
-
-        # Remove the age bracket column as it's no longer needed
-        changed_rows = changed_rows.drop("age_bracket", axis=1)
+            # Impute cholesterol for patients with missing values
+            changes.fill(
+                changed_mask,
+                "cholesterol",
+                imputed_cholesterol[imputed_cholesterol.notnull()],
+            )
+            stage.rows_changed = len(changes.positions[-1])
 
         # Return the rows with imputed cholesterol levels
-        return changed_rows[
-            ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
-        ].reset_index(drop=True)
+        with self.stage(method, "changed_rows", len(changes.positions[-1])):
+            return changes.changed_rows(
+                ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+            )
 
     # Imputes the time to tomography of all patients at all hospitals
     # who currently have np.nan for tomography by interpolating the values
     # with linear regression trained over the cholesterol level as the independent variable.
+    # With per_hospital, every hospital gets its own line, fitted from its
+    # own patients, when it has at least min_points of them with both values
+    # known and their cholesterol levels are not all equal; the patients of
+    # the other hospitals get the line fitted over all the hospitals.
     # Returns a DataFrame consisting of all patients whose tomography has changed.
-    def impute_tomography(self):
+    def impute_tomography(self, per_hospital=False, min_points=3):
         # Implement me!
         if self.input_data["cholesterol"].isnull().all():
             return pd.DataFrame()
 
-        # Store original data for comparison
+        method = "impute_tomography"
+        rows = len(self.input_data)
+
+        # Record the changed rows instead of storing the original data
+        changes = self.changes()
 
-        original_data = self.input_data.copy()
         # Begin sanitization
         cols_to_sanitize = ["cholesterol", "tomography"]
 
-        def get_majority_value(series):
-            mode_val = series.mode()
-            if len(mode_val) > 1 or len(series) == 1:
-                return series  # Return the series unchanged
-            else:
-                return mode_val.iloc[0]
-
-        majority_values = self.input_data.groupby("patientID")[
-            cols_to_sanitize
-        ].transform(get_majority_value)
-        self.input_data[cols_to_sanitize] = majority_values
+        with self.stage(method, "sanitization", rows) as stage:
+            changes.replace(majority_values(self.input_data, cols_to_sanitize))
+            stage.rows_changed = len(changes.positions[-1])
         # End sanitization
-        # Extract rows where both cholesterol and tomography are not NaN
-        training_data = self.input_data.dropna(subset=["cholesterol", "tomography"])
-
-        # Fit the model
-        model = LinearRegression()
-        model.fit(training_data[["cholesterol"]], training_data["tomography"])
-
-        # Predict tomography where it's NaN and cholesterol is not NaN
-        to_predict = self.input_data.loc[
-            self.input_data["tomography"].isnull()
-            & self.input_data["cholesterol"].notnull(),
-            ["cholesterol"],
-        ]
-
-        # Check if there is any data to predict
-        if not to_predict.empty:
-            predicted_tomography = model.predict(to_predict)
+        # Fit the model in one pass over the rows where both cholesterol
+        # and tomography are not NaN, and the lines of all the hospitals
+        # in another one
+        with self.stage(method, "fit", rows):
+            cholesterol = self.input_data["cholesterol"].to_numpy(dtype=float, na_value=np.nan)
+            tomography = self.input_data["tomography"].to_numpy(dtype=float, na_value=np.nan)
+            model = RegressionStatistics().update(cholesterol, tomography)
+            if per_hospital:
+                hospital_codes, hospitals = group_codes(self.input_data["hospitalID"])
+                hospital_models = GroupRegressionStatistics(hospitals).update(
+                    hospital_codes, cholesterol, tomography
+                )
+
+        with self.stage(method, "predict", rows) as stage:
+            # Predict tomography where it's NaN and cholesterol is not NaN;
+            # nothing can be predicted if no row has both values known
+            to_predict = np.isnan(tomography) & ~np.isnan(cholesterol) & (model.count > 0)
+            known_cholesterol = cholesterol[to_predict]
+            predictions = model.predict(known_cholesterol)
+            if per_hospital:
+                # The line of the hospital of every row, where it is fitted
+                codes = hospital_codes[to_predict]
+                slope = per_row(hospital_models.slope(min_points), codes)
+                intercept = per_row(hospital_models.intercept(min_points), codes)
+                fitted = ~np.isnan(slope)
+                predictions[fitted] = intercept[fitted] + slope[fitted] * known_cholesterol[fitted]
 
             # Update the original dataframe
-            self.input_data.loc[to_predict.index, "tomography"] = predicted_tomography
-
-        # Get rows that were changed during sanitization
-        # changed_rows_sanitization = self.input_data[
-        #     original_data[cols_to_sanitize] != self.input_data[cols_to_sanitize]
-        # ].dropna(subset=cols_to_sanitize)
-
-        # Determine rows changed during sanitization
-        # changed_mask = (
-        #     original_data[cols_to_sanitize] != self.input_data[cols_to_sanitize]
-        # ).any(axis=1)
-        changed_mask = (
-            ~original_data[cols_to_sanitize].isna()
-            & (original_data[cols_to_sanitize] != self.input_data[cols_to_sanitize])
-        ).any(axis=1)
-        changed_rows_sanitization = self.input_data[changed_mask]
-
-        # Get rows where tomography was imputed
-        changed_rows_imputation = self.input_data.loc[to_predict.index]
-
-        # Combine the two sets of changed rows
-        all_changed_rows = pd.concat(
-            [changed_rows_sanitization, changed_rows_imputation]
-        ).drop_duplicates()
-
-        all_changed_rows["patientID"] = all_changed_rows["patientID"].astype(int)
-        all_changed_rows["hospitalID"] = all_changed_rows["hospitalID"].astype(int)
-
-        return all_changed_rows[
-            ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
-        ].reset_index(drop=True)
+            changes.fill(to_predict, "tomography", predictions)
+            stage.rows_changed = len(changes.positions[-1])
+
+        # Rows changed during sanitization followed by the rows
+        # where tomography was imputed
+        with self.stage(method, "changed_rows", sum(map(len, changes.positions))):
+            all_changed_rows = changes.changed_rows(
+                ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+            )
+
+            # IDs that are not integers are returned as int; compact IDs keep their dtype
+            for column in ["patientID", "hospitalID"]:
+                if not pd.api.types.is_integer_dtype(all_changed_rows[column]):
+                    all_changed_rows[column] = all_changed_rows[column].astype(int)
+
+        return all_changed_rows
 
 
 # ---------------
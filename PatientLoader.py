@@ -0,0 +1,191 @@
+# Loading of the hospital CSV files (files/input-hospital*.csv)
+# into the PatientData table
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pandas as pd
+from sqlalchemy import Column, Float, Integer, func
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session, declarative_base
+
+Base = declarative_base()
+table_name = "PatientData"
+
+
+class Patient(Base):
+    __tablename__ = table_name
+
+    patientID = Column(Integer, primary_key=True)
+    hospitalID = Column(Integer, primary_key=True)
+    age = Column(Float, nullable=True)
+    cholesterol = Column(Float, nullable=True)
+    tomography = Column(Float, nullable=True)
+
+
+MEASUREMENTS = ["age", "cholesterol", "tomography"]
+
+
+# Returns the hospital number in a file name like files/input-hospital3.csv
+def hospital_number(filepath):
+    return int(re.search(r"(\d+)\.csv$", filepath).group(1))
+
+
+# Given the contents of a hospital file (ID, Age, Cholesterol, Tomography)
+# and its hospital number, returns a DataFrame with one row per patient.
+# Duplicate patients are merged like updatePatient in app.py does: every
+# field keeps the first known value, later rows only fill unknown fields.
+def hospital_records(data, hospitalID):
+    records = pd.DataFrame(
+        {
+            "patientID": data.iloc[:, 0],
+            "hospitalID": hospitalID,
+            "age": data.iloc[:, 1],
+            "cholesterol": data.iloc[:, 2],
+            "tomography": data.iloc[:, 3],
+        }
+    )
+    return records.groupby(["patientID", "hospitalID"], sort=False, as_index=False).first()
+
+
+# Returns an INSERT statement for the engine's database that, for patients
+# already in the table, only fills their NULL fields with the new values.
+def upsert_statement(engine):
+    table = Patient.__table__
+    if engine.dialect.name == "mysql":
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(
+            {
+                column: func.coalesce(table.c[column], statement.inserted[column])
+                for column in MEASUREMENTS
+            }
+        )
+    if engine.dialect.name in ("sqlite", "postgresql"):
+        dialect = sqlite if engine.dialect.name == "sqlite" else postgresql
+        statement = dialect.insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=["patientID", "hospitalID"],
+            set_={
+                column: func.coalesce(table.c[column], statement.excluded[column])
+                for column in MEASUREMENTS
+            },
+        )
+    raise ValueError(f"Bulk loading is not supported for {engine.dialect.name}")
+
+
+# Converts the rows of a DataFrame to dictionaries with None for np.nan
+def to_parameters(records):
+    return records.astype(object).where(records.notna(), None).to_dict("records")
+
+
+# Reads a hospital file and returns its number of rows and its patients
+# as returned by hospital_records
+def parse_hospital_file(filepath):
+    data = pd.read_csv(filepath)
+    return len(data), hospital_records(data, hospital_number(filepath))
+
+
+# Upserts the patients of a DataFrame like hospital_records returns with
+# batched multi-row INSERTs of batch_size rows, each batch in its own
+# transaction of a session of its own.
+def write_records(engine, records, batch_size=10000):
+    parameters = to_parameters(records)
+    statement = upsert_statement(engine)
+    with Session(engine) as session:
+        for batch_start in range(0, len(parameters), batch_size):
+            with session.begin():
+                session.execute(
+                    statement, parameters[batch_start : batch_start + batch_size]
+                )
+
+
+# Replaces the rows of the given hospitals in the table with the patients
+# of a DataFrame like hospital_records returns, in one transaction: the old
+# rows are deleted first, so changed values overwrite the old ones and the
+# patients no longer in records are removed.
+def replace_hospital_records(engine, records, hospitalIDs, batch_size=10000):
+    table = Patient.__table__
+    parameters = to_parameters(records[["patientID", "hospitalID"] + MEASUREMENTS])
+    with engine.begin() as connection:
+        connection.execute(
+            table.delete().where(table.c.hospitalID.in_([int(ID) for ID in hospitalIDs]))
+        )
+        for batch_start in range(0, len(parameters), batch_size):
+            connection.execute(table.insert(), parameters[batch_start : batch_start + batch_size])
+
+
+# Inserts the patients of a hospital file with the same result as
+# insertRecords in app.py, reading the file only once.
+# Returns the number of rows read from the file and the time it took.
+def bulk_insert_records(engine, filepath, batch_size=10000):
+    start = time.perf_counter()
+    rows, records = parse_hospital_file(filepath)
+    write_records(engine, records, batch_size)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Inserted {rows} rows from {filepath} in {elapsed:.2f}s "
+        f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+    return rows, elapsed
+
+
+# Inserts the patients of the given hospitals (all by default) of a
+# PatientStore, reading each partition instead of parsing its CSV files.
+# Returns the number of patients inserted and the time it took.
+def store_insert_records(engine, store, hospitalIDs=None, batch_size=10000):
+    start = time.perf_counter()
+    rows = 0
+    for hospitalID in store.hospitals() if hospitalIDs is None else hospitalIDs:
+        records = store.read([hospitalID])
+        write_records(engine, records, batch_size)
+        rows += len(records)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Inserted {rows} patients from {store.directory} in {elapsed:.2f}s "
+        f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+    return rows, elapsed
+
+
+# Inserts the patients of many hospital files at once: the files are
+# parsed by a pool of processes and written by a pool of threads, each
+# with its own session on a connection of the engine's pool.
+# All the files of a hospital are written one after another, in the given
+# order, by the same thread, so no two threads ever write the same
+# (patientID, hospitalID) and the result is the same as loading the files
+# one at a time. threads defaults to the size of the engine's pool.
+# Returns the number of rows read from the files and the time it took.
+def parallel_insert_records(
+    engine, filepaths, processes=None, threads=None, batch_size=10000
+):
+    start = time.perf_counter()
+    files_per_hospital = {}
+    for filepath in filepaths:
+        files_per_hospital.setdefault(hospital_number(filepath), []).append(filepath)
+    if threads is None:
+        threads = engine.pool.size() if hasattr(engine.pool, "size") else 1
+
+    with ProcessPoolExecutor(processes) as parsers, ThreadPoolExecutor(threads) as writers:
+        parsed = {filepath: parsers.submit(parse_hospital_file, filepath) for filepath in filepaths}
+
+        def write_hospital(hospital_filepaths):
+            rows = 0
+            for filepath in hospital_filepaths:
+                file_rows, records = parsed[filepath].result()
+                write_records(engine, records, batch_size)
+                rows += file_rows
+            return rows
+
+        written = [
+            writers.submit(write_hospital, hospital_filepaths)
+            for hospital_filepaths in files_per_hospital.values()
+        ]
+        rows = sum(future.result() for future in written)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Inserted {rows} rows from {len(filepaths)} files in {elapsed:.2f}s "
+        f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+    return rows, elapsed
@@ -0,0 +1,110 @@
+# Indexes of the PatientData table for the imputation UPDATEs of
+# query1.sql to query4.sql and DatabaseImpute. Without them the median and
+# average per hospitalID, (hospitalID, age) and age bracket scan and sort
+# the whole table. An age_bracket column makes the bracket of every row
+# indexable, and EXPLAIN shows which indexes each step uses.
+import re
+from sqlalchemy import inspect, text
+from DatabaseImputation import STEPS, age_bracket, has_age_bracket, step_statements
+from PatientLoader import table_name
+
+# Secondary indexes of PatientData by name, with their columns. They cover
+# every column the imputation statements read, so these never touch the
+# rows. The primary key (patientID, hospitalID) already serves the
+# sanitization of duplicate patients by patientID.
+INDEXES = {
+    "ix_PatientData_hospital_age": ["hospitalID", "age", "cholesterol"],
+    "ix_PatientData_age_bracket": ["age_bracket", "cholesterol"],
+}
+
+# Indexes each step is expected to use once the schema is tuned. The
+# tomography step fits its line over every known pair, so it scans.
+STEP_INDEXES = {
+    "age": ["ix_PatientData_hospital_age"],
+    "cholesterol_single_hospital": ["ix_PatientData_hospital_age"],
+    "cholesterol": ["ix_PatientData_age_bracket"],
+    "tomography": [],
+}
+
+
+# Returns the statements adding the age_bracket column to PatientData for
+# the dialect: a stored generated column in MySQL. SQLite cannot add stored
+# columns to an existing table, and once ANALYZE has run it plans wrong
+# results from an index on a virtual one, so there it is a plain column
+# filled once and kept up to date by triggers on every write of age.
+def add_age_bracket_statements(dialect):
+    bracket = age_bracket(dialect, "age")
+    if dialect == "mysql":
+        return [f"ALTER TABLE {table_name} ADD COLUMN age_bracket INT AS ({bracket}) STORED"]
+    if dialect == "sqlite":
+        new_bracket = age_bracket(dialect, "NEW.age")
+        return [
+            f"ALTER TABLE {table_name} ADD COLUMN age_bracket INTEGER",
+            f"UPDATE {table_name} SET age_bracket = {bracket}",
+            f"CREATE TRIGGER {table_name}_age_bracket_insert AFTER INSERT ON {table_name} "
+            f"BEGIN UPDATE {table_name} SET age_bracket = {new_bracket} "
+            f"WHERE rowid = NEW.rowid; END",
+            f"CREATE TRIGGER {table_name}_age_bracket_update AFTER UPDATE OF age ON {table_name} "
+            f"BEGIN UPDATE {table_name} SET age_bracket = {new_bracket} "
+            f"WHERE rowid = NEW.rowid; END",
+        ]
+    raise ValueError(f"Schema tuning is not supported for {dialect}")
+
+
+# Adds the age_bracket column and the indexes of INDEXES to the PatientData
+# table of an engine, skipping those it already has, in one transaction,
+# then refreshes the statistics the planner uses to choose the indexes.
+# Returns the names of the columns and indexes that were added.
+def tune_schema(engine):
+    added = []
+    existing = {index["name"] for index in inspect(engine).get_indexes(table_name)}
+    with engine.begin() as connection:
+        if not has_age_bracket(engine):
+            for statement in add_age_bracket_statements(engine.dialect.name):
+                connection.execute(text(statement))
+            added.append("age_bracket")
+        for name, columns in INDEXES.items():
+            if name not in existing:
+                connection.execute(
+                    text(f"CREATE INDEX {name} ON {table_name} ({', '.join(columns)})")
+                )
+                added.append(name)
+    with engine.begin() as connection:
+        if engine.dialect.name == "mysql":
+            connection.execute(text(f"ANALYZE TABLE {table_name}"))
+        else:
+            connection.execute(text(f"ANALYZE {table_name}"))
+    return added
+
+
+# Returns the names of the indexes the database plans to use for a
+# statement, from EXPLAIN in MySQL or EXPLAIN QUERY PLAN in SQLite
+def explain_indexes(connection, statement):
+    if connection.dialect.name == "mysql":
+        plan = connection.execute(text(f"EXPLAIN {statement}")).mappings()
+        return {row["key"] for row in plan if row["key"] is not None}
+    if connection.dialect.name == "sqlite":
+        plan = connection.execute(text(f"EXPLAIN QUERY PLAN {statement}"))
+        return {
+            index
+            for row in plan
+            for index in re.findall(r"USING (?:COVERING )?INDEX (\w+)", row[-1])
+        }
+    raise ValueError(f"Schema tuning is not supported for {connection.dialect.name}")
+
+
+# Returns, for every imputation step, the indexes the database plans to use
+# for its statements and the indexes of STEP_INDEXES it would not use
+def check_indexes(engine):
+    statements = step_statements(engine.dialect.name, has_age_bracket(engine))
+    report = {}
+    with engine.connect() as connection:
+        for step in STEPS:
+            used = set()
+            for statement in statements[step]:
+                used |= explain_indexes(connection, statement)
+            report[step] = {
+                "used": sorted(used),
+                "missing": [index for index in STEP_INDEXES[step] if index not in used],
+            }
+    return report
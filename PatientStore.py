@@ -0,0 +1,141 @@
+# Columnar storage of the hospital files (files/input-hospital*.csv).
+# Each CSV file is parsed once and its patients are kept in a partition of
+# their own hospital, directory/hospitalID=<hospitalID>/, as an
+# uncompressed Arrow IPC file (memory-mapped and read without copies) or a
+# Parquet file (smaller, but decoded when read). Requires pyarrow.
+# Unknown measurements are stored as NaN, like Impute expects, rather than
+# Arrow nulls, so that reading them back needs no conversion.
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from PatientLoader import MEASUREMENTS, hospital_number, hospital_records
+
+COLUMNS = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+
+# Returns the Arrow schema of the stored patients: int32 IDs and
+# measurements of the given type (float32 by default)
+def patient_schema(measurement_type="float32"):
+    measurement_type = pa.from_numpy_dtype(np.dtype(measurement_type))
+    return pa.schema(
+        [("patientID", pa.int32()), ("hospitalID", pa.int32())]
+        + [(column, measurement_type) for column in MEASUREMENTS]
+    )
+
+
+# Partitioned storage of the patients of every hospital in directory.
+# file_format is "arrow" or "parquet".
+class PatientStore:
+    def __init__(self, directory, measurement_type="float32", file_format="arrow"):
+        if file_format not in ("arrow", "parquet"):
+            raise ValueError(f"Unknown file format {file_format}")
+        self.directory = directory
+        self.schema = patient_schema(measurement_type)
+        self.file_format = file_format
+        os.makedirs(directory, exist_ok=True)
+
+        manifest_path = os.path.join(directory, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        else:
+            self.manifest = {}
+
+    def partition_path(self, hospitalID):
+        return os.path.join(
+            self.directory, f"hospitalID={hospitalID}", f"part.{self.file_format}"
+        )
+
+    # Returns the hospitals with a partition, in increasing order
+    def hospitals(self):
+        return sorted(
+            int(entry.split("=", 1)[1])
+            for entry in os.listdir(self.directory)
+            if entry.startswith("hospitalID=")
+        )
+
+    # Converts the hospital files that are new or have changed since they
+    # were last converted. The partition of a hospital holds the patients
+    # of all its files, merged like bulk_insert_records does, so it has the
+    # same rows as the PatientData table after loading them. Files converted
+    # before but missing from filepaths (deleted or renamed) are dropped, and
+    # so is the partition of a hospital that has no file left.
+    # Returns the set of hospitals whose partition was written or removed.
+    def convert_files(self, filepaths):
+        files_per_hospital = {}
+        changed = set()
+        for filepath in set(self.manifest) - set(filepaths):
+            changed.add(self.manifest.pop(filepath)["hospitalID"])
+        for filepath in filepaths:
+            with open(filepath, "rb") as hospital_file:
+                digest = hashlib.sha1(hospital_file.read()).hexdigest()
+            hospitalID = hospital_number(filepath)
+            if self.manifest.get(filepath, {}).get("digest") != digest:
+                changed.add(hospitalID)
+            self.manifest[filepath] = {"digest": digest, "hospitalID": hospitalID}
+
+        for hospitalID in changed - {entry["hospitalID"] for entry in self.manifest.values()}:
+            path = self.partition_path(hospitalID)
+            if os.path.exists(path):
+                os.remove(path)
+            if os.path.isdir(os.path.dirname(path)) and not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+        for filepath, entry in self.manifest.items():
+            if entry["hospitalID"] in changed:
+                files_per_hospital.setdefault(entry["hospitalID"], []).append(filepath)
+        for hospitalID, hospital_filepaths in files_per_hospital.items():
+            data = pd.concat([pd.read_csv(filepath) for filepath in hospital_filepaths])
+            self.write_partition(hospitalID, hospital_records(data, hospitalID))
+
+        with open(os.path.join(self.directory, "manifest.json"), "w") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        return changed
+
+    # Writes the patients of a hospital, as returned by hospital_records
+    def write_partition(self, hospitalID, records):
+        # from_pandas=False keeps NaN as a value instead of a null
+        table = pa.Table.from_arrays(
+            [
+                pa.array(records[field.name].to_numpy(), type=field.type, from_pandas=False)
+                for field in self.schema
+            ],
+            schema=self.schema,
+        )
+        path = self.partition_path(hospitalID)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.file_format == "arrow":
+            with ipc.new_file(path, self.schema) as writer:
+                writer.write_table(table)
+        else:
+            pq.write_table(table, path)
+
+    # Returns an Arrow table with the given columns (all by default) of the
+    # patients of the given hospitals (all by default), reading only their
+    # partitions and memory-mapping them
+    def read_table(self, hospitalIDs=None, columns=None):
+        hospitals = self.hospitals() if hospitalIDs is None else hospitalIDs
+        columns = COLUMNS if columns is None else columns
+        tables = []
+        for hospitalID in hospitals:
+            path = self.partition_path(hospitalID)
+            if not os.path.exists(path):
+                continue
+            if self.file_format == "arrow":
+                table = ipc.open_file(pa.memory_map(path)).read_all().select(columns)
+            else:
+                table = pq.read_table(path, columns=columns, memory_map=True)
+            tables.append(table)
+        if not tables:
+            return self.schema.empty_table().select(columns)
+        return pa.concat_tables(tables)
+
+    # Returns a DataFrame with the given columns of the patients of the
+    # given hospitals, as read_table does. For a single hospital stored as
+    # Arrow, its columns point to the memory-mapped file and are read-only.
+    def read(self, hospitalIDs=None, columns=None):
+        return self.read_table(hospitalIDs, columns).to_pandas(split_blocks=True)
@@ -0,0 +1,255 @@
+# Polars backend of Impute, selected with Impute(input_data, backend="polars").
+# The data is kept in a Polars DataFrame and every method runs as one lazy
+# query, which Polars executes over columnar memory with all the cores,
+# without any process management. The methods return the same pandas
+# DataFrames of changed rows as the pandas backend, which stays the
+# reference implementation. Requires polars.
+import pandas as pd
+import polars as pl
+from PatientImputation import (
+    ChangeTracker,
+    GroupRegressionStatistics,
+    Impute,
+    RegressionStatistics,
+)
+
+COLUMNS = ["patientID", "age", "cholesterol", "tomography"]
+COLUMNS_WITH_HOSPITAL = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+
+# Impute whose data lives in a Polars DataFrame (self.data), where unknown
+# values are nulls. input_data returns a pandas copy of it with np.nan for
+# unknown measurements: writes into that copy are not seen by the methods,
+# use set_values or changes instead. Instrumentation and the statistics
+# cache are not supported: asking for them raises ValueError.
+class PolarsImpute(Impute):
+    def __init__(
+        self,
+        input_data,
+        compact=False,
+        nullable=False,
+        instrumentation=None,
+        backend="polars",
+        cache_size=0,
+        check_cache=False,
+    ):
+        if instrumentation is not None:
+            raise ValueError("Instrumentation is not supported by the polars backend")
+        if cache_size > 0:
+            raise ValueError("The statistics cache is not supported by the polars backend")
+        super().__init__(input_data, compact, nullable)
+
+    @property
+    def input_data(self):
+        return self.data.to_pandas()
+
+    @input_data.setter
+    def input_data(self, input_data):
+        self.data = pl.from_pandas(input_data, nan_to_null=True)
+
+    def memory_footprint(self):
+        return int(self.data.estimated_size())
+
+    # Returns a ChangeTracker over a pandas copy of the data, which writes
+    # every change it records back into self.data
+    def changes(self):
+        input_data = self.input_data
+
+        def on_write(positions, column):
+            values = pl.Series(
+                input_data[column].to_numpy()[positions], nan_to_null=True
+            ).cast(self.data.schema[column])
+            self.data = self.data.with_columns(self.data[column].scatter(positions, values))
+
+        return ChangeTracker(input_data, on_write)
+
+    # Writes value (an expression over the current data) into column at the
+    # rows where changed holds, rounded to the dtype of the column, in one
+    # lazy query. Returns the given columns of the changed rows as a pandas
+    # DataFrame.
+    def fill(self, changed, column, value, columns):
+        result = (
+            self.data.lazy()
+            .with_columns(
+                changed.fill_null(False).alias("_changed"),
+                value.cast(self.data.schema[column]).alias("_value"),
+            )
+            .with_columns(
+                pl.when(pl.col("_changed"))
+                .then(pl.col("_value"))
+                .otherwise(pl.col(column))
+                .alias(column)
+            )
+            .collect()
+        )
+        self.data = result.drop(["_changed", "_value"])
+        return result.filter(pl.col("_changed")).select(columns).to_pandas()
+
+    def impute_age(self, hospitalID):
+        at_hospital = pl.col("hospitalID") == hospitalID
+        median_age = self.data.filter(at_hospital)["age"].median()
+        if median_age is None:
+            return pd.DataFrame(columns=COLUMNS)
+        return self.fill(
+            at_hospital & pl.col("age").is_null(), "age", pl.lit(median_age), COLUMNS
+        )
+
+    def impute_age_all_hospitals(self, hospitalIDs=None):
+        median_age = pl.col("age").median().over("hospitalID")
+        changed = pl.col("age").is_null() & median_age.is_not_null()
+        changed = changed & pl.col("hospitalID").is_not_null()
+        if hospitalIDs is not None:
+            changed = changed & pl.col("hospitalID").is_in(list(hospitalIDs))
+        return self.fill(changed, "age", median_age, COLUMNS_WITH_HOSPITAL)
+
+    def impute_cholesterol_single_hospital(self, hospitalID):
+        average_cholesterol = pl.col("cholesterol").mean().over(["hospitalID", "age"])
+        changed = (
+            (pl.col("hospitalID") == hospitalID)
+            & pl.col("age").is_not_null()
+            & pl.col("cholesterol").is_null()
+            & average_cholesterol.is_not_null()
+        )
+        return self.fill(changed, "cholesterol", average_cholesterol, COLUMNS)
+
+    def impute_cholesterol_all_hospitals(self):
+        average_cholesterol = pl.col("cholesterol").mean().over(["hospitalID", "age"])
+        changed = (
+            pl.col("hospitalID").is_not_null()
+            & pl.col("age").is_not_null()
+            & pl.col("cholesterol").is_null()
+            & average_cholesterol.is_not_null()
+        )
+        return self.fill(changed, "cholesterol", average_cholesterol, COLUMNS_WITH_HOSPITAL)
+
+    def impute_cholesterol(self):
+        age_bracket = (pl.col("age") / 5).floor() * 5
+        min_cholesterol = pl.col("cholesterol").min().over(age_bracket)
+        changed = (
+            pl.col("age").is_not_null()
+            & pl.col("cholesterol").is_null()
+            & min_cholesterol.is_not_null()
+        )
+        return self.fill(changed, "cholesterol", min_cholesterol, COLUMNS_WITH_HOSPITAL)
+
+    # Majority value of column for every patient with several rows whose
+    # most frequent known value is not tied, like majority_values. Only the
+    # rows of such patients are grouped.
+    def majorities(self, column):
+        value_counts = (
+            self.data.lazy()
+            .filter(pl.col("patientID").is_duplicated())
+            .filter(pl.col("patientID").is_not_null() & pl.col(column).is_not_null())
+            .group_by(["patientID", column])
+            .agg(pl.len().alias("value_rows"))
+        )
+        return (
+            value_counts.filter(
+                pl.col("value_rows") == pl.col("value_rows").max().over("patientID")
+            )
+            .group_by("patientID")
+            .agg(pl.col(column).first().alias("majority"), pl.len().alias("modes"))
+            .filter(pl.col("modes") == 1)
+            .select("patientID", "majority")
+        )
+
+    def impute_tomography(self, per_hospital=False, min_points=3):
+        if self.data["cholesterol"].null_count() == len(self.data):
+            return pd.DataFrame()
+
+        # Sanitization: every value of a patient with a majority is replaced,
+        # but only the rows where a known value changed are reported
+        columns = ["cholesterol", "tomography"]
+        sanitized = self.data.lazy().with_row_index("_row")
+        for column in columns:
+            sanitized = sanitized.join(
+                self.majorities(column).rename({"majority": f"_{column}_majority"}),
+                on="patientID",
+                how="left",
+            )
+        sanitized = sanitized.sort("_row").with_columns(
+            [
+                pl.coalesce(
+                    pl.col(f"_{column}_majority").cast(self.data.schema[column]),
+                    pl.col(column),
+                ).alias(f"_{column}_sanitized")
+                for column in columns
+            ]
+        )
+        sanitized = sanitized.with_columns(
+            pl.any_horizontal(
+                [
+                    pl.col(column).is_not_null()
+                    & (pl.col(f"_{column}_sanitized") != pl.col(column))
+                    for column in columns
+                ]
+            ).alias("_sanitized"),
+            *[pl.col(f"_{column}_sanitized").alias(column) for column in columns],
+        ).collect()
+
+        # Fit the line over the rows where both values are known
+        known = pl.col("cholesterol").is_not_null() & pl.col("tomography").is_not_null()
+        cholesterol = pl.col("cholesterol").cast(pl.Float64)
+        tomography = pl.col("tomography").cast(pl.Float64)
+        sums = [
+            known.sum().alias("count"),
+            cholesterol.filter(known).sum().alias("sum_x"),
+            tomography.filter(known).sum().alias("sum_y"),
+            (cholesterol * cholesterol).filter(known).sum().alias("sum_xx"),
+            (cholesterol * tomography).filter(known).sum().alias("sum_xy"),
+        ]
+        model = RegressionStatistics()
+        for name, value in sanitized.select(sums).row(0, named=True).items():
+            setattr(model, name, value)
+        prediction = pl.lit(model.intercept()) + pl.lit(model.slope()) * cholesterol
+
+        # The lines of the hospitals that can be fitted from their own rows
+        if per_hospital:
+            hospital_sums = (
+                sanitized.filter(pl.col("hospitalID").is_not_null())
+                .group_by("hospitalID")
+                .agg(sums)
+            )
+            hospital_models = GroupRegressionStatistics(len(hospital_sums))
+            for name in ["count", "sum_x", "sum_y", "sum_xx", "sum_xy"]:
+                setattr(hospital_models, name, hospital_sums[name].to_numpy())
+            lines = pl.DataFrame(
+                {
+                    "hospitalID": hospital_sums["hospitalID"],
+                    "_slope": hospital_models.slope(min_points),
+                    "_intercept": hospital_models.intercept(min_points),
+                }
+            )
+            sanitized = sanitized.join(lines, on="hospitalID", how="left").sort("_row")
+            prediction = (
+                pl.when(pl.col("_slope").is_not_nan())
+                .then(pl.col("_intercept") + pl.col("_slope") * cholesterol)
+                .otherwise(prediction)
+            )
+
+        predicted = (
+            pl.col("tomography").is_null()
+            & pl.col("cholesterol").is_not_null()
+            & pl.lit(model.count > 0)
+        )
+        result = sanitized.with_columns(
+            predicted.alias("_predicted"),
+            pl.when(predicted)
+            .then(prediction.cast(self.data.schema["tomography"]))
+            .otherwise(pl.col("tomography"))
+            .alias("tomography"),
+        )
+        self.data = result.select(self.data.columns)
+
+        # Rows changed during sanitization followed by the rows
+        # where tomography was imputed
+        all_changed_rows = (
+            result.filter(pl.col("_sanitized") | pl.col("_predicted"))
+            .sort([pl.col("_sanitized").not_(), pl.col("_row")])
+            .select(COLUMNS_WITH_HOSPITAL)
+            .to_pandas()
+        )
+        for column in ["patientID", "hospitalID"]:
+            if not pd.api.types.is_integer_dtype(all_changed_rows[column]):
+                all_changed_rows[column] = all_changed_rows[column].astype(int)
+        return all_changed_rows
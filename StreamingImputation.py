@@ -0,0 +1,294 @@
+# Imputation of patient data that does not fit in memory.
+# The data is read in chunks, possibly several times, and only the
+# statistics needed by each imputation strategy are kept between chunks.
+# Their size depends on the number of hospitals, ages and age brackets,
+# never on the number of patients.
+import numpy as np
+import pandas as pd
+from MedianSketch import HistogramMedian
+from PatientImputation import RegressionStatistics, majority_values
+
+COLUMNS = ["patientID", "hospitalID", "age", "cholesterol", "tomography"]
+
+# Imputation strategies in the order they are applied, named after the
+# Impute methods whose results they reproduce when called in this order:
+# impute_age_all_hospitals, impute_cholesterol_all_hospitals,
+# impute_cholesterol and impute_tomography.
+STEPS = ["age", "cholesterol_single_hospital", "cholesterol", "tomography"]
+
+
+# Returns a function that reads the CSV file at path in chunks of
+# chunksize rows each time it is called.
+def csv_chunks(path, chunksize=100000):
+    def read_chunks():
+        return pd.read_csv(path, chunksize=chunksize)
+
+    return read_chunks
+
+
+# Returns a function that reads the Parquet file at path in chunks of
+# batch_size rows each time it is called. Requires pyarrow.
+def parquet_chunks(path, batch_size=100000):
+    import pyarrow.parquet as pq
+
+    def read_chunks():
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+
+    return read_chunks
+
+
+# Adds two Series of per-group sums, keeping the groups of both
+def add_statistics(total, chunk):
+    if total is None:
+        return chunk
+    return total.add(chunk, fill_value=0)
+
+
+# Keeps the lowest value of each group of two Series of per-group minimums
+def min_statistics(total, chunk):
+    if total is None:
+        return chunk
+    return pd.concat([total, chunk]).groupby(level=0).min()
+
+
+# Looks up the value of a Series indexed by (hospitalID, age) for every
+# row of data; rows without a matching group (every row, when statistics
+# is empty) get NaN.
+def lookup_hospital_age(statistics, data):
+    if len(statistics) == 0:
+        return np.full(len(data), np.nan)
+    keys = pd.MultiIndex.from_arrays([data["hospitalID"], data["age"]])
+    positions = statistics.index.get_indexer(keys)
+    values = statistics.to_numpy()[positions]
+    values[positions < 0] = np.nan
+    return values
+
+
+# Imputes patient data read in chunks with the same results as calling
+# the in-memory Impute methods one after another over the whole data.
+# read_chunks is a function returning a new iterator over DataFrames with
+# the five attributes expected by Impute every time it is called, such as
+# csv_chunks or parquet_chunks. Only the strategies listed in steps are
+# applied, always in the order of STEPS.
+# The per-hospital median ages are gathered by median, a HistogramMedian
+# (exact, the default) or a TDigestMedian (approximate) from MedianSketch.py.
+# The tomography step sanitizes all the rows of a patient together, so it
+# requires the chunks to be sorted by patientID.
+# Averages are summed chunk by chunk, so they can differ from the in-memory
+# ones in the last bit, which can change an exact majority vote during
+# sanitization; results are identical when the cholesterol sums are exact.
+class StreamingImpute:
+    def __init__(self, read_chunks, steps=STEPS, median=None):
+        self.read_chunks = read_chunks
+        self.steps = [step for step in STEPS if step in steps]
+        self.median = HistogramMedian() if median is None else median
+
+        self.median_age = None
+        self.average_cholesterol = None
+        self.min_cholesterol = None
+        self.regression = None
+        self.sanitize = False
+
+    # First pass: gathers the per-hospital age medians, the (hospital, age)
+    # cholesterol sums and counts and the age bracket cholesterol minimums.
+    # Rows with an unknown age count towards the median age of their
+    # hospital, as they do once impute_age has filled them.
+    def gather_statistics(self):
+        read_any = False
+        cholesterol_sum = None
+        cholesterol_count = None
+        bracket_min = None
+        unknown_age_sum = None
+        unknown_age_count = None
+        unknown_age_min = None
+
+        for chunk in self.read_chunks():
+            known_cholesterol = chunk.loc[chunk["cholesterol"].notnull()]
+            unknown_age = known_cholesterol.loc[known_cholesterol["age"].isnull()]
+
+            read_any = True
+            self.median.update(chunk["hospitalID"], chunk["age"])
+            by_age = known_cholesterol.groupby(["hospitalID", "age"])["cholesterol"]
+            cholesterol_sum = add_statistics(cholesterol_sum, by_age.sum())
+            cholesterol_count = add_statistics(cholesterol_count, by_age.count())
+            bracket_min = min_statistics(
+                bracket_min,
+                known_cholesterol["cholesterol"]
+                .groupby((known_cholesterol["age"] // 5) * 5)
+                .min(),
+            )
+
+            by_hospital = unknown_age.groupby("hospitalID")["cholesterol"]
+            unknown_age_sum = add_statistics(unknown_age_sum, by_hospital.sum())
+            unknown_age_count = add_statistics(unknown_age_count, by_hospital.count())
+            unknown_age_min = min_statistics(unknown_age_min, by_hospital.min())
+
+        # Nothing to impute without any data
+        if not read_any:
+            self.median_age = pd.Series(dtype=float)
+            self.average_cholesterol = pd.Series(
+                dtype=float, index=pd.MultiIndex.from_arrays([[], []])
+            )
+            self.min_cholesterol = pd.Series(dtype=float)
+            return
+
+        self.median_age = self.median.medians()
+
+        if "age" in self.steps:
+            # Move the cholesterol of rows with an unknown age to the group
+            # of the median age of their hospital
+            median_age = unknown_age_sum.index.map(self.median_age)
+            has_median = median_age.notnull()
+            deferred_keys = pd.MultiIndex.from_arrays(
+                [unknown_age_sum.index[has_median], median_age[has_median]],
+                names=["hospitalID", "age"],
+            )
+            cholesterol_sum = add_statistics(
+                cholesterol_sum,
+                pd.Series(unknown_age_sum.to_numpy()[has_median], index=deferred_keys),
+            )
+            cholesterol_count = add_statistics(
+                cholesterol_count,
+                pd.Series(unknown_age_count.to_numpy()[has_median], index=deferred_keys),
+            )
+            bracket_min = min_statistics(
+                bracket_min,
+                pd.Series(
+                    unknown_age_min.to_numpy()[has_median],
+                    index=pd.Index((median_age[has_median] // 5) * 5, name="age"),
+                ),
+            )
+
+        has_cholesterol = cholesterol_count > 0
+        self.average_cholesterol = (
+            cholesterol_sum[has_cholesterol] / cholesterol_count[has_cholesterol]
+        )
+        self.min_cholesterol = bracket_min
+
+    # Applies the age and cholesterol strategies to a chunk, in place
+    def impute_age_and_cholesterol(self, chunk):
+        if "age" in self.steps:
+            imputed_age = chunk["hospitalID"].map(self.median_age)
+            unknown_age = chunk["age"].isnull() & imputed_age.notnull()
+            chunk.loc[unknown_age, "age"] = imputed_age[unknown_age].to_numpy()
+
+        if "cholesterol_single_hospital" in self.steps:
+            imputed_cholesterol = lookup_hospital_age(self.average_cholesterol, chunk)
+            unknown_cholesterol = chunk["cholesterol"].isnull().to_numpy() & ~np.isnan(
+                imputed_cholesterol
+            )
+            chunk.loc[unknown_cholesterol, "cholesterol"] = imputed_cholesterol[
+                unknown_cholesterol
+            ]
+
+        if "cholesterol" in self.steps:
+            imputed_cholesterol = ((chunk["age"] // 5) * 5).map(self.min_cholesterol)
+            unknown_cholesterol = (
+                chunk["cholesterol"].isnull() & imputed_cholesterol.notnull()
+            )
+            chunk.loc[unknown_cholesterol, "cholesterol"] = imputed_cholesterol[
+                unknown_cholesterol
+            ].to_numpy()
+
+    # Yields the chunks with every patient's rows in a single chunk,
+    # holding back the rows of the last patient of a chunk until the next.
+    # Raises ValueError if the chunks are not sorted by patientID.
+    def patient_chunks(self):
+        held_back = None
+        for chunk in self.read_chunks():
+            if held_back is not None:
+                chunk = pd.concat([held_back, chunk])
+            chunk = chunk.reset_index(drop=True)
+            if len(chunk) == 0:
+                continue
+
+            patient_ids = chunk["patientID"].to_numpy()
+            if not np.all(patient_ids[1:] >= patient_ids[:-1]):
+                raise ValueError("The tomography step requires data sorted by patientID")
+
+            split = np.searchsorted(patient_ids, patient_ids[-1], side="left")
+            held_back = chunk.iloc[split:]
+            if split > 0:
+                yield chunk.iloc[:split].copy()
+
+        if held_back is not None:
+            yield held_back.copy()
+
+    # Second pass, only needed for the tomography step: fits the regression
+    # over the data as it is after the other strategies and sanitization.
+    def fit_regression(self):
+        self.regression = RegressionStatistics()
+        self.sanitize = False
+        for chunk in self.patient_chunks():
+            self.impute_age_and_cholesterol(chunk)
+            self.sanitize |= bool(chunk["cholesterol"].notnull().any())
+            chunk[["cholesterol", "tomography"]] = majority_values(
+                chunk, ["cholesterol", "tomography"]
+            )
+            self.regression.update(chunk["cholesterol"], chunk["tomography"])
+
+    # Yields the imputed chunks, gathering the statistics first if needed
+    def impute_chunks(self):
+        if self.median_age is None:
+            self.gather_statistics()
+        if "tomography" in self.steps and self.regression is None:
+            self.fit_regression()
+
+        if "tomography" not in self.steps:
+            for chunk in self.read_chunks():
+                chunk = chunk.reset_index(drop=True)
+                self.impute_age_and_cholesterol(chunk)
+                yield chunk
+            return
+
+        for chunk in self.patient_chunks():
+            self.impute_age_and_cholesterol(chunk)
+            # Like impute_tomography, nothing changes when no cholesterol is known
+            if self.sanitize:
+                chunk[["cholesterol", "tomography"]] = majority_values(
+                    chunk, ["cholesterol", "tomography"]
+                )
+                if self.regression.count > 0:
+                    to_predict = (
+                        chunk["tomography"].isnull() & chunk["cholesterol"].notnull()
+                    )
+                    chunk.loc[to_predict, "tomography"] = self.regression.predict(
+                        chunk.loc[to_predict, "cholesterol"]
+                    )
+            yield chunk
+
+    # Imputes all the chunks and writes them to output_path, as Parquet if
+    # the path ends with .parquet (requires pyarrow) and as CSV otherwise.
+    # Returns the number of rows written.
+    def run(self, output_path):
+        rows = 0
+        if output_path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            writer = None
+            try:
+                for chunk in self.impute_chunks():
+                    if writer is None:
+                        table = pa.Table.from_pandas(chunk, preserve_index=False)
+                        writer = pq.ParquetWriter(output_path, table.schema)
+                    else:
+                        table = pa.Table.from_pandas(
+                            chunk, schema=writer.schema, preserve_index=False
+                        )
+                    writer.write_table(table)
+                    rows += len(chunk)
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            for chunk in self.impute_chunks():
+                chunk.to_csv(
+                    output_path,
+                    mode="w" if rows == 0 else "a",
+                    header=rows == 0,
+                    index=False,
+                )
+                rows += len(chunk)
+        return rows
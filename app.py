@@ -1,13 +1,21 @@
 import pandas as pd
 import math
-from sqlalchemy import Table, create_engine
-from sqlalchemy import create_engine, Column, Integer, Float, MetaData, Table
+from sqlalchemy import MetaData, Table, create_engine
 from sqlalchemy import and_
-from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import IntegrityError
 import os
+from DatabaseImputation import DatabaseImpute
+from IncrementalImputation import IncrementalImpute
+from PatientSchema import tune_schema
+from PatientLoader import (
+    Base,
+    Patient,
+    bulk_insert_records,
+    hospital_number,
+    parallel_insert_records,
+    store_insert_records,
+    table_name,
+)
 
 # MySQL database configuration
 host = "localhost:3306"
@@ -15,36 +23,35 @@ database = "db"
 user = "user"
 password = "password"
 
+# Load each file with batched upserts instead of one query per row
+bulk_load = True
+batch_size = 10000
+# Parse the files in parallel processes and write them from parallel threads
+parallel_load = False
+# Convert new or changed files once into columnar partitions per hospital
+# in store_directory and load from them (requires pyarrow)
+store_load = False
+store_directory = "store"
+# Keep the imputed data in imputation_store, imputing again only the rows
+# that depend on hospital files that are new or changed since the last run
+incremental_imputation = False
+imputation_store = "imputation"
+# Add the age_bracket column and the indexes of PatientSchema that the
+# imputation UPDATEs use, once the files are loaded (skipping those the
+# table already has). On SQLite this only speeds up the cholesterol step,
+# and keeping the indexes up to date slows the other steps
+tune_database_schema = False
+# Impute the PatientData table once it is loaded, either inside the
+# database ("database") or with the Impute methods in memory ("pandas")
+database_imputation = False
+imputation_backend = "database"
+
 # Create a MySQL engine using SQLAlchemy
 engine = create_engine(f"mysql+pymysql://{user}:{password}@{host}/{database}")
 Session = sessionmaker(bind=engine)
 session = Session()
 
-# Step 3: Define a Model Class
-Base = declarative_base()
-table_name = "PatientData"  # Replace with the name of the table you want to drop
-
-
-class Patient(Base):
-    __tablename__ = table_name
-
-    patientID = Column(Integer, primary_key=True)
-    hospitalID = Column(Integer, primary_key=True)
-    age = Column(Float, nullable=True)
-    cholesterol = Column(Float, nullable=True)
-    tomography = Column(Float, nullable=True)
-
-
-# Step 3: Reflect the Database (optional but useful to define tables)
-metadata = MetaData()
-metadata.reflect(bind=engine)
-
-# Drop a Specific Table
-
-table_to_drop = Table(table_name, metadata, autoload=True, autoload_with=engine)
-table_to_drop.drop(engine)
-
-Base.metadata.create_all(engine)
+# Step 3: The Patient model class and table_name are defined in PatientLoader.py
 
 folder_path = "files"
 
@@ -77,7 +84,7 @@ def insertRecords(filepath):
     data = pd.read_csv(filepath)
     df = pd.DataFrame(data)
     # Extract the hospital number from the file name
-    hospital_number = int(filepath[-5])
+    hospital_id = hospital_number(filepath)
 
     rows = df.values.tolist()
     i = 0
@@ -86,7 +93,7 @@ def insertRecords(filepath):
         patientID = record[0]
         age = record[1]
         cholesterol = record[2]
-        hospitalID = hospital_number
+        hospitalID = hospital_id
         tomography = record[3]
 
         # Step 5: Create a New Record
@@ -118,17 +125,63 @@ def insertRecords(filepath):
     session.commit()
 
 
-# Check if the folder exists
-if os.path.exists(folder_path) and os.path.isdir(folder_path):
-    # List all files in the folder
-    file_list = os.listdir(folder_path)
-
-    # Iterate through file names
-    for file_name in file_list:
-        # Print each file name
-        print(f"Inserting {file_name}")
-        insertRecords(f"files/{file_name}")
-
-else:
-    print(f"The folder '{folder_path}' does not exist or is not a directory.")
+# Worker processes of parallel_load import this module again, so the
+# database is only reset and loaded when it runs as a script
+if __name__ == "__main__":
+    # Step 3: Reflect the Database (optional but useful to define tables)
+    metadata = MetaData()
+    metadata.reflect(bind=engine)
+
+    # Drop a Specific Table, unless imputing incrementally, which keeps
+    # the data already loaded and only replaces the hospitals that changed
+
+    if not incremental_imputation:
+        table_to_drop = Table(table_name, metadata, autoload=True, autoload_with=engine)
+        table_to_drop.drop(engine)
+
+    Base.metadata.create_all(engine)
+
+    # Check if the folder exists
+    if os.path.exists(folder_path) and os.path.isdir(folder_path):
+        # List all files in the folder
+        file_list = os.listdir(folder_path)
+        file_paths = [f"files/{file_name}" for file_name in file_list]
+
+        if incremental_imputation:
+            # The files are read by the imputation store instead of the
+            # loaders, and the table receives the imputed rows of the
+            # hospitals it imputed again, replacing their old rows
+            updated = IncrementalImpute(imputation_store).ingest_into_table(
+                engine, file_paths, batch_size
+            )
+            print(f"Imputed again the patients of hospitals {sorted(updated)}")
+        elif store_load:
+            from PatientStore import PatientStore
+
+            store = PatientStore(store_directory)
+            store.convert_files(file_paths)
+            store_insert_records(engine, store, batch_size=batch_size)
+        elif parallel_load:
+            parallel_insert_records(engine, file_paths, batch_size=batch_size)
+        else:
+            # Iterate through file names
+            for file_name in file_list:
+                # Print each file name
+                print(f"Inserting {file_name}")
+                if bulk_load:
+                    bulk_insert_records(engine, f"files/{file_name}", batch_size)
+                else:
+                    insertRecords(f"files/{file_name}")
+
+        if tune_database_schema:
+            added = tune_schema(engine)
+            print(f"Added {', '.join(added) if added else 'nothing'} to {table_name}")
+
+        if database_imputation:
+            timings = DatabaseImpute(engine, imputation_backend).impute()
+            for step, seconds in timings.items():
+                print(f"Imputed {step} in {seconds:.2f}s")
+
+    else:
+        print(f"The folder '{folder_path}' does not exist or is not a directory.")
 # MySQL database configuration
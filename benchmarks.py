@@ -0,0 +1,468 @@
+# Benchmarks for the imputation methods of PatientImputation.py
+# Run with: python benchmarks.py [benchmark ...] [--rows N ...]
+# The "suite" benchmark times every imputation method, the SQL steps and
+# the loader, and can write and check JSON lines, see run_suite.
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from PatientImputation import Impute, RegressionStatistics, majority_values
+from ParallelImputation import ParallelImpute
+from MultipleImputation import MultipleImpute
+from ImputationPlan import ImputationPlan
+from sqlalchemy import create_engine
+from DatabaseImputation import DatabaseImpute
+from PatientLoader import Base, Patient, bulk_insert_records
+from PatientSchema import check_indexes, tune_schema
+
+
+# Builds a synthetic DataFrame with the five attributes expected by Impute:
+# patientID, hospitalID, age, cholesterol, tomography, with the value
+# ranges of the files/input-hospital*.csv files.
+# Every measurement is set to np.nan with probability missing_rate, which
+# is either one rate for all of them or a dict of rates by column.
+# A fraction duplicate_rate of the rows repeat the patientID of another row,
+# at the same hospital or at another one.
+def make_patient_frame(rows, hospitals=1000, missing_rate=0.1, seed=0, duplicate_rate=0.0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(
+        {
+            "patientID": np.arange(rows),
+            "hospitalID": rng.integers(0, hospitals, rows),
+            "age": rng.integers(0, 100, rows).astype(float),
+            "cholesterol": rng.uniform(0.0, 3.0, rows),
+            "tomography": rng.uniform(0.0, 10.0, rows),
+        }
+    )
+    for column in ["age", "cholesterol", "tomography"]:
+        rate = missing_rate[column] if isinstance(missing_rate, dict) else missing_rate
+        data.loc[rng.random(rows) < rate, column] = np.nan
+    if duplicate_rate > 0:
+        duplicates = rng.random(rows) < duplicate_rate
+        data.loc[duplicates, "patientID"] = rng.choice(
+            data["patientID"].to_numpy()[~duplicates], np.count_nonzero(duplicates)
+        )
+    return data
+
+
+# Writes the rows of a DataFrame like make_patient_frame builds as hospital
+# files like files/input-hospital*.csv in directory, one per hospital.
+# Returns their paths.
+def write_hospital_files(data, directory):
+    filepaths = []
+    for hospitalID, hospital_data in data.groupby("hospitalID"):
+        filepath = os.path.join(directory, f"input-hospital{hospitalID}.csv")
+        hospital_data.rename(
+            columns={
+                "patientID": "ID",
+                "age": "Age",
+                "cholesterol": "Cholesterol",
+                "tomography": "Tomography",
+            }
+        )[["ID", "Age", "Cholesterol", "Tomography"]].to_csv(filepath, index=False)
+        filepaths.append(filepath)
+    return filepaths
+
+
+# Returns the wall time in seconds of calling function(*args)
+def time_call(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+# Row-wise implementation of Impute.impute_cholesterol before it was
+# vectorized, kept only as the baseline for benchmark_impute_cholesterol.
+def impute_cholesterol_rowwise(input_data):
+    input_data["age_bracket"] = (input_data["age"] // 5) * 5
+    min_cholesterol_per_bracket = (
+        input_data.groupby("age_bracket")["cholesterol"].min().to_dict()
+    )
+    nan_cholesterol_mask = input_data["cholesterol"].isnull()
+    input_data.loc[nan_cholesterol_mask, "cholesterol"] = input_data.loc[
+        nan_cholesterol_mask
+    ].apply(
+        lambda row: min_cholesterol_per_bracket.get(row["age_bracket"], np.nan),
+        axis=1,
+    )
+
+
+# Compares the row-wise and the vectorized age bracket imputation
+def benchmark_impute_cholesterol(rows):
+    data = make_patient_frame(rows)
+    rowwise = time_call(impute_cholesterol_rowwise, data.copy())
+    vectorized = time_call(Impute(data.copy()).impute_cholesterol)
+    print(
+        f"impute_cholesterol rows={rows}: row-wise {rowwise:.3f}s, "
+        f"vectorized {vectorized:.3f}s, speedup {rowwise / vectorized:.1f}x"
+    )
+
+
+# Per-patient majority value using Series.mode() once per group, as
+# impute_tomography did before majority_values, kept only as the baseline
+# for benchmark_majority_values. Groups without any known value are left
+# unchanged here, where the original raised an IndexError.
+def majority_values_mode(input_data, columns):
+    def get_majority_value(series):
+        mode_val = series.mode()
+        if len(mode_val) != 1 or len(series) == 1:
+            return series
+        else:
+            return mode_val.iloc[0]
+
+    return {
+        column: input_data.groupby("patientID")[column].transform(get_majority_value)
+        for column in columns
+    }
+
+
+# Compares the per-group mode and the vectorized majority vote.
+# Every patient appears three times on average.
+def benchmark_majority_values(rows):
+    data = make_patient_frame(rows)
+    data["patientID"] = data["patientID"] // 3
+    columns = ["cholesterol", "tomography"]
+    per_group = time_call(majority_values_mode, data, columns)
+    vectorized = time_call(majority_values, data, columns)
+    print(
+        f"majority_values rows={rows}: per-group mode {per_group:.3f}s, "
+        f"vectorized {vectorized:.3f}s, speedup {per_group / vectorized:.1f}x"
+    )
+
+
+# Calls impute_age and impute_cholesterol_single_hospital once per hospital
+def impute_per_hospital(patient_imputer):
+    for hospitalID in patient_imputer.input_data["hospitalID"].unique():
+        patient_imputer.impute_age(hospitalID)
+        patient_imputer.impute_cholesterol_single_hospital(hospitalID)
+
+
+# Compares the per-hospital methods called for every hospital, which only
+# touch the rows of their hospital, with the grouped all-hospital methods
+def benchmark_per_hospital(rows):
+    data = make_patient_frame(rows, hospitals=max(rows // 1000, 1))
+    per_hospital = time_call(impute_per_hospital, Impute(data.copy()))
+    patient_imputer = Impute(data.copy())
+    all_hospitals = time_call(
+        lambda: (
+            patient_imputer.impute_age_all_hospitals(),
+            patient_imputer.impute_cholesterol_all_hospitals(),
+        )
+    )
+    print(
+        f"per-hospital methods rows={rows}: once per hospital {per_hospital:.3f}s, "
+        f"all hospitals at once {all_hospitals:.3f}s"
+    )
+
+
+# Compares the per-hospital methods called for every hospital in this
+# process with the same calls split among a pool of worker processes
+def benchmark_parallel(rows):
+    data = make_patient_frame(rows, hospitals=max(rows // 1000, 1))
+    sequential = time_call(impute_per_hospital, Impute(data.copy()))
+    parallel_imputer = ParallelImpute(Impute(data.copy()))
+    parallel = time_call(
+        lambda: (
+            parallel_imputer.impute_age(),
+            parallel_imputer.impute_cholesterol_single_hospital(),
+        )
+    )
+    print(
+        f"parallel per-hospital methods rows={rows} workers={parallel_imputer.workers}: "
+        f"sequential {sequential:.3f}s, parallel {parallel:.3f}s, "
+        f"speedup {sequential / parallel:.1f}x"
+    )
+
+
+# Times drawing 100 imputed datasets and reports the memory taken by the
+# draws next to that of the frame they fill
+def benchmark_multiple_imputation(rows):
+    data = make_patient_frame(rows)
+    multiple_imputer = MultipleImpute(data, m=100)
+    seconds = time_call(multiple_imputer.impute)
+    draw_bytes = sum(draws.nbytes for _, draws in multiple_imputer.imputed.values())
+    print(
+        f"multiple imputation rows={rows} m=100: {seconds:.3f}s, "
+        f"draws {draw_bytes / 2**20:.1f} MiB, "
+        f"frame {data.memory_usage(index=True).sum() / 2**20:.1f} MiB"
+    )
+
+
+# Compares the four all-hospital strategies called one after another with
+# the same strategies run as one ImputationPlan
+def benchmark_plan(rows):
+    data = make_patient_frame(rows, duplicate_rate=0.1)
+    sequential_imputer = Impute(data.copy())
+    sequential = time_call(
+        lambda: (
+            sequential_imputer.impute_age_all_hospitals(),
+            sequential_imputer.impute_cholesterol_all_hospitals(),
+            sequential_imputer.impute_cholesterol(),
+            sequential_imputer.impute_tomography(),
+        )
+    )
+    fused = time_call(ImputationPlan(Impute(data.copy())).run)
+    print(f"imputation plan rows={rows}: sequential {sequential:.3f}s, plan {fused:.3f}s")
+
+
+# Times the per-hospital methods called again for every hospital after a
+# few measurements of 1% of the hospitals were edited, with and without the
+# statistics cache
+def benchmark_cache(rows):
+    data = make_patient_frame(rows, hospitals=max(rows // 1000, 1))
+    hospitalIDs = data["hospitalID"].unique()
+    rng = np.random.default_rng(0)
+    seconds = {}
+    for cache_size in [0, 2 * len(hospitalIDs)]:
+        patient_imputer = Impute(data.copy(), cache_size=cache_size)
+        # The writes of the first calls invalidate the statistics they used,
+        # which the second calls cache again
+        impute_per_hospital(patient_imputer)
+        impute_per_hospital(patient_imputer)
+        for hospitalID in rng.choice(hospitalIDs, max(len(hospitalIDs) // 100, 1)):
+            positions = patient_imputer.hospital_positions(hospitalID)[:5]
+            patient_imputer.set_values(positions, "cholesterol", np.nan)
+        seconds[cache_size] = time_call(impute_per_hospital, patient_imputer)
+    print(
+        f"statistics cache rows={rows} hospitals={len(hospitalIDs)}: "
+        f"without {seconds[0]:.3f}s, with {seconds[2 * len(hospitalIDs)]:.3f}s"
+    )
+
+
+# Compares fitting one tomography line per hospital in a loop with
+# impute_tomography(per_hospital=True), with 20 patients per hospital
+def benchmark_hospital_lines(rows):
+    data = make_patient_frame(rows, hospitals=max(rows // 20, 1))
+    loop = time_call(
+        lambda: {
+            hospitalID: RegressionStatistics().update(
+                hospital_data["cholesterol"], hospital_data["tomography"]
+            )
+            for hospitalID, hospital_data in data.groupby("hospitalID")
+        }
+    )
+    patient_imputer = Impute(data.copy())
+    batched = time_call(lambda: patient_imputer.impute_tomography(per_hospital=True))
+    print(
+        f"per-hospital lines rows={rows} hospitals={data['hospitalID'].nunique()}: "
+        f"fitted in a loop {loop:.3f}s, impute_tomography(per_hospital=True) {batched:.3f}s"
+    )
+
+
+# Times the four all-hospital strategies with the pandas and Polars backends
+def benchmark_polars(rows):
+    data = make_patient_frame(rows, duplicate_rate=0.1)
+    seconds = {}
+    for backend in ["pandas", "polars"]:
+        patient_imputer = Impute(data.copy(), backend=backend)
+        seconds[backend] = time_call(
+            lambda: (
+                patient_imputer.impute_age_all_hospitals(),
+                patient_imputer.impute_cholesterol_all_hospitals(),
+                patient_imputer.impute_cholesterol(),
+                patient_imputer.impute_tomography(),
+            )
+        )
+    print(
+        f"backends rows={rows}: pandas {seconds['pandas']:.3f}s, "
+        f"polars {seconds['polars']:.3f}s"
+    )
+
+
+# Times the imputation inside a SQLite database with and without the
+# indexes of tune_schema, and prints the indexes every step plans to use
+def benchmark_schema(rows):
+    data = make_patient_frame(rows, hospitals=max(rows // 1000, 1))
+    seconds = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for tuned in [False, True]:
+            engine = create_engine(f"sqlite:///{os.path.join(directory, f'{tuned}.db')}")
+            Base.metadata.create_all(engine)
+            data.to_sql(
+                Patient.__tablename__, engine, if_exists="append", index=False, chunksize=100_000
+            )
+            if tuned:
+                tune_schema(engine)
+                for step, report in check_indexes(engine).items():
+                    print(f"{step}: uses {report['used']}, missing {report['missing']}")
+            seconds[tuned] = sum(DatabaseImpute(engine).impute().values())
+            engine.dispose()
+    print(
+        f"imputation in SQLite rows={rows}: without indexes {seconds[False]:.3f}s, "
+        f"with indexes {seconds[True]:.3f}s"
+    )
+
+
+# Calls function() and returns a benchmark record with its wall time, the
+# rows it processed per second and the peak memory it allocated through
+# Python (which includes NumPy and pandas buffers, but not the memory of
+# SQLite). Anything the function prints is discarded.
+def measure(name, rows, function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "benchmark": name,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / max(seconds, 1e-9),
+        "peak_bytes": peak_bytes,
+    }
+
+
+# Times every Impute method on a fresh copy of synthetic data with the
+# given shape (see make_patient_frame), then loading its hospital files into
+# a SQLite database with bulk_insert_records and every imputation step of
+# DatabaseImpute on that database. Returns the benchmark records.
+def run_suite(rows, hospitals=None, missing_rate=0.1, duplicate_rate=0.0):
+    if hospitals is None:
+        hospitals = max(rows // 1000, 1)
+    data = make_patient_frame(
+        rows, hospitals, missing_rate=missing_rate, duplicate_rate=duplicate_rate
+    )
+    hospitalIDs = data["hospitalID"].unique()
+    methods = {
+        "impute_age": lambda imputer: [imputer.impute_age(h) for h in hospitalIDs],
+        "impute_age_all_hospitals": lambda imputer: imputer.impute_age_all_hospitals(),
+        "impute_cholesterol_single_hospital": lambda imputer: [
+            imputer.impute_cholesterol_single_hospital(h) for h in hospitalIDs
+        ],
+        "impute_cholesterol_all_hospitals": lambda imputer: (
+            imputer.impute_cholesterol_all_hospitals()
+        ),
+        "impute_cholesterol": lambda imputer: imputer.impute_cholesterol(),
+        "impute_tomography": lambda imputer: imputer.impute_tomography(),
+    }
+    records = []
+    for name, method in methods.items():
+        patient_imputer = Impute(data.copy())
+        records.append(measure(name, rows, lambda: method(patient_imputer)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepaths = write_hospital_files(data, directory)
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'patients.db')}")
+        Base.metadata.create_all(engine)
+        records.append(
+            measure(
+                "bulk_insert_records",
+                rows,
+                lambda: [bulk_insert_records(engine, filepath) for filepath in filepaths],
+            )
+        )
+        timings = {}
+        records.append(
+            measure("sql", rows, lambda: timings.update(DatabaseImpute(engine).impute()))
+        )
+        for step, seconds in timings.items():
+            records.append(
+                {
+                    "benchmark": f"sql_{step}",
+                    "rows": rows,
+                    "seconds": seconds,
+                    "rows_per_second": rows / max(seconds, 1e-9),
+                }
+            )
+        engine.dispose()
+    return records
+
+
+# Returns the records slower than their baseline record (same benchmark and
+# rows) by more than the fraction tolerance
+def find_regressions(records, baseline, tolerance=0.25):
+    baseline_seconds = {
+        (record["benchmark"], record["rows"]): record["seconds"] for record in baseline
+    }
+    return [
+        record
+        for record in records
+        if (record["benchmark"], record["rows"]) in baseline_seconds
+        and record["seconds"]
+        > baseline_seconds[(record["benchmark"], record["rows"])] * (1 + tolerance)
+    ]
+
+
+# Runs the suite with default data and prints its records
+def benchmark_suite(rows):
+    for record in run_suite(rows):
+        print(json.dumps(record))
+
+
+BENCHMARKS = {
+    "impute_cholesterol": benchmark_impute_cholesterol,
+    "majority_values": benchmark_majority_values,
+    "per_hospital": benchmark_per_hospital,
+    "parallel": benchmark_parallel,
+    "multiple_imputation": benchmark_multiple_imputation,
+    "plan": benchmark_plan,
+    "polars": benchmark_polars,
+    "cache": benchmark_cache,
+    "hospital_lines": benchmark_hospital_lines,
+    "schema": benchmark_schema,
+    "suite": benchmark_suite,
+}
+
+
+# Returns the missing rates given on the command line: one rate for all the
+# measurements, or column=rate pairs
+def missing_rates(values):
+    if len(values) == 1 and "=" not in values[0]:
+        return float(values[0])
+    rates = {"age": 0.0, "cholesterol": 0.0, "tomography": 0.0}
+    for value in values:
+        column, rate = value.split("=")
+        rates[column] = float(rate)
+    return rates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Impute methods.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000_000])
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS))
+    suite = parser.add_argument_group("suite", "Options of the suite benchmark")
+    suite.add_argument("--hospitals", type=int, help="default: one per 1000 rows")
+    suite.add_argument(
+        "--missing-rate", nargs="+", default=["0.1"], help="RATE or COLUMN=RATE ..."
+    )
+    suite.add_argument("--duplicate-rate", type=float, default=0.0)
+    suite.add_argument("--output", help="append the records as JSON lines to this file")
+    suite.add_argument("--baseline", help="JSON lines file of records to compare against")
+    suite.add_argument("--tolerance", type=float, default=0.25)
+    arguments = parser.parse_args()
+
+    regressions = []
+    for rows in arguments.rows:
+        for name in arguments.benchmarks:
+            if name != "suite":
+                BENCHMARKS[name](rows)
+                continue
+            records = run_suite(
+                rows,
+                arguments.hospitals,
+                missing_rates(arguments.missing_rate),
+                arguments.duplicate_rate,
+            )
+            for record in records:
+                print(json.dumps(record))
+            if arguments.output:
+                with open(arguments.output, "a") as output:
+                    output.writelines(json.dumps(record) + "\n" for record in records)
+            if arguments.baseline:
+                with open(arguments.baseline) as baseline:
+                    regressions += find_regressions(
+                        records, [json.loads(line) for line in baseline], arguments.tolerance
+                    )
+
+    for record in regressions:
+        print(f"Regression: {record['benchmark']} rows={record['rows']} {record['seconds']:.3f}s")
+    sys.exit(1 if regressions else 0)
@@ -12,39 +12,20 @@
 
 UPDATE PatientData pd
 JOIN (
-    SELECT 
-        a.hospitalID,
-        CASE
-            WHEN COUNT(*) % 2 = 1 THEN
-                MAX(IF(a.row_num = b.row_num, a.age, NULL))
-            ELSE
-                AVG(DISTINCT IF(a.row_num IN (b.row_num, b.row_num + 1), a.age, NULL))
-        END AS MedianAge
-    FROM
-        (
-            SELECT 
-                hospitalID, age,
-                @row_num := IF(@prev_hospital = hospitalID, @row_num + 1, 1) AS row_num,
-                @prev_hospital := hospitalID
-            FROM 
-                PatientData,
-                (SELECT @row_num := 0, @prev_hospital := NULL) AS init
-            WHERE 
-                age IS NOT NULL
-            ORDER BY 
-                hospitalID, age
-        ) AS a
-    JOIN 
-        (
-            SELECT hospitalID, CEIL(COUNT(*) / 2) AS row_num
-            FROM PatientData
-            WHERE age IS NOT NULL
-            GROUP BY hospitalID
-        ) AS b
-    ON a.hospitalID = b.hospitalID
-    GROUP BY 
-        a.hospitalID
-) AS medians
+    SELECT hospitalID, AVG(age) AS median_age
+    FROM (
+        SELECT
+            hospitalID,
+            age,
+            ROW_NUMBER() OVER (PARTITION BY hospitalID ORDER BY age) AS row_num,
+            COUNT(*) OVER (PARTITION BY hospitalID) AS ages
+        FROM PatientData
+        WHERE age IS NOT NULL
+    ) ranked
+    -- the middle age, or the two middle ones when the count is even
+    WHERE 2 * row_num BETWEEN ages AND ages + 2
+    GROUP BY hospitalID
+) medians
 ON pd.hospitalID = medians.hospitalID
-SET pd.age = medians.MedianAge
+SET pd.age = medians.median_age
 WHERE pd.age IS NULL;
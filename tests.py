@@ -4,13 +4,46 @@
 # Your implementation should anticipate ways in which these mocks
 # or tests could be more complex, as well as design mocks
 # for some disclosed but not written test cases.
+import importlib.util
+import json
+import os
+import tempfile
 import unittest
 import time
+import tracemalloc
 import timeout_decorator
 import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal
-from PatientImputation import Impute
+from sqlalchemy import create_engine
+from PatientImputation import (
+    GroupRegressionStatistics,
+    Impute,
+    RegressionStatistics,
+    compact_frame,
+    majority_values,
+)
+from MedianSketch import HistogramMedian, TDigestMedian
+from Instrumentation import Instrumentation, JsonLinesSink, PrometheusSink
+from PatientLoader import (
+    Base,
+    Patient,
+    bulk_insert_records,
+    parallel_insert_records,
+    store_insert_records,
+)
+from PatientStore import PatientStore
+from StreamingImputation import StreamingImpute, csv_chunks
+from IncrementalImputation import IncrementalImpute
+from DatabaseImputation import DatabaseImpute, STEPS
+from ImputationPlan import ImputationPlan
+from PatientSchema import INDEXES, check_indexes, tune_schema
+from ParallelImputation import ParallelImpute
+from MultipleImputation import MultipleImpute, rubin_pool
+from ImputationKernels import group_codes, group_majority, group_mean, group_median, group_min
+
+# The polars backend is optional
+HAS_POLARS = importlib.util.find_spec("polars") is not None
 
 
 # Straight-forward case: single value median
@@ -416,5 +449,1179 @@ class TestCase19(unittest.TestCase):
         assert_frame_equal(expected_output_frame, actual_output_frame)
 
 
+# all hospitals at once matches one impute_age call per hospital
+class TestCase20(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_median_age_all_hospitals(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [0, 1, 2, 3, 4, 5, 6],
+                "hospitalID": [2, 1, 2, 1, 1, 3, 2],
+                "age": [15.0, np.nan, np.nan, 20.0, 20.2, np.nan, 17.0],
+                "cholesterol": [0.0, 42.0, np.nan, 10.0, 15.0, np.nan, 3.0],
+                "tomography": [0.0, 12.0, 100.0, np.nan, np.nan, np.nan, 1.0],
+            }
+        )
+        patient_imputer = Impute(input_frame)
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "patientID": [1, 2],
+                "hospitalID": [1, 2],
+                "age": [20.1, 16.0],
+                "cholesterol": [42.0, np.nan],
+                "tomography": [12.0, 100.0],
+            }
+        )
+
+        assert_frame_equal(
+            expected_output_frame, patient_imputer.impute_age_all_hospitals()
+        )
+        self.assertTrue(np.isnan(input_frame.loc[5, "age"]))
+
+
+# restricting the bulk mode to a list of hospitals
+class TestCase21(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_median_age_all_hospitals(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [0, 1, 2, 3, 4],
+                "hospitalID": [2, 1, 2, 1, 1],
+                "age": [15.0, np.nan, np.nan, 20.0, 21.0],
+                "cholesterol": [0.0, 42.0, np.nan, 10.0, 15.0],
+                "tomography": [0.0, 12.0, 100.0, np.nan, np.nan],
+            }
+        )
+        bulk_output = Impute(input_frame.copy()).impute_age_all_hospitals([2])
+        single_output = Impute(input_frame.copy()).impute_age(2)
+
+        assert_frame_equal(single_output, bulk_output.drop(columns="hospitalID"))
+
+
+# all hospitals at once matches one call per hospital
+class TestCase22(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_average_cholesterol_all_hospitals(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [0, 1, 2, 3, 4, 5, 6, 7],
+                "hospitalID": [10, 20, 10, 20, 10, 20, 30, np.nan],
+                "age": [24.0, 24.0, 24.0, 24.0, 15.0, np.nan, 24.0, 24.0],
+                "cholesterol": [4.0, 1.0, np.nan, np.nan, np.nan, np.nan, np.nan, 9.0],
+                "tomography": [0.0, 12.0, 100.0, 87.0, 5.0, 6.0, 7.0, 8.0],
+            }
+        )
+        patient_imputer = Impute(input_frame.copy())
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "patientID": [2, 3],
+                "hospitalID": [10.0, 20.0],
+                "age": [24.0, 24.0],
+                "cholesterol": [4.0, 1.0],
+                "tomography": [100.0, 87.0],
+            }
+        )
+
+        assert_frame_equal(
+            expected_output_frame, patient_imputer.impute_cholesterol_all_hospitals()
+        )
+
+        sequential_imputer = Impute(input_frame.copy())
+        for hospitalID in [10, 20, 30]:
+            sequential_imputer.impute_cholesterol_single_hospital(hospitalID)
+        assert_frame_equal(sequential_imputer.input_data, patient_imputer.input_data)
+
+
+# majority value per patient: ties, single rows and unknown values
+class TestCase23(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_majority_values(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [1, 1, 2, 2, 2, 3, 4, 4, 4, 5, 5],
+                "cholesterol": [1.0, 2.0, 3.0, 3.0, 4.0, 7.0, np.nan, 5.0, 5.0, np.nan, np.nan],
+                "tomography": [5.0, 5.0, 6.0, 7.0, 8.0, 9.0, 1.0, 2.0, 3.0, 4.0, 4.0],
+            }
+        )
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "cholesterol": [1.0, 2.0, 3.0, 3.0, 3.0, 7.0, 5.0, 5.0, 5.0, np.nan, np.nan],
+                "tomography": [5.0, 5.0, 6.0, 7.0, 8.0, 9.0, 1.0, 2.0, 3.0, 4.0, 4.0],
+            }
+        )
+
+        assert_frame_equal(
+            expected_output_frame,
+            majority_values(input_frame, ["cholesterol", "tomography"]),
+        )
+        self.assertEqual(input_frame.loc[4, "cholesterol"], 4.0)
+
+
+# regression statistics merged over chunks match a single pass
+class TestCase24(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_regression_statistics(self):
+        cholesterol = np.array([0.0, 1.0, np.nan, 2.0, 3.0, 4.0, 5.0])
+        tomography = np.array([1.0, 3.2, 4.0, 4.9, np.nan, 9.1, 11.0])
+
+        single_pass = RegressionStatistics().update(cholesterol, tomography)
+        chunked = RegressionStatistics().update(cholesterol[:3], tomography[:3])
+        chunked.merge(RegressionStatistics().update(cholesterol[3:], tomography[3:]))
+
+        slope, intercept = np.polyfit([0.0, 1.0, 2.0, 4.0, 5.0], [1.0, 3.2, 4.9, 9.1, 11.0], 1)
+        self.assertEqual(single_pass.count, 5)
+        self.assertAlmostEqual(single_pass.slope(), slope)
+        self.assertAlmostEqual(single_pass.intercept(), intercept)
+        self.assertAlmostEqual(chunked.slope(), slope)
+        self.assertAlmostEqual(chunked.intercept(), intercept)
+
+
+# constant x-values: horizontal line through the mean of the y-values
+class TestCase25(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_tomography(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [0, 1, 2],
+                "hospitalID": [0, 0, 1],
+                "age": [19.0, 24.0, 20.0],
+                "cholesterol": [0.1, 0.1, 0.1],
+                "tomography": [1.0, 2.0, np.nan],
+            }
+        )
+        patient_imputer = Impute(input_frame)
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "patientID": [2],
+                "hospitalID": [1],
+                "age": [20.0],
+                "cholesterol": [0.1],
+                "tomography": [1.5],
+            }
+        )
+
+        assert_frame_equal(expected_output_frame, patient_imputer.impute_tomography())
+
+
+# changed rows are tracked without copying the frame: the peak memory of
+# impute_tomography stays well below the size of a wide input frame
+class TestCase26(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_tomography_peak_memory(self):
+        rows = 20000
+        rng = np.random.default_rng(0)
+        input_frame = pd.DataFrame(
+            {
+                "patientID": np.arange(rows) // 2,
+                "hospitalID": rng.integers(0, 10, rows),
+                "age": rng.integers(0, 100, rows).astype(float),
+                "cholesterol": rng.uniform(0.0, 3.0, rows),
+                "tomography": np.where(rng.random(rows) < 0.1, np.nan, 1.0),
+            }
+        )
+        extra_columns = pd.DataFrame(
+            np.zeros((rows, 100)), columns=[f"extra{i}" for i in range(100)]
+        )
+        input_frame = pd.concat([input_frame, extra_columns], axis=1).copy()
+        frame_size = input_frame.memory_usage().sum()
+        patient_imputer = Impute(input_frame)
+
+        tracemalloc.start()
+        try:
+            changed_rows = patient_imputer.impute_tomography()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertFalse(changed_rows.empty)
+        self.assertLess(peak, frame_size / 2)
+
+
+# sanitization fills the unknown tomography of a row whose known
+# cholesterol it also changes: the row is returned once with both values
+class TestCase27(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_tomography(self):
+        input_frame = pd.DataFrame(
+            {
+                "patientID": [1, 1, 1, 2, 3],
+                "hospitalID": [0, 0, 1, 1, 2],
+                "age": [19.0, 19.0, 24.0, np.nan, 20.0],
+                "cholesterol": [5.0, 5.0, 7.0, 100.0, 0.0],
+                "tomography": [10.0, 10.0, np.nan, 200.0, 0.0],
+            }
+        )
+        patient_imputer = Impute(input_frame)
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "patientID": [1],
+                "hospitalID": [1],
+                "age": [24.0],
+                "cholesterol": [5.0],
+                "tomography": [10.0],
+            }
+        )
+
+        assert_frame_equal(expected_output_frame, patient_imputer.impute_tomography())
+
+
+# Builds a frame sorted by patientID, with patients spread over several
+# hospitals and missing values in every measurement. Cholesterol values
+# are multiples of 0.25 so that their sums are exact.
+def make_sorted_patient_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    input_frame = pd.DataFrame(
+        {
+            "patientID": np.sort(rng.integers(0, rows // 3, rows)),
+            "hospitalID": rng.integers(0, 8, rows),
+            "age": rng.integers(0, 40, rows).astype(float),
+            "cholesterol": rng.integers(0, 12, rows) / 4,
+            "tomography": rng.integers(0, 10, rows).astype(float),
+        }
+    )
+    for column in ["age", "cholesterol", "tomography"]:
+        input_frame.loc[rng.random(rows) < 0.3, column] = np.nan
+    return input_frame
+
+
+# Imputes input_frame in memory with the strategies of StreamingImpute
+def impute_sequentially(input_frame):
+    patient_imputer = Impute(input_frame.copy())
+    patient_imputer.impute_age_all_hospitals()
+    patient_imputer.impute_cholesterol_all_hospitals()
+    patient_imputer.impute_cholesterol()
+    patient_imputer.impute_tomography()
+    return patient_imputer.input_data
+
+
+# streaming over small CSV chunks matches the in-memory imputation
+class TestCase28(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_streaming_impute(self):
+        input_frame = make_sorted_patient_frame(3000)
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "input.csv")
+            output_path = os.path.join(directory, "output.csv")
+            input_frame.to_csv(input_path, index=False)
+
+            rows = StreamingImpute(csv_chunks(input_path, chunksize=97)).run(output_path)
+            output_frame = pd.read_csv(output_path)
+
+        self.assertEqual(rows, len(input_frame))
+        assert_frame_equal(impute_sequentially(input_frame), output_frame)
+
+
+# tomography sanitization needs the rows of each patient together
+class TestCase29(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_streaming_impute_unsorted(self):
+        input_frame = make_sorted_patient_frame(300).iloc[::-1]
+        chunks = [input_frame.iloc[:150], input_frame.iloc[150:]]
+
+        streaming_imputer = StreamingImpute(lambda: iter(chunks))
+        with self.assertRaises(ValueError):
+            list(streaming_imputer.impute_chunks())
+
+        age_only = StreamingImpute(lambda: iter(chunks), steps=["age"])
+        patient_imputer = Impute(input_frame.copy().reset_index(drop=True))
+        patient_imputer.impute_age_all_hospitals()
+        assert_frame_equal(
+            patient_imputer.input_data,
+            pd.concat(age_only.impute_chunks(), ignore_index=True),
+        )
+
+
+# exact histogram medians merged over chunks match pandas
+class TestCase30(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_histogram_median(self):
+        rng = np.random.default_rng(0)
+        hospitals = rng.integers(0, 50, 5000)
+        ages = rng.integers(0, 100, 5000).astype(float)
+        ages[rng.random(5000) < 0.2] = np.nan
+        ages[:10] = 20.2
+
+        first = HistogramMedian().update(hospitals[:2000], ages[:2000])
+        second = HistogramMedian().update(hospitals[2000:], ages[2000:])
+        medians = first.merge(second).medians()
+
+        expected = pd.Series(ages).groupby(hospitals).median()
+        np.testing.assert_array_equal(expected.to_numpy(), medians[expected.index].to_numpy())
+
+
+# t-digest medians: exact for small groups, close for large ones
+class TestCase31(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_tdigest_median(self):
+        small = TDigestMedian().update([1, 1, 1, 2, 2, 2, 2], [15.0, 16.1, 35.0, 1.0, 2.0, 3.0, np.nan])
+        self.assertEqual(small.medians().to_dict(), {1: 16.1, 2: 2.0})
+
+        rng = np.random.default_rng(0)
+        hospitals = rng.integers(0, 5, 50000)
+        ages = rng.normal(50.0, 15.0, 50000)
+        sketch = TDigestMedian(compression=500).update(hospitals[:20000], ages[:20000])
+        sketch.merge(TDigestMedian(compression=500).update(hospitals[20000:], ages[20000:]))
+
+        expected = pd.Series(ages).groupby(hospitals).median()
+        np.testing.assert_allclose(
+            expected.to_numpy(), sketch.medians()[expected.index].to_numpy(), atol=0.5
+        )
+        self.assertLessEqual(len(sketch.weights), 5 * (500 // 2 + 1))
+
+
+# Creates an in-memory SQLite database with an empty PatientData table
+def make_patient_database():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+# Returns the PatientData table of the database sorted by its primary key
+def read_patient_table(engine):
+    return pd.read_sql_table(Patient.__tablename__, engine).sort_values(
+        ["hospitalID", "patientID"], ignore_index=True
+    )
+
+
+# bulk loading merges duplicate patients filling only unknown fields,
+# and keeps the known fields of patients already in the table
+class TestCase32(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_bulk_insert_records(self):
+        engine = make_patient_database()
+        with engine.begin() as connection:
+            connection.execute(
+                Patient.__table__.insert(),
+                [{"patientID": 9, "hospitalID": 12, "age": None, "cholesterol": 1.0, "tomography": None}],
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "input-hospital12.csv")
+            pd.DataFrame(
+                {
+                    "ID": [5, 7, 5, 9, 5],
+                    "Age": [np.nan, 30.0, 40.0, 50.0, 60.0],
+                    "Cholesterol": [2.0, np.nan, 3.0, 4.0, np.nan],
+                    "Tomography": [np.nan, np.nan, np.nan, 6.0, 8.0],
+                }
+            ).to_csv(filepath, index=False)
+
+            rows, elapsed = bulk_insert_records(engine, filepath, batch_size=2)
+
+        expected_output_frame = pd.DataFrame(
+            {
+                "patientID": [5, 7, 9],
+                "hospitalID": [12, 12, 12],
+                "age": [40.0, 30.0, 50.0],
+                "cholesterol": [2.0, np.nan, 1.0],
+                "tomography": [8.0, np.nan, 6.0],
+            }
+        )
+
+        self.assertEqual(rows, 5)
+        assert_frame_equal(expected_output_frame, read_patient_table(engine))
+
+
+# parallel loading gives the same table as loading the files one by one,
+# including two files of the same hospital
+class TestCase33(unittest.TestCase):
+    @timeout_decorator.timeout(60)
+    def test_parallel_insert_records(self):
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as directory:
+            filepaths = []
+            for index, hospitalID in enumerate([1, 2, 3, 2]):
+                os.mkdir(os.path.join(directory, str(index)))
+                filepath = os.path.join(directory, str(index), f"input-hospital{hospitalID}.csv")
+                values = rng.integers(0, 5, (40, 3)).astype(float)
+                values[rng.random((40, 3)) < 0.4] = np.nan
+                pd.DataFrame(
+                    {
+                        "ID": rng.integers(0, 20, 40),
+                        "Age": values[:, 0],
+                        "Cholesterol": values[:, 1],
+                        "Tomography": values[:, 2],
+                    }
+                ).to_csv(filepath, index=False)
+                filepaths.append(filepath)
+
+            sequential_engine = create_engine(f"sqlite:///{directory}/sequential.db")
+            Base.metadata.create_all(sequential_engine)
+            for filepath in filepaths:
+                bulk_insert_records(sequential_engine, filepath, batch_size=7)
+
+            parallel_engine = create_engine(f"sqlite:///{directory}/parallel.db")
+            Base.metadata.create_all(parallel_engine)
+            rows, elapsed = parallel_insert_records(
+                parallel_engine, filepaths, processes=2, threads=3, batch_size=7
+            )
+
+            self.assertEqual(rows, 160)
+            assert_frame_equal(
+                read_patient_table(sequential_engine), read_patient_table(parallel_engine)
+            )
+            sequential_engine.dispose()
+            parallel_engine.dispose()
+
+
+# updating the changed hospitals of a store gives the same imputation as
+# imputing all the hospitals again, without touching unrelated hospitals
+class TestCase34(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_incremental_impute(self):
+        input_frame = make_sorted_patient_frame(3000)
+        isolated_frame = pd.DataFrame(
+            {
+                "patientID": [10000, 10001],
+                "hospitalID": [100, 100],
+                "age": [30.0, 31.0],
+                "cholesterol": [1.0, 2.0],
+                "tomography": [np.nan, 4.0],
+            }
+        )
+        changed_frame = make_sorted_patient_frame(300, seed=1)
+        changed_frame["hospitalID"] = 3
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = IncrementalImpute(directory)
+            store.update(
+                {
+                    hospitalID: hospital_frame
+                    for hospitalID, hospital_frame in input_frame.groupby("hospitalID")
+                }
+            )
+            store.update({100: isolated_frame})
+            full_frame = pd.concat([input_frame, isolated_frame])
+            assert_frame_equal(
+                impute_sequentially(
+                    full_frame.sort_values("hospitalID", kind="stable").reset_index(drop=True)
+                ),
+                store.load(),
+            )
+
+            updated = IncrementalImpute(directory).update({3: changed_frame})
+            full_frame = pd.concat(
+                [full_frame[full_frame["hospitalID"] != 3], changed_frame]
+            )
+            self.assertIn(3, updated)
+            self.assertNotIn(100, updated)
+            assert_frame_equal(
+                impute_sequentially(
+                    full_frame.sort_values("hospitalID", kind="stable").reset_index(drop=True)
+                ),
+                IncrementalImpute(directory).load(),
+            )
+
+
+# files converted once to a PatientStore load the same table as the CSV
+# files, and a single hospital is read from its own memory-mapped partition
+class TestCase35(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_patient_store(self):
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as directory:
+            filepaths = []
+            for index, hospitalID in enumerate([1, 2, 2]):
+                os.mkdir(os.path.join(directory, str(index)))
+                filepath = os.path.join(directory, str(index), f"input-hospital{hospitalID}.csv")
+                values = rng.random((40, 3))
+                values[rng.random((40, 3)) < 0.4] = np.nan
+                pd.DataFrame(
+                    {
+                        "ID": rng.integers(0, 20, 40),
+                        "Age": values[:, 0],
+                        "Cholesterol": values[:, 1],
+                        "Tomography": values[:, 2],
+                    }
+                ).to_csv(filepath, index=False)
+                filepaths.append(filepath)
+
+            csv_engine = create_engine(f"sqlite:///{directory}/csv.db")
+            Base.metadata.create_all(csv_engine)
+            for filepath in filepaths:
+                bulk_insert_records(csv_engine, filepath)
+
+            store = PatientStore(os.path.join(directory, "store"), measurement_type="float64")
+            self.assertEqual(store.convert_files(filepaths), {1, 2})
+            self.assertEqual(store.convert_files(filepaths), set())
+            store_engine = create_engine(f"sqlite:///{directory}/store.db")
+            Base.metadata.create_all(store_engine)
+            store_insert_records(store_engine, store)
+
+            assert_frame_equal(
+                read_patient_table(csv_engine), read_patient_table(store_engine)
+            )
+            csv_engine.dispose()
+            store_engine.dispose()
+
+            hospital_frame = store.read([2], columns=["patientID", "age"])
+            self.assertEqual(list(hospital_frame.columns), ["patientID", "age"])
+            self.assertEqual(hospital_frame["patientID"].dtype, np.int32)
+            self.assertFalse(hospital_frame["age"].to_numpy().flags.writeable)
+
+            # Files that left the input set drop their partitions and entries
+            stale_store = PatientStore(os.path.join(directory, "stale"), measurement_type="float64")
+            stale_store.convert_files(filepaths)
+            self.assertEqual(stale_store.convert_files(filepaths[1:2]), {1, 2})
+            self.assertEqual(stale_store.hospitals(), [2])
+            self.assertEqual(list(stale_store.manifest), filepaths[1:2])
+            reopened_store = PatientStore(os.path.join(directory, "stale"))
+            self.assertEqual(list(reopened_store.manifest), filepaths[1:2])
+            fresh_store = PatientStore(os.path.join(directory, "fresh"), measurement_type="float64")
+            fresh_store.convert_files(filepaths[1:2])
+            assert_frame_equal(fresh_store.read(), stale_store.read())
+
+            compact_store = PatientStore(os.path.join(directory, "compact"), file_format="parquet")
+            compact_store.convert_files(filepaths)
+            input_frame = store.read().astype({"patientID": int, "hospitalID": int})
+            compact_imputer = Impute.from_store(compact_store)
+            self.assertEqual(compact_imputer.input_data["age"].dtype, np.float32)
+            assert_frame_equal(
+                impute_sequentially(input_frame),
+                impute_sequentially(compact_imputer.input_data).astype(
+                    {"patientID": int, "hospitalID": int}
+                ).astype({column: float for column in ["age", "cholesterol", "tomography"]}),
+                rtol=1e-5,
+            )
+
+
+# compact dtypes take at most half the memory and impute the same values
+# within float32 tolerance, with np.nan or with nullable dtypes
+class TestCase36(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_compact_dtypes(self):
+        input_frame = make_sorted_patient_frame(3000)
+        expected_output_frame = impute_sequentially(input_frame)
+
+        for nullable in [False, True]:
+            patient_imputer = Impute(input_frame.copy(), compact=True, nullable=nullable)
+            self.assertEqual(patient_imputer.input_data["hospitalID"].dtype.itemsize, 2)
+            if not nullable:
+                self.assertLessEqual(
+                    patient_imputer.memory_footprint(), Impute(input_frame).memory_footprint() / 2
+                )
+
+            patient_imputer.impute_age_all_hospitals()
+            patient_imputer.impute_cholesterol_all_hospitals()
+            patient_imputer.impute_cholesterol()
+            tomography_output = patient_imputer.impute_tomography()
+            self.assertEqual(tomography_output["patientID"].dtype.itemsize, 4)
+            assert_frame_equal(
+                expected_output_frame,
+                patient_imputer.input_data.astype(
+                    {"patientID": "int64", "hospitalID": "int64"}
+                ).astype({column: "float64" for column in ["age", "cholesterol", "tomography"]}),
+                rtol=1e-6,
+            )
+
+    def test_compact_frame_validation(self):
+        input_frame = make_sorted_patient_frame(30)
+        with self.assertRaises(ValueError):
+            compact_frame(input_frame.drop(columns="tomography"))
+        with self.assertRaises(ValueError):
+            compact_frame(input_frame.assign(hospitalID=40000))
+        with self.assertRaises(ValueError):
+            compact_frame(input_frame.assign(patientID=0.5))
+        with self.assertRaises(ValueError):
+            compact_frame(input_frame.assign(hospitalID=np.nan))
+        self.assertEqual(
+            compact_frame(input_frame.assign(hospitalID=np.nan), nullable=True)["hospitalID"].dtype,
+            "Int16",
+        )
+
+
+# per-hospital methods use the hospital index, which stays valid across
+# their writes and is rebuilt when input_data is replaced
+class TestCase37(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_hospital_positions(self):
+        input_frame = make_sorted_patient_frame(3000)
+        input_frame["hospitalID"] = np.random.default_rng(1).integers(0, 400, 3000)
+
+        per_hospital_imputer = Impute(input_frame.copy())
+        for hospitalID in input_frame["hospitalID"].unique():
+            per_hospital_imputer.impute_age(hospitalID)
+        for hospitalID in input_frame["hospitalID"].unique():
+            per_hospital_imputer.impute_cholesterol_single_hospital(hospitalID)
+
+        all_hospitals_imputer = Impute(input_frame.copy())
+        all_hospitals_imputer.impute_age_all_hospitals()
+        all_hospitals_imputer.impute_cholesterol_all_hospitals()
+        assert_frame_equal(all_hospitals_imputer.input_data, per_hospital_imputer.input_data)
+
+        per_hospital_imputer.input_data = input_frame.iloc[::-1].reset_index(drop=True)
+        np.testing.assert_array_equal(
+            per_hospital_imputer.hospital_positions(7),
+            np.flatnonzero(per_hospital_imputer.input_data["hospitalID"] == 7),
+        )
+        self.assertEqual(len(per_hospital_imputer.hospital_positions(1000)), 0)
+
+
+# the parallel executor writes the same cells and returns the same rows,
+# in the same order, as calling the per-hospital methods one at a time
+class TestCase38(unittest.TestCase):
+    @timeout_decorator.timeout(60)
+    def test_parallel_impute(self):
+        input_frame = make_sorted_patient_frame(3000)
+        input_frame["hospitalID"] = np.random.default_rng(2).integers(0, 50, 3000)
+        hospitalIDs = list(input_frame["hospitalID"].unique())
+
+        per_hospital_imputer = Impute(input_frame.copy())
+        expected_age = pd.concat(
+            [per_hospital_imputer.impute_age(hospitalID) for hospitalID in hospitalIDs]
+        ).reset_index(drop=True)
+        expected_cholesterol = pd.concat(
+            [
+                per_hospital_imputer.impute_cholesterol_single_hospital(hospitalID)
+                for hospitalID in hospitalIDs
+            ]
+        ).reset_index(drop=True)
+
+        for workers in [1, 3]:
+            patient_imputer = Impute(input_frame.copy())
+            parallel_imputer = ParallelImpute(patient_imputer, workers=workers)
+            assert_frame_equal(
+                expected_age, parallel_imputer.impute_age(), check_dtype=False
+            )
+            assert_frame_equal(
+                expected_cholesterol,
+                parallel_imputer.impute_cholesterol_single_hospital(),
+                check_dtype=False,
+            )
+            assert_frame_equal(per_hospital_imputer.input_data, patient_imputer.input_data)
+
+        # Unknown hospitals are skipped
+        patient_imputer = Impute(input_frame.copy())
+        self.assertEqual(len(ParallelImpute(patient_imputer, 2).impute_age([1000])), 0)
+
+
+# every draw fills the unknown cells only, with values drawn from the
+# right groups, the same seed gives the same draws, and Rubin's rules
+# pool the per-draw estimates
+class TestCase39(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_multiple_impute(self):
+        input_frame = make_sorted_patient_frame(3000)
+        input_frame.loc[input_frame["hospitalID"] == 5, "age"] = np.nan
+        multiple_imputer = MultipleImpute(input_frame, m=20, seed=3).impute()
+
+        age_positions, age_draws = multiple_imputer.imputed["age"]
+        self.assertEqual(age_draws.shape, (20, len(age_positions)))
+        for position, ages in zip(age_positions, age_draws.T):
+            hospitalID = input_frame["hospitalID"].iloc[position]
+            known_ages = input_frame.loc[input_frame["hospitalID"] == hospitalID, "age"]
+            if hospitalID == 5:
+                self.assertTrue(np.isnan(ages).all())
+            else:
+                self.assertTrue(np.isin(ages, known_ages.dropna()).all())
+
+        for draw in [0, 19]:
+            imputed_data = multiple_imputer.dataset(draw)
+            known = input_frame.notnull()
+            assert_frame_equal(imputed_data[known], input_frame[known])
+            self.assertFalse(imputed_data.loc[input_frame["hospitalID"] != 5].isnull().any().any())
+        self.assertFalse(
+            np.array_equal(multiple_imputer.dataset(0), multiple_imputer.dataset(1))
+        )
+
+        same_seed = MultipleImpute(input_frame, m=20, seed=3).impute()
+        for column, (positions, draws) in multiple_imputer.imputed.items():
+            np.testing.assert_array_equal(same_seed.imputed[column][1], draws)
+
+        pooled = multiple_imputer.pooled_mean("tomography")
+        means = [multiple_imputer.dataset(draw)["tomography"].mean() for draw in range(20)]
+        self.assertAlmostEqual(pooled["estimate"], np.mean(means))
+        self.assertAlmostEqual(pooled["between"], np.var(means, ddof=1))
+
+        # A single draw has no between-imputation variance; a single value
+        # has no sample variance
+        single_draw = MultipleImpute(input_frame, m=1, seed=3).impute()
+        self.assertEqual(single_draw.pooled_mean("tomography")["between"], 0.0)
+        single_value = input_frame.iloc[:3].assign(tomography=[np.nan, 5.0, np.nan])
+        single_value["cholesterol"] = np.nan
+        with self.assertRaises(ValueError):
+            MultipleImpute(single_value, m=3).impute().pooled_mean("tomography")
+
+        pooled = rubin_pool([1.0, 2.0, 3.0], [0.5, 0.5, 0.5])
+        self.assertEqual(pooled["estimate"], 2.0)
+        self.assertEqual(pooled["between"], 1.0)
+        self.assertAlmostEqual(pooled["total"], 0.5 + 4 / 3)
+
+
+# imputing the table inside the database gives the same table as the
+# Impute methods, including duplicate patients across hospitals and a
+# hospital without any known age
+class TestCase40(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_database_impute(self):
+        input_frame = make_sorted_patient_frame(3000).drop_duplicates(
+            ["patientID", "hospitalID"], ignore_index=True
+        )
+        input_frame.loc[input_frame["hospitalID"] == 4, "age"] = np.nan
+
+        tables = []
+        for backend in ["database", "pandas"]:
+            engine = make_patient_database()
+            input_frame.to_sql(Patient.__tablename__, engine, if_exists="append", index=False)
+            timings = DatabaseImpute(engine, backend).impute()
+            self.assertTrue(set(STEPS) <= set(timings))
+            tables.append(read_patient_table(engine))
+
+        assert_frame_equal(tables[1], tables[0])
+        self.assertLess(tables[0]["tomography"].isnull().sum(), input_frame["tomography"].isnull().sum())
+        with self.assertRaises(ValueError):
+            DatabaseImpute(make_patient_database(), "spark")
+
+
+# tuning the schema adds the age_bracket column and the indexes once, the
+# imputation steps plan to use them, and the imputed table is unchanged
+class TestCase41(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_tune_schema(self):
+        input_frame = make_sorted_patient_frame(3000).drop_duplicates(
+            ["patientID", "hospitalID"], ignore_index=True
+        )
+        tables = []
+        for tuned in [False, True]:
+            engine = make_patient_database()
+            input_frame.to_sql(Patient.__tablename__, engine, if_exists="append", index=False)
+            if tuned:
+                self.assertTrue(check_indexes(engine)["cholesterol"]["missing"])
+                self.assertEqual(tune_schema(engine), ["age_bracket"] + list(INDEXES))
+                self.assertEqual(tune_schema(engine), [])
+                for step, report in check_indexes(engine).items():
+                    self.assertEqual(report["missing"], [], step)
+            DatabaseImpute(engine).impute()
+            tables.append(read_patient_table(engine)[input_frame.columns])
+
+        assert_frame_equal(tables[0], tables[1])
+
+
+# instrumentation records every stage of the methods to its sinks
+# without changing their results
+class TestCase42(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_instrumentation(self):
+        input_frame = make_sorted_patient_frame(3000)
+        prometheus = PrometheusSink()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stages.jsonl")
+            instrumentation = Instrumentation(
+                prometheus, JsonLinesSink(path), trace_memory=True
+            )
+            patient_imputer = Impute(input_frame.copy(), instrumentation=instrumentation)
+            changed_rows = patient_imputer.impute_age_all_hospitals()
+            changed_rows = patient_imputer.impute_tomography()
+            with open(path) as records:
+                records = [json.loads(line) for line in records]
+        tracemalloc.stop()
+
+        self.assertEqual(
+            [(record["method"], record["stage"]) for record in records],
+            [
+                ("impute_age_all_hospitals", "statistics"),
+                ("impute_age_all_hospitals", "fill"),
+                ("impute_age_all_hospitals", "changed_rows"),
+                ("impute_tomography", "sanitization"),
+                ("impute_tomography", "fit"),
+                ("impute_tomography", "predict"),
+                ("impute_tomography", "changed_rows"),
+            ],
+        )
+        self.assertEqual(records[1]["rows_changed"], input_frame["age"].isnull().sum())
+        # a row can be both sanitized and predicted
+        self.assertGreaterEqual(
+            records[3]["rows_changed"] + records[5]["rows_changed"], len(changed_rows)
+        )
+        self.assertEqual(records[6]["rows_scanned"], records[3]["rows_changed"] + records[5]["rows_changed"])
+        self.assertTrue(all(record["allocated_bytes"] is not None for record in records))
+        self.assertIn(
+            'impute_stage_calls_total{method="impute_tomography",stage="fit"} 1',
+            prometheus.text(),
+        )
+
+        # Without instrumentation, the stages share one stage that keeps nothing
+        plain_imputer = Impute(input_frame.copy())
+        plain_imputer.impute_age_all_hospitals()
+        assert_frame_equal(changed_rows, plain_imputer.impute_tomography())
+        self.assertEqual(plain_imputer.stage("impute_tomography", "fit").rows_changed, 0)
+
+
+# a plan leaves the frame exactly as the sequential Impute calls, for any
+# order of the steps, and reports every changed cell once
+class TestCase43(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_imputation_plan(self):
+        input_frame = make_sorted_patient_frame(3000)
+        for steps in [STEPS, ["cholesterol", "age", "tomography"], ["tomography"]]:
+            for frame in [input_frame, compact_frame(input_frame)]:
+                sequential_imputer = Impute(frame.copy())
+                methods = {
+                    "age": sequential_imputer.impute_age_all_hospitals,
+                    "cholesterol_single_hospital": sequential_imputer.impute_cholesterol_all_hospitals,
+                    "cholesterol": sequential_imputer.impute_cholesterol,
+                    "tomography": sequential_imputer.impute_tomography,
+                }
+                for step in steps:
+                    methods[step]()
+
+                patient_imputer = Impute(frame.copy())
+                report = ImputationPlan(patient_imputer, steps).run()
+                assert_frame_equal(sequential_imputer.input_data, patient_imputer.input_data)
+
+                self.assertFalse(report.duplicated(["position", "column"]).any())
+                for column in ["age", "cholesterol", "tomography"]:
+                    cells = report[report["column"] == column]
+                    np.testing.assert_array_equal(
+                        cells["new_value"],
+                        patient_imputer.input_data[column].to_numpy()[cells["position"]],
+                    )
+                    self.assertEqual(
+                        len(cells),
+                        np.count_nonzero(
+                            ~(frame[column].isnull() & patient_imputer.input_data[column].isnull())
+                            & (frame[column] != patient_imputer.input_data[column])
+                        ),
+                    )
+        with self.assertRaises(ValueError):
+            ImputationPlan(Impute(input_frame), ["median"])
+
+
+# the Polars backend returns the same changed rows and leaves the same data
+# as the pandas one, also under fused and parallel imputations
+@unittest.skipUnless(HAS_POLARS, "polars is not installed")
+class TestCase44(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_polars_backend(self):
+        input_frame = make_sorted_patient_frame(3000)
+        # A hospital where no age is known
+        input_frame.loc[input_frame["hospitalID"] == 3, "age"] = np.nan
+        calls = [
+            ("impute_age", [2]),
+            ("impute_age", [3]),
+            ("impute_cholesterol_single_hospital", [1]),
+            ("impute_age_all_hospitals", []),
+            ("impute_cholesterol_all_hospitals", []),
+            ("impute_cholesterol", []),
+            ("impute_tomography", []),
+        ]
+        for frame in [input_frame, compact_frame(input_frame)]:
+            reference_imputer = Impute(frame.copy())
+            patient_imputer = Impute(frame.copy(), backend="polars")
+            self.assertIsInstance(patient_imputer, Impute)
+            for method, arguments in calls:
+                assert_frame_equal(
+                    getattr(reference_imputer, method)(*arguments).reset_index(drop=True),
+                    getattr(patient_imputer, method)(*arguments),
+                )
+                assert_frame_equal(reference_imputer.input_data, patient_imputer.input_data)
+
+        # Fused and parallel imputations write into the Polars data
+        reference_imputer = Impute(input_frame.copy())
+        patient_imputer = Impute(input_frame.copy(), backend="polars")
+        assert_frame_equal(
+            ImputationPlan(reference_imputer).run(), ImputationPlan(patient_imputer).run()
+        )
+        assert_frame_equal(reference_imputer.input_data, patient_imputer.input_data)
+        reference_imputer = Impute(input_frame.copy())
+        patient_imputer = Impute(input_frame.copy(), backend="polars")
+        for imputer in [reference_imputer, patient_imputer]:
+            ParallelImpute(imputer, workers=2).impute_age()
+        assert_frame_equal(reference_imputer.input_data, patient_imputer.input_data)
+
+        no_cholesterol = input_frame.assign(cholesterol=np.nan)
+        self.assertTrue(Impute(no_cholesterol, backend="polars").impute_tomography().empty)
+        with self.assertRaises(ValueError):
+            Impute(input_frame, backend="spark")
+        with self.assertRaises(ValueError):
+            Impute(input_frame, backend="polars", cache_size=16)
+        with self.assertRaises(ValueError):
+            Impute(input_frame, backend="polars", instrumentation=Instrumentation())
+
+
+# the grouped kernels, compiled or not, give exactly the statistics of
+# pandas' groupby on values whose sums are rounded, and several keys group
+# only the rows where all of them are known
+class TestCase45(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_grouped_kernels(self):
+        rng = np.random.default_rng(0)
+        rows = 2000
+        keys = pd.Series(rng.integers(0, 30, rows).astype(float))
+        keys[rng.random(rows) < 0.05] = np.nan
+        values = pd.Series(rng.integers(0, 6, rows) / 3 + 0.1)
+        values[rng.random(rows) < 0.3] = np.nan
+
+        codes, groups = group_codes(keys)
+        grouped = values.groupby(keys)
+        uniques = pd.unique(keys[keys.notnull()])
+        # Majority values from the per-group mode, np.nan when tied
+        modes = grouped.agg(
+            lambda group: group.mode().iloc[0] if len(group.mode()) == 1 else np.nan
+        )
+        expected = {
+            group_median: grouped.median(),
+            group_mean: grouped.mean(),
+            group_min: grouped.min(),
+            group_majority: modes,
+        }
+        # The NumPy kernels, then the loops Numba compiles, run uncompiled
+        for loops in [False, True]:
+            for kernel, statistics in expected.items():
+                np.testing.assert_array_equal(
+                    kernel(codes, values, groups, loops=loops),
+                    statistics.reindex(uniques).to_numpy(),
+                    err_msg=kernel.__name__,
+                )
+
+        # Groups of several keys; rows with an unknown key are in no group
+        codes, groups = group_codes(keys, values)
+        self.assertEqual(groups, len(pd.MultiIndex.from_arrays([keys, values]).dropna().unique()))
+        np.testing.assert_array_equal(codes < 0, keys.isnull() | values.isnull())
+
+
+# the statistics cache serves repeated per-hospital calls with the results
+# of uncached ones, and edits forget only the hospitals they touch
+class TestCase46(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_statistics_cache(self):
+        input_frame = make_sorted_patient_frame(3000)
+        reference_imputer = Impute(input_frame.copy())
+        patient_imputer = Impute(input_frame.copy(), cache_size=64, check_cache=True)
+        methods = ["impute_age", "impute_cholesterol_single_hospital"]
+
+        # The writes of the first calls invalidate the statistics of their
+        # hospitals, the second calls write nothing and the third hit the cache
+        for _ in range(3):
+            for hospitalID in range(8):
+                for method in methods:
+                    assert_frame_equal(
+                        getattr(reference_imputer, method)(hospitalID),
+                        getattr(patient_imputer, method)(hospitalID),
+                    )
+        self.assertEqual(patient_imputer.cache.misses, 32)
+        self.assertEqual(patient_imputer.cache.hits, 16)
+
+        # Edits through the class invalidate only the hospitals they touch
+        positions = np.flatnonzero(input_frame["hospitalID"] == 5)[:10]
+        for imputer in [reference_imputer, patient_imputer]:
+            imputer.set_values(positions, "cholesterol", np.nan)
+            imputer.set_values(positions[:3], "age", 75.0)
+        self.assertNotIn(("median_age", 5), patient_imputer.cache.statistics)
+        self.assertNotIn(("average_cholesterol", 5), patient_imputer.cache.statistics)
+        self.assertEqual(len(patient_imputer.cache.statistics), 14)
+        for hospitalID in range(8):
+            for method in methods:
+                assert_frame_equal(
+                    getattr(reference_imputer, method)(hospitalID),
+                    getattr(patient_imputer, method)(hospitalID),
+                )
+        assert_frame_equal(reference_imputer.input_data, patient_imputer.input_data)
+
+        # The all-hospital methods write through the cache too
+        patient_imputer.impute_tomography()
+        for hospitalID in range(8):
+            patient_imputer.impute_cholesterol_single_hospital(hospitalID)
+
+        # The age bracket minimums of impute_cholesterol are cached too, and
+        # moving an age to another bracket forgets both brackets
+        reference_imputer = Impute(input_frame.copy())
+        bracket_imputer = Impute(input_frame.copy(), cache_size=64, check_cache=True)
+        for _ in range(3):
+            assert_frame_equal(
+                reference_imputer.impute_cholesterol(), bracket_imputer.impute_cholesterol()
+            )
+        self.assertEqual(bracket_imputer.cache.hits, input_frame["age"].floordiv(5).nunique())
+        youngest = np.flatnonzero(input_frame["age"] < 5)[:1]
+        for imputer in [reference_imputer, bracket_imputer]:
+            imputer.set_values(youngest, "cholesterol", -1.0)
+            imputer.impute_cholesterol()
+            imputer.set_values(youngest, "age", 37.0)
+            imputer.set_values(np.flatnonzero(input_frame["age"] >= 35), "cholesterol", np.nan)
+        assert_frame_equal(
+            reference_imputer.impute_cholesterol(), bracket_imputer.impute_cholesterol()
+        )
+        assert_frame_equal(reference_imputer.input_data, bracket_imputer.input_data)
+
+        # Only the most recently used statistics are kept
+        small_imputer = Impute(input_frame.copy(), cache_size=3)
+        for hospitalID in list(range(8)) * 2:
+            small_imputer.impute_age(hospitalID)
+        self.assertEqual(
+            list(small_imputer.cache.statistics), [("median_age", h) for h in [5, 6, 7]]
+        )
+
+        # A write that bypasses the cache is caught by check_cache
+        patient_imputer.input_data.loc[input_frame["hospitalID"] == 5, "age"] = 1.0
+        with self.assertRaises(AssertionError):
+            patient_imputer.impute_age(5)
+        with self.assertRaises(ValueError):
+            patient_imputer.set_values(positions, "hospitalID", 1)
+
+
+# per-hospital lines impute tomography from each hospital's own fit where
+# it has enough points, and from the line of all hospitals elsewhere
+class TestCase47(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_per_hospital_tomography(self):
+        # Every hospital measures tomography on its own line; hospital 3 has
+        # a single known pair and hospital 4 a single cholesterol level
+        rng = np.random.default_rng(0)
+        rows = 4000
+        hospitalIDs = rng.integers(0, 5, rows)
+        cholesterol = rng.integers(100, 300, rows).astype(float)
+        cholesterol[hospitalIDs == 4] = 200.0
+        tomography = 2.0 + 0.5 * hospitalIDs + (1.0 + hospitalIDs / 10) * cholesterol
+        tomography[rng.random(rows) < 0.3] = np.nan
+        tomography[(hospitalIDs == 3) & (np.arange(rows) > np.argmax(hospitalIDs == 3))] = np.nan
+        input_frame = pd.DataFrame(
+            {
+                "patientID": np.arange(rows),
+                "hospitalID": hospitalIDs,
+                "age": 50.0,
+                "cholesterol": cholesterol,
+                "tomography": tomography,
+            }
+        )
+
+        global_imputer = Impute(input_frame.copy())
+        global_imputer.impute_tomography()
+        patient_imputer = Impute(input_frame.copy())
+        changed_rows = patient_imputer.impute_tomography(per_hospital=True)
+        self.assertEqual(len(changed_rows), np.count_nonzero(np.isnan(tomography)))
+
+        imputed = patient_imputer.input_data["tomography"]
+        for hospitalID in range(5):
+            at_hospital = hospitalIDs == hospitalID
+            if hospitalID in [3, 4]:
+                np.testing.assert_allclose(
+                    imputed[at_hospital], global_imputer.input_data["tomography"][at_hospital]
+                )
+            else:
+                np.testing.assert_allclose(
+                    imputed[at_hospital],
+                    2.0 + 0.5 * hospitalID + (1.0 + hospitalID / 10) * cholesterol[at_hospital],
+                )
+        if HAS_POLARS:
+            assert_frame_equal(
+                changed_rows,
+                Impute(input_frame.copy(), backend="polars").impute_tomography(per_hospital=True),
+            )
+
+        # The sums of every group are those of a RegressionStatistics
+        codes = rng.integers(-1, 20000, 100000)
+        x = rng.normal(size=100000)
+        y = 3 * x + rng.normal(size=100000)
+        models = GroupRegressionStatistics(20000).update(codes, x, y)
+        for group in [0, 123, 19999]:
+            model = RegressionStatistics().update(x[codes == group], y[codes == group])
+            self.assertEqual(models.count[group], model.count)
+            if models.fitted()[group]:
+                self.assertAlmostEqual(models.slope()[group], model.slope())
+                self.assertAlmostEqual(models.intercept()[group], model.intercept())
+
+
+# streaming over data where no cholesterol is known leaves it unknown,
+# like the in-memory imputation
+class TestCase48(unittest.TestCase):
+    @timeout_decorator.timeout(15)
+    def test_streaming_impute_without_cholesterol(self):
+        input_frame = make_sorted_patient_frame(300).assign(cholesterol=np.nan)
+        chunks = [input_frame.iloc[:150], input_frame.iloc[150:]]
+
+        streaming_imputer = StreamingImpute(lambda: iter(chunks))
+        assert_frame_equal(
+            impute_sequentially(input_frame),
+            pd.concat(streaming_imputer.impute_chunks(), ignore_index=True),
+        )
+
+
+# on small random tables with unknown ages and cholesterol, tuned schemas
+# impute like untuned ones, whether the rows were inserted before or after
+# tuning
+class TestCase49(unittest.TestCase):
+    @timeout_decorator.timeout(60)
+    def test_tuned_schema_parity(self):
+        for seed in range(20):
+            random = np.random.default_rng(seed)
+            rows = int(random.integers(5, 60))
+            input_frame = pd.DataFrame(
+                {
+                    "patientID": np.arange(rows),
+                    "hospitalID": random.integers(0, 4, rows),
+                    "age": random.integers(0, 40, rows).astype(float),
+                    "cholesterol": random.integers(0, 12, rows) / 4,
+                    "tomography": random.integers(0, 10, rows).astype(float),
+                }
+            )
+            for column in ["age", "cholesterol", "tomography"]:
+                input_frame.loc[random.random(rows) < 0.4, column] = np.nan
+
+            tables = []
+            for tuning in ["none", "before insert", "after insert"]:
+                engine = make_patient_database()
+                if tuning == "before insert":
+                    tune_schema(engine)
+                input_frame.to_sql(Patient.__tablename__, engine, if_exists="append", index=False)
+                if tuning == "after insert":
+                    tune_schema(engine)
+                DatabaseImpute(engine).impute()
+                tables.append(read_patient_table(engine)[input_frame.columns])
+
+            assert_frame_equal(tables[1], tables[0])
+            assert_frame_equal(tables[2], tables[0])
+
+
+# ingesting hospital files into a table keeps it equal to the imputed
+# store, with changed values overwritten and removed patients deleted
+class TestCase50(unittest.TestCase):
+    @timeout_decorator.timeout(30)
+    def test_incremental_ingest_into_table(self):
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as directory:
+            filepaths = []
+            for hospitalID in range(1, 4):
+                filepath = os.path.join(directory, f"input-hospital{hospitalID}.csv")
+                values = rng.integers(0, 40, (50, 3)).astype(float)
+                values[rng.random((50, 3)) < 0.3] = np.nan
+                pd.DataFrame(
+                    {
+                        "ID": 100 * hospitalID + np.arange(50),
+                        "Age": values[:, 0],
+                        "Cholesterol": values[:, 1] / 4,
+                        "Tomography": values[:, 2],
+                    }
+                ).to_csv(filepath, index=False)
+                filepaths.append(filepath)
+
+            engine = make_patient_database()
+            store = IncrementalImpute(os.path.join(directory, "imputation"))
+            self.assertEqual(store.ingest_into_table(engine, filepaths), {1, 2, 3})
+            self.assertEqual(store.ingest_into_table(engine, filepaths), set())
+
+            # A known value changes, which changes the line predicting
+            # tomography in the other hospitals too, and a patient is removed
+            changed = pd.read_csv(filepaths[1])
+            known = changed["Cholesterol"].notnull() & changed["Tomography"].notnull()
+            changed.loc[known.idxmax(), "Tomography"] += 1
+            changed.iloc[1:].to_csv(filepaths[1], index=False)
+            self.assertEqual(store.ingest_into_table(engine, filepaths), {1, 2, 3})
+
+            table = read_patient_table(engine)
+            self.assertNotIn(200, table["patientID"].tolist())
+            assert_frame_equal(
+                table,
+                store.load()
+                .sort_values(["hospitalID", "patientID"], ignore_index=True)
+                .astype(table.dtypes.to_dict()),
+            )
+
+
 # Run all unit tests above.
 unittest.main(argv=[""], verbosity=2, exit=False)